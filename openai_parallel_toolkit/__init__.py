@@ -1,2 +1,10 @@
+from .api.cache import ResponseCache
+from .api.client import HTTPClient
+from .api.concurrency import AdaptiveConcurrency
+from .api.hedge import HedgePolicy
 from .api.model import OpenAIModel, Prompt
+from .api.packing import PromptPacker
+from .api.planner import CapacityPlanner
+from .api.retry import CircuitBreaker, RetryPolicy
+from .api.scheduler import Scheduler
 from .main import ParallelToolkit
@@ -0,0 +1,358 @@
+import asyncio
+import logging
+import time
+from functools import partial
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+import aiohttp
+import openai
+
+from openai_parallel_toolkit.utils.logger import LOG_LABEL
+from openai_parallel_toolkit.utils.metrics import PACKED_ITEMS, REQUESTS, RETRIES
+from openai_parallel_toolkit.utils.process_bar import ProgressBar
+from openai_parallel_toolkit.utils.trace import TRACER
+from openai_parallel_toolkit.utils.writer import ResultWriter, open_writer
+from .cache import ResponseCache
+from .client import HTTPClient
+from .concurrency import alimited
+from .errors import CONTEXT_LENGTH, DAILY_LIMIT, INVALID, QUOTA, RATE_LIMIT, TRANSIENT, classify_error
+from .hedge import agenerate_hedged
+from .keys import KeyManager
+from .model import OpenAIModel, Prompt
+from .packing import PromptPacker
+from .request import record_completion
+from .retry import RetryPolicy
+
+
+async def request_openai_api_async(openai_model: OpenAIModel, prompt: Prompt, key_manager: KeyManager,
+                                   max_retries: int, cache: ResponseCache = None,
+                                   retry_policy: RetryPolicy = None) -> Optional[str]:
+    if cache:
+        return await cache.aget_or_request(
+                cache.make_key(openai_model, prompt),
+                partial(request_openai_api_async, openai_model=openai_model, prompt=prompt, key_manager=key_manager,
+                        max_retries=max_retries, retry_policy=retry_policy))
+    retry_policy = retry_policy or RetryPolicy(max_retries=max_retries)
+    tokens = openai_model.count_tokens(prompt)
+    model_name = openai_model.select_model(tokens)
+    track = TRACER.task_track()
+    key = None  # Leased once the request holds a concurrency slot, and released before every retry
+    completion = None
+    attempts = 0
+    start = time.monotonic()
+
+    try:
+        while attempts < retry_policy.max_retries and not retry_policy.expired(start):
+            probe = await retry_policy.await_breaker(start)
+            if probe is None:
+                break
+            try:
+                try:
+                    async with alimited(retry_policy.concurrency) as slot:
+                        key = await key_manager.aget_new_key(tokens=tokens, timeout=retry_policy.remaining(start))
+                        if key is None:
+                            break  # The deadline passed while waiting for a key
+                        slot.start()
+                        with TRACER.span("http", track=track):
+                            if retry_policy.hedge:
+                                completion, key = await agenerate_hedged(retry_policy.hedge, openai_model, prompt,
+                                                                         model_name, key, key_manager, tokens)
+                                retry_policy.hedge.record(time.monotonic() - slot.started)
+                            else:
+                                completion = await openai_model.agenerate(instruction=prompt.instruction,
+                                                                          input=prompt.input, api_key=key,
+                                                                          model_name=model_name,
+                                                                          api_base=key_manager.api_base_for(key))
+                finally:
+                    if probe:
+                        retry_policy.breaker.end_probe()
+                logging.info(f"{LOG_LABEL}key {key} ,request ok")
+                retry_policy.breaker.record_success()
+                record_completion(key, slot.started, completion)
+                key_manager.release_key(key, tokens=completion.get('usage', {}).get('total_tokens'),
+                                        latency=time.monotonic() - slot.started)
+                key = None
+                break
+            except Exception as e:
+                if key is None:
+                    raise  # No key could be leased
+                kind, retry_after = classify_error(e)
+                RETRIES.inc(label=kind)
+                key, failed_key = None, key
+                if kind in (QUOTA, DAILY_LIMIT):
+                    key_manager.remove_key(failed_key, exhausted=kind == DAILY_LIMIT)
+                    continue
+                if kind == RATE_LIMIT:
+                    key_manager.limit_key(failed_key, retry_after)
+                    continue
+                if kind == TRANSIENT and key_manager.record_failure(failed_key):
+                    # The endpoint is out of rotation and has the key back: move to another one, without a backoff
+                    attempts += 1
+                    continue
+                key_manager.release_key(failed_key)
+                if kind == CONTEXT_LENGTH and openai_model.next_model(model_name):
+                    model_name = openai_model.next_model(model_name)
+                    logging.info(f"{LOG_LABEL}Prompt exceeds the context window, retrying with {model_name}")
+                    continue
+                if kind in (CONTEXT_LENGTH, INVALID):
+                    logging.error(f"{LOG_LABEL}Error occurred while accessing openai API: {e}")
+                    break
+                attempts += 1
+                if kind == TRANSIENT:
+                    retry_policy.breaker.record_failure()
+                else:
+                    logging.error(
+                            f"{LOG_LABEL}Unknown error occurred while accessing OpenAI API: {e}. Retry attempt "
+                            f"{attempts} of {retry_policy.max_retries}")
+                with TRACER.span("backoff", track=track):
+                    await asyncio.sleep(retry_policy.backoff(attempts, retry_after))
+    except asyncio.CancelledError:
+        # The caller stopped waiting for this item: give the key back before unwinding
+        if key is not None:
+            key_manager.release_key(key)
+        raise
+
+    if not completion:
+        REQUESTS.inc(label="failed")
+        return None
+    REQUESTS.inc(label="ok")
+
+    return completion['choices'][0]['message']['content'].strip()
+
+
+async def request_packed_async(group: List[Tuple[str, Prompt]], openai_model: OpenAIModel, key_manager: KeyManager,
+                               max_retries: int, packer: PromptPacker, cache: ResponseCache = None,
+                               retry_policy: RetryPolicy = None) -> List[Tuple[str, Optional[str]]]:
+    """
+    Async variant of request_packed. The fallback requests for a group that did not split run concurrently.
+    """
+    request = partial(request_openai_api_async, openai_model=openai_model, key_manager=key_manager,
+                      max_retries=max_retries, cache=cache, retry_policy=retry_policy)
+    if len(group) > 1:
+        output = await request(prompt=packer.build(group))
+        results = packer.split(output, len(group)) if output is not None else None
+        if results is not None:
+            PACKED_ITEMS.inc(len(group), label="packed")
+            return [(index, result) for (index, _), result in zip(group, results)]
+        PACKED_ITEMS.inc(len(group), label="fallback")
+        logging.info(f"{LOG_LABEL}Packed request for {len(group)} prompts did not split, sending them one by one")
+    results = await asyncio.gather(*(request(prompt=prompt) for _, prompt in group))
+    return [(index, result) for (index, _), result in zip(group, results)]
+
+
+async def request_openai_api_with_progress_async(item: Tuple[int, Prompt], openai_model: OpenAIModel,
+                                                 key_manager: KeyManager, process_bar: ProgressBar,
+                                                 semaphore: asyncio.Semaphore, max_retries: int,
+                                                 writer: ResultWriter = None, cache: ResponseCache = None,
+                                                 retry_policy: RetryPolicy = None):
+    key, prompt = item
+    queued, track = TRACER.clock(), TRACER.task_track()
+    async with semaphore:
+        TRACER.add("queue", queued, time.monotonic(), key, track)
+        with TRACER.span("item", key, track):
+            result = await request_openai_api_async(openai_model=openai_model, prompt=prompt,
+                                                    key_manager=key_manager, max_retries=max_retries, cache=cache,
+                                                    retry_policy=retry_policy)
+
+    if writer:
+        writer.put(key, result)
+    process_bar.update()
+    return result
+
+
+async def request_packed_with_progress_async(group: List[Tuple[str, Prompt]], openai_model: OpenAIModel,
+                                             key_manager: KeyManager, process_bar: ProgressBar,
+                                             semaphore: asyncio.Semaphore, max_retries: int, packer: PromptPacker,
+                                             writer: ResultWriter = None, cache: ResponseCache = None,
+                                             retry_policy: RetryPolicy = None):
+    queued, track = TRACER.clock(), TRACER.task_track()
+    async with semaphore:
+        TRACER.add("queue", queued, time.monotonic(), group[0][0], track)
+        with TRACER.span("group", group[0][0], track):
+            results = await request_packed_async(group, openai_model=openai_model, key_manager=key_manager,
+                                                 max_retries=max_retries, packer=packer, cache=cache,
+                                                 retry_policy=retry_policy)
+    if writer:
+        for index, result in results:
+            writer.put(index, result)
+    process_bar.update(len(results))
+    return [result for _, result in results]
+
+
+async def parallel_request_openai_async(data: Dict[int, Prompt], openai_model: OpenAIModel,
+                                        concurrency: int, key_manager: KeyManager, max_retries: int,
+                                        process_bar: ProgressBar,
+                                        output_path: str, writer: ResultWriter = None, cache: ResponseCache = None,
+                                        retry_policy: RetryPolicy = None, packer: PromptPacker = None,
+                                        http_client: HTTPClient = None):
+    """
+    Process data with one coroutine per prompt (or per packed group). At most `concurrency` requests
+    are in flight, and each key serves a single request at a time because KeyManager leases keys exclusively.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = (http_client or HTTPClient()).connector(concurrency)
+    with open_writer(output_path, writer) as writer:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            token = openai.aiosession.set(session)
+            try:
+                if packer:
+                    tasks = [
+                        asyncio.ensure_future(request_packed_with_progress_async(
+                                group, openai_model=openai_model, key_manager=key_manager, process_bar=process_bar,
+                                semaphore=semaphore, max_retries=max_retries, packer=packer, writer=writer,
+                                cache=cache, retry_policy=retry_policy))
+                        for group in packer.pack(data.items(), openai_model)
+                    ]
+                else:
+                    tasks = [
+                        asyncio.ensure_future(request_openai_api_with_progress_async(
+                                item, openai_model=openai_model, key_manager=key_manager, process_bar=process_bar,
+                                semaphore=semaphore, max_retries=max_retries, writer=writer, cache=cache,
+                                retry_policy=retry_policy))
+                        for item in data.items()
+                    ]
+                results = []
+                for future in asyncio.as_completed(tasks):
+                    try:
+                        result = await future
+                        if packer:
+                            results.extend(result)
+                        else:
+                            results.append(result)
+                    except Exception as e:
+                        logging.error(f"{LOG_LABEL}Error occurred while processing prompt: {e}")
+                        results.append(None)
+            finally:
+                openai.aiosession.reset(token)
+
+    return results
+
+
+async def stream_request_openai_async(items: Iterable[Tuple[int, Prompt]], openai_model: OpenAIModel,
+                                      concurrency: int, key_manager: KeyManager, max_retries: int,
+                                      process_bar: ProgressBar,
+                                      output_path: str, writer: ResultWriter = None, cache: ResponseCache = None,
+                                      retry_policy: RetryPolicy = None, packer: PromptPacker = None,
+                                      http_client: HTTPClient = None):
+    """
+    Process items pulled lazily from an iterable, creating a task only when a request slot is free,
+    so memory stays flat regardless of the dataset size.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    pending = set()
+
+    async def process(group):
+        try:
+            with TRACER.span("item", group[0][0], TRACER.task_track()):
+                if packer:
+                    results = await request_packed_async(group, openai_model=openai_model, key_manager=key_manager,
+                                                         max_retries=max_retries, packer=packer, cache=cache,
+                                                         retry_policy=retry_policy)
+                else:
+                    results = [(group[0][0], await request_openai_api_async(
+                            openai_model=openai_model, prompt=group[0][1], key_manager=key_manager,
+                            max_retries=max_retries, cache=cache, retry_policy=retry_policy))]
+        except Exception as e:
+            logging.error(f"{LOG_LABEL}Error occurred while processing prompt {group[0][0]}: {e}")
+            results = [(index, None) for index, _ in group]
+        finally:
+            semaphore.release()
+        if writer:
+            for index, result in results:
+                writer.put(index, result)
+        process_bar.update(len(results))
+
+    connector = (http_client or HTTPClient()).connector(concurrency)
+    with open_writer(output_path, writer) as writer:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            token = openai.aiosession.set(session)
+            try:
+                groups = packer.pack(items, openai_model) if packer else ([item] for item in items)
+                for group in groups:
+                    await semaphore.acquire()
+                    task = asyncio.ensure_future(process(group))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                if pending:
+                    await asyncio.wait(pending)
+            finally:
+                openai.aiosession.reset(token)
+
+
+async def iter_request_openai_async(items: Iterable[Tuple[int, Prompt]], openai_model: OpenAIModel,
+                                    concurrency: int, key_manager: KeyManager, max_retries: int,
+                                    process_bar: ProgressBar,
+                                    output_path: str = None, ordered: bool = False, buffer_size: int = None,
+                                    writer: ResultWriter = None, cache: ResponseCache = None,
+                                    retry_policy: RetryPolicy = None, packer: PromptPacker = None,
+                                    http_client: HTTPClient = None) -> AsyncIterator[Tuple[int, Optional[str]]]:
+    """
+    Async variant of iter_request_openai: yield (index, result) pairs as requests finish, or in order.
+    At most concurrency requests are in flight and buffer_size items (concurrency * 2 by default) are
+    in flight or held in the reorder buffer.
+    """
+    if ordered and packer:
+        raise ValueError("Ordered delivery cannot be combined with prompt packing")
+    window = buffer_size or concurrency * 2
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(unit, session):
+        # Each task runs in a copy of the context, so setting the session here does not leak
+        openai.aiosession.set(session)
+        group = unit if packer else [unit]
+        queued, track = TRACER.clock(), TRACER.task_track()
+        try:
+            async with semaphore:
+                TRACER.add("queue", queued, time.monotonic(), group[0][0], track)
+                with TRACER.span("item", group[0][0], track):
+                    if packer:
+                        results = await request_packed_async(group, openai_model=openai_model,
+                                                             key_manager=key_manager, max_retries=max_retries,
+                                                             packer=packer, cache=cache, retry_policy=retry_policy)
+                    else:
+                        results = [(unit[0], await request_openai_api_async(
+                                openai_model=openai_model, prompt=unit[1], key_manager=key_manager,
+                                max_retries=max_retries, cache=cache, retry_policy=retry_policy))]
+        except Exception as e:
+            logging.error(f"{LOG_LABEL}Error occurred while processing prompt {group[0][0]}: {e}")
+            results = [(index, None) for index, _ in group]
+        if writer:
+            for index, result in results:
+                writer.put(index, result)
+        process_bar.update(len(results))
+        return results
+
+    connector = (http_client or HTTPClient()).connector(concurrency)
+    with open_writer(output_path, writer) as writer:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            units = iter(packer.pack(items, openai_model) if packer else items)
+            pending = {}  # task -> sequence number
+            finished = {}  # sequence number -> results, waiting for earlier units in ordered mode
+            submitted = next_seq = 0
+            exhausted = False
+            try:
+                while True:
+                    while not exhausted and len(pending) + len(finished) < window:
+                        unit = next(units, None)
+                        if unit is None:
+                            exhausted = True
+                            break
+                        pending[asyncio.ensure_future(process(unit, session))] = submitted
+                        submitted += 1
+                    if not pending:
+                        break
+                    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        seq = pending.pop(task)
+                        if ordered:
+                            finished[seq] = task.result()
+                        else:
+                            for pair in task.result():
+                                yield pair
+                    while next_seq in finished:
+                        for pair in finished.pop(next_seq):
+                            yield pair
+                        next_seq += 1
+            finally:
+                for task in pending:
+                    task.cancel()
@@ -0,0 +1,171 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Optional
+
+from cachetools import LRUCache
+
+from .model import OpenAIModel, Prompt
+
+
+class ResponseCache:
+    """
+    Two-tier cache of completions keyed by model settings and prompt: an in-memory LRU in front of an
+    optional SQLite file whose least recently used entries are evicted once it exceeds disk_max_bytes.
+    Identical prompts that are requested concurrently share a single upstream request.
+    """
+
+    def __init__(self, path: str = None, memory_size: int = 10000, disk_max_bytes: int = 1 << 30):
+        """
+        Args:
+            path (str): SQLite file of the disk tier. Without it only the memory tier is used.
+            memory_size (int): Number of responses kept in memory.
+            disk_max_bytes (int): Size of the cached responses the disk tier may hold.
+        """
+        self.path = path
+        self.memory = LRUCache(maxsize=memory_size)
+        self.lock = threading.Lock()
+        self.in_flight = {}  # key -> Future of the request that is fetching it
+        self.async_in_flight = {}  # key -> asyncio.Future, for coroutines on the running loop
+        self.disk_max_bytes = disk_max_bytes
+        self.conn = None
+        self.disk_bytes = 0
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, size INTEGER, accessed REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+            self.disk_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def __getstate__(self):
+        # Sharded workers open their own connection to the same file; the memory tier is not copied
+        return {"path": self.path, "memory_size": self.memory.maxsize, "disk_max_bytes": self.disk_max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @staticmethod
+    def make_key(openai_model: OpenAIModel, prompt: Prompt) -> str:
+        fields = [openai_model.model_name, openai_model.kwargs, prompt.instruction, prompt.input]
+        if openai_model.stream and (openai_model.max_output_chars or openai_model.stop_when):
+            # A cut-off changes the answer; keys of uncut models stay as they were
+            fields.append([openai_model.max_output_chars, getattr(openai_model.stop_when, "__qualname__", None)])
+        payload = json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None or not self.conn:
+                return value
+            row = self.conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            self.memory[key] = row[0]
+            return row[0]
+
+    def put(self, key: str, value: str):
+        with self.lock:
+            self.memory[key] = value
+            if not self.conn:
+                return
+            size = len(value.encode("utf-8"))
+            old = self.conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", (key, value, size, time.time()))
+            self.disk_bytes += size - (old[0] if old else 0)
+            self._evict()
+            self.conn.commit()
+
+    def get_or_request(self, key: str, request: Callable[[], Optional[str]]) -> Optional[str]:
+        """
+        Return the cached response, or call request() once for all threads asking for the same key.
+        Only successful (non-None) responses are cached.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self.lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self.in_flight[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            value = request()
+            if value is not None:
+                self.put(key, value)
+            future.set_result(value)
+            return value
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+
+    async def aget_or_request(self, key: str, request: Callable[[], Awaitable[Optional[str]]]) -> Optional[str]:
+        """
+        Async variant of get_or_request for coroutines on one event loop. When the coroutine making the
+        request is cancelled, one of those waiting for it makes the request anew and the others wait for that.
+        """
+        while True:
+            value = self.get(key)
+            if value is not None:
+                return value
+            future = self.async_in_flight.get(key)
+            if future is None:
+                break
+            # asyncio.wait neither cancels the shared future nor raises its cancellation to the waiters
+            await asyncio.wait({future})
+            if not future.cancelled():
+                return future.result()
+        future = self.async_in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await request()
+            if value is not None:
+                self.put(key, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark as retrieved when nobody else is waiting
+            raise
+        finally:
+            self.async_in_flight.pop(key, None)
+
+    def close(self):
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+    def _evict(self):
+        if self.disk_bytes <= self.disk_max_bytes:
+            return
+        # Evict down to 90% of the limit so eviction does not run on every insert
+        target = self.disk_max_bytes * 0.9
+        while self.disk_bytes > target:
+            rows = self.conn.execute("SELECT key, size FROM cache ORDER BY accessed LIMIT 256").fetchall()
+            if not rows:
+                self.disk_bytes = 0
+                break
+            evicted = []
+            for key, size in rows:
+                evicted.append((key,))
+                self.disk_bytes -= size
+                if self.disk_bytes <= target:
+                    break
+            self.conn.executemany("DELETE FROM cache WHERE key = ?", evicted)
@@ -0,0 +1,55 @@
+from contextlib import contextmanager
+
+import aiohttp
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HTTPClient:
+    """
+    Connection pools for the OpenAI client. The openai library keeps one requests.Session per thread,
+    so each worker reuses its own keep-alive connections instead of paying for a TCP and TLS handshake
+    per request; this class configures those sessions and the aiohttp connector of the async engines.
+    """
+
+    def __init__(self, pool_maxsize: int = 4, max_retries: int = 2, limit_per_host: int = 0,
+                 keepalive_timeout: float = 60.0):
+        """
+        Args:
+            pool_maxsize (int): Connections each thread's session keeps open per host.
+            max_retries (int): Retries of failed connection attempts, before any data is sent.
+            limit_per_host (int): Most connections per host of the async engines (0: no limit besides
+                the concurrency).
+            keepalive_timeout (float): Seconds the async engines keep an idle connection open.
+        """
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+
+    def make_session(self) -> requests.Session:
+        session = requests.Session()
+        if openai.proxy:
+            proxy = openai.proxy
+            session.proxies = proxy if isinstance(proxy, dict) else {"http": proxy, "https": proxy}
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_maxsize, max_retries=self.max_retries)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @contextmanager
+    def installed(self):
+        """
+        Let the threads started inside the block create their sessions with make_session.
+        """
+        previous = openai.requestssession
+        openai.requestssession = self.make_session
+        try:
+            yield self
+        finally:
+            openai.requestssession = previous
+
+    def connector(self, limit: int) -> aiohttp.TCPConnector:
+        return aiohttp.TCPConnector(limit=limit, limit_per_host=self.limit_per_host,
+                                    keepalive_timeout=self.keepalive_timeout)
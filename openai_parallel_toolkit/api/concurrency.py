@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+from openai_parallel_toolkit.utils.logger import LOG_LABEL
+from openai_parallel_toolkit.utils.metrics import METRICS
+from .errors import RATE_LIMIT, TRANSIENT, classify_error
+
+# Errors that mean the endpoint is receiving more than it can handle
+CONGESTION = (RATE_LIMIT, TRANSIENT)
+
+
+class AsyncWaiters:
+    """
+    Coroutines waiting for something another thread may signal, such as a released slot or key. Each
+    waits on a future of its own event loop, which wake resolves through call_soon_threadsafe, so nobody
+    polls. add, wake and wake_all must be called with the owner's lock held.
+    """
+
+    def __init__(self):
+        self.futures = deque()
+
+    def __len__(self):
+        return len(self.futures)
+
+    def add(self) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.futures.append(future)
+        return future
+
+    def wake(self, count: int = 1):
+        """
+        Wake up to count waiters, oldest first.
+        """
+        while count > 0 and self.futures:
+            future = self.futures.popleft()
+            if future.done():
+                continue  # Timed out or cancelled, and not yet taken out by its coroutine
+            future.get_loop().call_soon_threadsafe(_set_result, future)
+            count -= 1
+
+    def wake_all(self):
+        self.wake(len(self.futures))
+
+    async def wait(self, future: asyncio.Future, timeout: float, lock):
+        """
+        Wait until future is woken or timeout seconds (None for no timeout) pass. A cancelled waiter
+        that was already woken passes the wakeup on, so it is not lost.
+        Args:
+            lock: The owner's lock, taken to take the future out.
+        """
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            with lock:
+                self._discard(future)
+        except asyncio.CancelledError:
+            with lock:
+                if not self._discard(future):
+                    self.wake()
+            raise
+
+    def _discard(self, future) -> bool:
+        try:
+            self.futures.remove(future)
+            return True
+        except ValueError:
+            return False
+
+
+class AdaptiveConcurrency:
+    """
+    Limit on the requests in flight, adjusted at runtime (AIMD). Each successful request raises the limit
+    by increase / limit, about `increase` per round trip of the whole window, as long as at least half of
+    the limit is in use. A rate limit error, an overload or server error, or a short-term latency above
+    latency_factor times the long-term latency multiplies it by decrease, at most once per average
+    latency so that one burst of errors counts once.
+    """
+
+    def __init__(self, initial: int = 16, min_limit: int = 1, max_limit: int = 256, increase: float = 1.0,
+                 decrease: float = 0.7, latency_factor: float = 2.0):
+        """
+        Args:
+            initial (int): Limit at the start.
+            min_limit (int): Lowest limit.
+            max_limit (int): Highest limit. The engines never run more than threads (or concurrency)
+                requests at once either.
+            increase (float): Additive increase per window of successful requests.
+            decrease (float): Factor applied to the limit on congestion.
+            latency_factor (float): How many times slower than the long-term average the recent requests
+                have to be to count as congestion.
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.in_flight = 0
+        self.short_latency = None  # Moving averages of the latency over about 10 and 100 requests
+        self.long_latency = None
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+        self.async_waiters = AsyncWaiters()  # Coroutines waiting in aacquire, woken by release
+        METRICS.gauge("openai_concurrency_limit", "Current limit of requests in flight", lambda: int(self.limit))
+
+    def __getstate__(self):
+        # Each sharded worker starts from the current limit with its own measurements
+        return {"initial": int(self.limit), "min_limit": self.min_limit, "max_limit": self.max_limit,
+                "increase": self.increase, "decrease": self.decrease, "latency_factor": self.latency_factor}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def acquire(self):
+        """
+        Block until a request can be sent.
+        """
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    async def aacquire(self):
+        """
+        Async variant of acquire.
+        """
+        while True:
+            with self.cond:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                waiter = self.async_waiters.add()
+            await self.async_waiters.wait(waiter, None, self.cond)
+
+    def release(self, latency: float = None, congested: bool = False):
+        """
+        End a request.
+        Args:
+            latency (float): Seconds a successful request took.
+            congested (bool): The request failed with a rate limit, overload or server error.
+        """
+        with self.cond:
+            # Only grow a limit that is in use, not one the callers never reach
+            used = self.in_flight >= self.limit / 2
+            self.in_flight -= 1
+            if latency is not None:
+                if self.short_latency is None:
+                    self.short_latency = self.long_latency = latency
+                self.short_latency = 0.9 * self.short_latency + 0.1 * latency
+                self.long_latency = 0.99 * self.long_latency + 0.01 * latency
+                congested = congested or self.short_latency > self.latency_factor * self.long_latency
+            if congested:
+                self._decrease()
+            elif latency is not None and used:
+                self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+            self.cond.notify_all()
+            # Wake as many waiting coroutines as there are free slots
+            self.async_waiters.wake(int(self.limit) - self.in_flight)
+
+    def describe(self) -> str:
+        return f"limit={int(self.limit)}"
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease < (self.short_latency or 0):
+            return
+        self.last_decrease = now
+        limit = max(self.min_limit, self.limit * self.decrease)
+        if int(limit) < int(self.limit):
+            logging.info(f"{LOG_LABEL}Endpoint congested, lowering the concurrency limit to {int(limit)}")
+        self.limit = limit
+
+
+def _set_result(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class Slot:
+    """
+    A slot held by limited. The latency reported for the request is measured from start(), so the
+    engines call it once the key is leased and the controller does not see the wait for the key.
+    """
+    __slots__ = ("started",)
+
+    def __init__(self):
+        self.started = time.monotonic()
+
+    def start(self):
+        self.started = time.monotonic()
+
+
+@contextmanager
+def limited(concurrency: AdaptiveConcurrency = None):
+    """
+    Hold a slot of concurrency for the request made inside the block, and report how it went.
+    Lease the key inside the block, so no key sits leased while the request waits for a slot.
+    Does nothing but yield a Slot when concurrency is None.
+    """
+    slot = Slot()
+    if concurrency is None:
+        yield slot
+        return
+    concurrency.acquire()
+    latency, congested = None, False
+    slot.start()
+    try:
+        yield slot
+        latency = time.monotonic() - slot.started
+    except Exception as e:
+        congested = classify_error(e)[0] in CONGESTION
+        raise
+    finally:
+        concurrency.release(latency, congested)
+
+
+@asynccontextmanager
+async def alimited(concurrency: AdaptiveConcurrency = None):
+    """
+    Async variant of limited.
+    """
+    slot = Slot()
+    if concurrency is None:
+        yield slot
+        return
+    await concurrency.aacquire()
+    latency, congested = None, False
+    slot.start()
+    try:
+        yield slot
+        latency = time.monotonic() - slot.started
+    except Exception as e:
+        congested = classify_error(e)[0] in CONGESTION
+        raise
+    finally:
+        concurrency.release(latency, congested)
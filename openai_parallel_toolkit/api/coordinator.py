@@ -0,0 +1,235 @@
+import argparse
+import asyncio
+import ipaddress
+import logging
+import secrets
+import threading
+from multiprocessing.connection import Client, Listener
+from typing import Optional
+
+from openai_parallel_toolkit.utils.logger import LOG_LABEL
+from .keys import KeyManager
+from .router import open_key_manager
+
+
+class KeyCoordinator:
+    """
+    Serves one KeyManager over a socket, so processes on this host or other hosts lease keys from a
+    single pool and see each other's rate-limited and removed keys. Each client connection gets a
+    thread, and blocking calls such as get_new_key block only that connection. Keys still leased
+    by a connection when it drops (a crashed worker) are released. Hedged requests may release a key
+    over a different connection from the one that leased it, so leases are tracked per key.
+    The connection unpickles what clients send, so the authkey is all that keeps anyone who can reach the
+    port from running code on this host and reading the keys: it is never a default, and a random one is
+    generated when none is given, which is only allowed on a loopback address.
+    """
+
+    def __init__(self, config_path: str, address=("127.0.0.1", 0), authkey: bytes = None,
+                 key_manager: KeyManager = None):
+        """
+        Args:
+            address (tuple): (host, port) to listen on. Port 0 picks a free port.
+            authkey (bytes): Secret the clients must know. Required unless host is a loopback address; a
+                random key is generated when it is None (see the authkey attribute).
+        """
+        if authkey is None:
+            if not is_loopback(address[0]):
+                raise ValueError(f"Listening on {address[0]} requires an explicit authkey")
+            authkey = secrets.token_hex(16).encode()
+        self.authkey = authkey
+        self.key_manager = key_manager or open_key_manager(config_path)
+        # Every worker thread connects at start-up: the default backlog of 1 would drop connections
+        self.listener = Listener(address, backlog=1024, authkey=authkey)
+        self.address = self.listener.address
+        self.thread = None
+        self.leases = {}  # key -> connection that leased it
+        self.leases_lock = threading.Lock()
+
+    def start(self):
+        """
+        Accept connections on a daemon thread and return immediately.
+        """
+        self.thread = threading.Thread(target=self.serve_forever, name="KeyCoordinator", daemon=True)
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        logging.warning(f"{LOG_LABEL}Key coordinator listening on {self.address}")
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                break  # Listener closed
+            except Exception as e:
+                logging.error(f"{LOG_LABEL}Rejected key coordinator connection: {e}")
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+
+    def _serve(self, conn):
+        try:
+            while True:
+                try:
+                    method, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    conn.send((True, self._dispatch(method, args, conn)))
+                except (EOFError, OSError):
+                    return
+                except Exception as e:
+                    conn.send((False, str(e)))
+        finally:
+            conn.close()
+            with self.leases_lock:
+                leased = [key for key, owner in self.leases.items() if owner is conn]
+                for key in leased:
+                    del self.leases[key]
+            for key in leased:
+                self.key_manager.release_key(key)
+
+    def _dispatch(self, method, args, conn):
+        if method == "api_base":
+            return self.key_manager.api_base
+        if method in ("get_key_length", "capacity", "set_pace", "preflight"):
+            return getattr(self.key_manager, method)(*args)
+        if method == "api_base_for":
+            return self.key_manager.api_base_for(args[0])
+        if method == "record_failure":
+            released = self.key_manager.record_failure(args[0])
+            if released:
+                self._end_lease(args[0])
+            return released
+        if method in ("get_new_key", "try_get_new_key"):
+            if method == "get_new_key" and args[0]:
+                self._end_lease(args[0])
+            new_key = getattr(self.key_manager, method)(*args)
+            if new_key:
+                with self.leases_lock:
+                    self.leases[new_key] = conn
+            return new_key
+        if method in ("release_key", "remove_key", "limit_key"):
+            self._end_lease(args[0])
+            return getattr(self.key_manager, method)(*args)
+        raise ValueError(f"Unknown method {method}")
+
+    def _end_lease(self, key):
+        with self.leases_lock:
+            self.leases.pop(key, None)
+
+
+class RemoteKeyManager:
+    """
+    KeyManager interface backed by a KeyCoordinator. Every thread uses its own connection. capacity,
+    set_pace and preflight act on the coordinator's whole pool, so the pace set by one client applies to all.
+    """
+
+    def __init__(self, address, authkey: bytes):
+        self.address = tuple(address)
+        self.authkey = authkey
+        self.local = threading.local()
+        self.conns = []  # Connections of all threads, for close
+        self.conns_lock = threading.Lock()
+        self.api_base = self._call("api_base")
+        self.api_bases = {}  # key -> api_base
+
+    def get_new_key(self, key=None, tokens: int = 0, retry_after: float = None, timeout: float = None) -> Optional[str]:
+        return self._call("get_new_key", key, tokens, retry_after, timeout)
+
+    async def aget_new_key(self, key=None, tokens: int = 0, retry_after: float = None,
+                           timeout: float = None) -> Optional[str]:
+        return await asyncio.get_running_loop().run_in_executor(None, self.get_new_key, key, tokens, retry_after,
+                                                                timeout)
+
+    def try_get_new_key(self, tokens: int = 0):
+        return self._call("try_get_new_key", tokens)
+
+    def release_key(self, key, tokens: int = None, latency: float = None):
+        return self._call("release_key", key, tokens, latency)
+
+    def limit_key(self, key, retry_after: float = None):
+        return self._call("limit_key", key, retry_after)
+
+    def record_failure(self, key) -> bool:
+        return self._call("record_failure", key)
+
+    def api_base_for(self, key) -> str:
+        # The endpoint of a key never changes, so ask the coordinator once per key
+        api_base = self.api_bases.get(key)
+        if api_base is None:
+            api_base = self.api_bases[key] = self._call("api_base_for", key)
+        return api_base
+
+    def remove_key(self, key, exhausted: bool = False):
+        self._call("remove_key", key, exhausted)
+        logging.warning(f"{LOG_LABEL}remove_key {key}")
+
+    def get_key_length(self):
+        return self._call("get_key_length")
+
+    def capacity(self) -> dict:
+        return self._call("capacity")
+
+    def set_pace(self, requests_per_second: float = None):
+        return self._call("set_pace", requests_per_second)
+
+    def preflight(self, threads: int = 32, model_name: str = None) -> dict:
+        return self._call("preflight", threads, model_name)
+
+    def close(self):
+        """
+        Close the connections of all threads. The coordinator releases the keys they still lease.
+        """
+        with self.conns_lock:
+            conns, self.conns = self.conns, []
+        for conn in conns:
+            conn.close()
+
+    def _call(self, method, *args):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = Client(self.address, authkey=self.authkey)
+            with self.conns_lock:
+                self.conns.append(conn)
+        conn.send((method, args))
+        ok, result = conn.recv()
+        if not ok:
+            raise Exception(result)
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a shared key pool to sharded ParallelToolkit runs.")
+    parser.add_argument("config_path")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6000)
+    parser.add_argument("--authkey", help="Secret shared with the workers. Required with a non-loopback --host; "
+                                           "a random one is generated and printed otherwise")
+    parser.add_argument("--ledger", help="SQLite file that keeps key health across runs")
+    parser.add_argument("--preflight", action="store_true", help="Check every key before serving")
+    args = parser.parse_args()
+    if not args.authkey and not is_loopback(args.host):
+        parser.error(f"--authkey is required to listen on {args.host}")
+    key_manager = open_key_manager(args.config_path, ledger_path=args.ledger)
+    if args.preflight:
+        key_manager.preflight()
+    coordinator = KeyCoordinator(args.config_path, address=(args.host, args.port),
+                                 authkey=args.authkey.encode() if args.authkey else None, key_manager=key_manager)
+    if not args.authkey:
+        print(f"authkey: {coordinator.authkey.decode()}", flush=True)
+    coordinator.serve_forever()
+
+
+def is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False  # A host name: it may resolve to any interface
+
+
+if __name__ == "__main__":
+    main()
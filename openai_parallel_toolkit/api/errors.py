@@ -0,0 +1,54 @@
+from typing import Optional, Tuple
+
+from openai import error
+
+# What a failed request means for the caller
+QUOTA = "quota"  # The key is used up or revoked: remove it
+DAILY_LIMIT = "daily_limit"  # The key hit its requests per day: remove it until its day is over
+RATE_LIMIT = "rate_limit"  # The key is temporarily limited: switch keys
+CONTEXT_LENGTH = "context_length"  # The prompt does not fit the model
+INVALID = "invalid"  # Retrying the same request cannot succeed
+TRANSIENT = "transient"  # Network or server trouble: back off and retry
+UNKNOWN = "unknown"
+
+
+def classify_error(e: Exception) -> Tuple[str, Optional[float]]:
+    """
+    Classify an exception raised by the OpenAI client by its type and HTTP status, falling back to
+    the messages of the $5 account limits for proxies that rewrite errors.
+    Returns (kind, retry_after), where retry_after comes from the Retry-After header if present.
+    """
+    message = str(e)
+    retry_after = _retry_after(e)
+    if " / day" in message:
+        return DAILY_LIMIT, retry_after
+    if "exceeded your current quota" in message or "<empty message>" in message:
+        return QUOTA, retry_after
+    if isinstance(e, (error.AuthenticationError, error.PermissionError)):
+        return QUOTA, retry_after
+    if "maximum context length" in message or getattr(e, "code", None) == "context_length_exceeded":
+        return CONTEXT_LENGTH, retry_after
+    if isinstance(e, error.RateLimitError) or " / min" in message:
+        return RATE_LIMIT, retry_after
+    if isinstance(e, (error.APIConnectionError, error.Timeout, error.ServiceUnavailableError, error.TryAgain)):
+        return TRANSIENT, retry_after
+    status = getattr(e, "http_status", None)
+    if status == 429:
+        return RATE_LIMIT, retry_after
+    if status and status >= 500:
+        return TRANSIENT, retry_after
+    if isinstance(e, error.InvalidRequestError) or (status and 400 <= status < 500):
+        return INVALID, retry_after
+    if "Max retries exceeded with url" in message or "overloaded" in message:
+        return TRANSIENT, retry_after
+    return UNKNOWN, retry_after
+
+
+def _retry_after(e: Exception) -> Optional[float]:
+    headers = getattr(e, "headers", None) or {}
+    try:
+        value = headers.get("retry-after") or headers.get("Retry-After")
+        return float(value) if value is not None else None
+    except (TypeError, ValueError, AttributeError):
+        # HTTP-date values are rare on this API; fall back to the backoff schedule
+        return None
@@ -0,0 +1,188 @@
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Optional
+
+from openai_parallel_toolkit.utils.metrics import HEDGES
+from .errors import DAILY_LIMIT, QUOTA, RATE_LIMIT, TRANSIENT, classify_error
+from .model import OpenAIModel, Prompt
+
+
+class HedgePolicy:
+    """
+    Hedged requests: once a request has taken longer than a percentile of recent latencies, the same
+    request is sent again on a spare key, and whichever answers first is used. Spare keys are only
+    taken when they are within their budgets right now, and the duplicate is charged to them like any
+    other request, so hedging never causes rate limits; it only uses capacity that would sit idle.
+    """
+
+    def __init__(self, quantile: float = 0.95, window: int = 500, min_samples: int = 20, min_delay: float = 1.0,
+                 max_workers: int = 1024):
+        """
+        Args:
+            quantile (float): Percentile of recent latencies after which a request is hedged.
+            window (int): Number of recent latencies the percentile is computed from.
+            min_samples (int): Latencies needed before any request is hedged.
+            min_delay (float): Shortest time to wait before hedging, whatever the percentile.
+            max_workers (int): Most threads the thread engines use to run hedged calls.
+        """
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_workers = max_workers
+        self.latencies = deque(maxlen=window)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float):
+        self.latencies.append(seconds)
+
+    def delay(self) -> Optional[float]:
+        """
+        Seconds after which a request is hedged, or None while there are too few latencies.
+        """
+        samples = sorted(self.latencies)
+        if len(samples) < self.min_samples:
+            return None
+        return max(self.min_delay, samples[min(len(samples) - 1, int(len(samples) * self.quantile))])
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        # Threads are started as needed, so the pool grows to the number of requests in flight
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="hedge")
+            return self.executor
+
+    def __getstate__(self):
+        return {"quantile": self.quantile, "window": self.latencies.maxlen, "min_samples": self.min_samples,
+                "min_delay": self.min_delay, "max_workers": self.max_workers}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+def _usage(completion) -> Optional[int]:
+    return completion.get('usage', {}).get('total_tokens')
+
+
+def _release_failed(key_manager, key, e: Exception):
+    """
+    Give back a spare or losing key whose call failed, treating it as request_openai_api treats a failed key:
+    removed when used up, held back when rate limited, and counted against its endpoint on network trouble.
+    """
+    kind, retry_after = classify_error(e)
+    if kind in (QUOTA, DAILY_LIMIT):
+        key_manager.remove_key(key, exhausted=kind == DAILY_LIMIT)
+    elif kind == RATE_LIMIT:
+        key_manager.limit_key(key, retry_after)
+    elif not (kind == TRANSIENT and key_manager.record_failure(key)):
+        key_manager.release_key(key)
+
+
+def _release_when_done(key_manager, key, future):
+    """
+    Release the key of a request that lost the race once it finishes.
+    """
+    def done(future):
+        if future.cancelled():
+            key_manager.release_key(key)
+        elif future.exception() is not None:
+            _release_failed(key_manager, key, future.exception())
+        else:
+            key_manager.release_key(key, tokens=_usage(future.result()))
+    future.add_done_callback(done)
+
+
+def generate_hedged(hedge: HedgePolicy, openai_model: OpenAIModel, prompt: Prompt, model_name: str, key: str,
+                    key_manager, tokens: int):
+    """
+    Call generate with key, and once the call takes longer than hedge.delay(), send it again on a spare
+    key if one is within its budgets.
+    Returns:
+        tuple: (completion, key that produced it). The caller releases that key; the other one is released
+            when its request finishes. If both fail, the error of the first call is raised and key is
+            still leased.
+    """
+    def call(api_key):
+        return openai_model.generate(instruction=prompt.instruction, input=prompt.input, model_name=model_name,
+                                     api_key=api_key, api_base=key_manager.api_base_for(api_key))
+
+    delay = hedge.delay()
+    if delay is None:
+        return call(key), key
+    executor = hedge.get_executor()
+    primary = executor.submit(call, key)
+    try:
+        return primary.result(timeout=delay), key
+    except FutureTimeoutError:
+        pass
+    spare = key_manager.try_get_new_key(tokens=tokens)
+    if spare is None:
+        return primary.result(), key
+    HEDGES.inc(label="sent")
+    secondary = executor.submit(call, spare)
+    done, _ = wait([primary, secondary], return_when=FIRST_COMPLETED)
+    first = primary if primary in done else secondary
+    second = secondary if first is primary else primary
+    if first.exception() is not None:
+        wait([second])
+        if second.exception() is not None:
+            _release_failed(key_manager, spare, secondary.exception())
+            raise primary.exception()
+        first, second = second, first
+    if first is secondary:
+        HEDGES.inc(label="won")
+        _release_when_done(key_manager, key, primary)
+        return secondary.result(), spare
+    _release_when_done(key_manager, spare, secondary)
+    return primary.result(), key
+
+
+async def agenerate_hedged(hedge: HedgePolicy, openai_model: OpenAIModel, prompt: Prompt, model_name: str, key: str,
+                           key_manager, tokens: int):
+    """
+    Async variant of generate_hedged. The request that loses the race is cancelled.
+    """
+    def call(api_key):
+        return openai_model.agenerate(instruction=prompt.instruction, input=prompt.input, model_name=model_name,
+                                      api_key=api_key, api_base=key_manager.api_base_for(api_key))
+
+    delay = hedge.delay()
+    if delay is None:
+        return await call(key), key
+    primary = asyncio.ensure_future(call(key))
+    spare = secondary = None
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result(), key
+        spare = key_manager.try_get_new_key(tokens=tokens)
+        if spare is None:
+            return await primary, key
+        HEDGES.inc(label="sent")
+        secondary = asyncio.ensure_future(call(spare))
+        done, _ = await asyncio.wait({primary, secondary}, return_when=asyncio.FIRST_COMPLETED)
+        first = primary if primary in done else secondary
+        second = secondary if first is primary else primary
+        if first.exception() is not None:
+            await asyncio.wait({second})
+            if second.exception() is not None:
+                _release_failed(key_manager, spare, secondary.exception())
+                raise primary.exception()
+            first, second = second, first
+        second.cancel()
+        if first is secondary:
+            HEDGES.inc(label="won")
+            key_manager.release_key(key)
+            return secondary.result(), spare
+        key_manager.release_key(spare)
+        return primary.result(), key
+    except asyncio.CancelledError:
+        # The caller releases key; the spare key and both calls are dropped here
+        primary.cancel()
+        if secondary is not None:
+            secondary.cancel()
+            key_manager.release_key(spare)
+        raise
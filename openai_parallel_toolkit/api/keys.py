@@ -1,100 +1,458 @@
+import heapq
+import itertools
 import logging
-import random
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 import openai
-from cachetools import TTLCache
 
+from openai_parallel_toolkit.utils.ledger import KeyLedger
 from openai_parallel_toolkit.utils.logger import LOG_LABEL
-from openai_parallel_toolkit.utils.reader import read_config
+from openai_parallel_toolkit.utils.metrics import KEY_WAIT_SECONDS, METRICS
+from openai_parallel_toolkit.utils.reader import read_config, read_rate_limits
+from openai_parallel_toolkit.utils.trace import TRACER
+from .concurrency import AsyncWaiters
+from .errors import DAILY_LIMIT, QUOTA, RATE_LIMIT, classify_error
+
+DAY = 24 * 60 * 60
+
+
+class KeyBudget:
+    """
+    Rate budgets of a single key: token buckets for requests and tokens per minute,
+    and a request counter for the current day.
+    """
+    __slots__ = ("requests", "tokens", "updated", "day_start", "day_count", "blocked_until", "reserved", "entry")
+
+    def __init__(self, rpm, tpm, now):
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated = now
+        self.day_start = now
+        self.day_count = 0
+        self.blocked_until = 0.0
+        self.reserved = 0  # Tokens reserved by the current lease
+        self.entry = None  # Sequence number of the live heap entry
+
+    def refill(self, now, rpm, tpm):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.requests = min(rpm, self.requests + elapsed * rpm / 60)
+            self.tokens = min(tpm, self.tokens + elapsed * tpm / 60)
+            self.updated = now
+        if now - self.day_start >= DAY:
+            self.day_start = now
+            self.day_count = 0
+
+    def ready_at(self, now, tokens, rpm, tpm, rpd):
+        """
+        The earliest time this key can send a request of the given size.
+        """
+        ready = max(now, self.blocked_until)
+        if self.requests < 1:
+            ready = max(ready, now + (1 - self.requests) * 60 / rpm)
+        if self.tokens < tokens:
+            ready = max(ready, now + (tokens - self.tokens) * 60 / tpm)
+        if self.day_count >= rpd:
+            ready = max(ready, self.day_start + DAY)
+        return ready
+
+
+def expired(deadline: Optional[float]) -> bool:
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def bounded(delay: Optional[float], deadline: Optional[float]) -> Optional[float]:
+    """
+    A wait of delay seconds (None for no limit), cut short at the monotonic deadline if there is one.
+    """
+    if deadline is None:
+        return delay
+    left = max(0.0, deadline - time.monotonic())
+    return left if delay is None else min(delay, left)
 
 
 class KeyManager:
 
-    def __init__(self, config_path: str = None):
+    def __init__(self, config_path: str = None, rpm: int = None, tpm: int = None, rpd: int = None,
+                 ledger_path: str = None, api_keys: list = None, api_base: str = None, ledger: KeyLedger = None):
         """
         Initialize the instance.
+        Args:
+            config_path (str): Path of config.json.
+            rpm (int): Requests per minute allowed for each key. Overrides config.json.
+            tpm (int): Tokens per minute allowed for each key. Overrides config.json.
+            rpd (int): Requests per day allowed for each key. Overrides config.json.
+            ledger_path (str): SQLite file that keeps key health across runs (see KeyLedger). Revoked keys
+                are skipped and daily counts, exhausted keys and recent rate limits are restored.
+            api_keys (list): Keys to use instead of those in config_path, with api_base.
+            api_base (str): Endpoint of api_keys.
+            ledger (KeyLedger): Ledger shared with other key managers, instead of ledger_path.
         """
-        if not config_path:
-            raise Exception("No OpenAI keys available")
-
-        api_keys, api_base = read_config(config_path)
-        openai.api_base = api_base
+        if api_keys is None:
+            if not config_path:
+                raise Exception("No OpenAI keys available")
+            api_keys, api_base = read_config(config_path)
+        limits = read_rate_limits(config_path)
+        self.api_base = api_base  # Passed with every request rather than set on the openai module
+        self.rpm = rpm or limits["rpm"]
+        self.tpm = tpm or limits["tpm"]
+        self.rpd = rpd or limits["rpd"]
         self.keys = set(api_keys)  # All keys
-        self.using_keys = set()  # Keys that have been used
-        self.limited_keys = TTLCache(maxsize=len(self.keys),
-                                     ttl=30)  # Keys that have reached the request limit
-        self.using_keys_lock = threading.Lock()  # Lock for keys and using_keys
-        # self.limited_keys_lock = threading.Lock()  # Separate using_keys_lock for limited_keys
+        self.using_keys = set()  # Keys that are leased to a request
+        now = time.time()
+        self.budgets = {key: KeyBudget(self.rpm, self.tpm, now) for key in self.keys}
+        self.ready_heap = []  # (ready_at, seq, key) for keys that are not leased
+        self.seq = itertools.count()
+        self.using_keys_lock = threading.Lock()  # Lock for keys, using_keys and budgets
+        self.key_released = threading.Condition(self.using_keys_lock)
+        self.async_waiters = AsyncWaiters()  # Coroutines waiting in aget_new_key, woken with key_released
+        self.pace_interval = 0.0  # Least seconds between two leases, 0 without pacing (see set_pace)
+        self.next_lease = 0.0
+        self.ledger = ledger or (KeyLedger(ledger_path) if ledger_path else None)
+        if self.ledger:
+            self._load_ledger(now)
+        for key in self.keys:
+            self._push(key, now)
+        METRICS.gauge("openai_keys_total", "Keys that have not been removed", lambda: len(self.keys))
+        METRICS.gauge("openai_keys_in_use", "Keys leased to a request", lambda: len(self.using_keys))
+        METRICS.gauge("openai_keys_limited", "Idle keys waiting for their rate budgets", self.get_limited_length)
 
-    def get_new_key(self, key=None) -> str:
+    def get_new_key(self, key=None, tokens: int = 0, retry_after: float = None, timeout: float = None) -> Optional[str]:
         """
-        Get a new key. The key is one that is in keys but not in using_keys or limited_keys.
+        Lease the key that will be ready soonest, blocking until it is within its budgets.
+        Passing the previous key marks it as rate limited, for retry_after seconds if given.
+        Returns None when no key is ready within timeout seconds (None to wait as long as it takes).
         """
-        min_ttl = None
-        min_key = None
-        with self.using_keys_lock:
-            logging.info(f"{LOG_LABEL} {key} get lock ")
-            self.limited_keys.expire()
-            unused_keys = self.keys - self.using_keys - set(self.limited_keys.keys())
-            logging.info(f"{LOG_LABEL}unused_keys {len(unused_keys)}")
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        if key:
+            logging.info(f"{LOG_LABEL}limited key {key}")
+        with self.key_released:
             if key:
-                logging.info(f"{LOG_LABEL}locked {key}")
-                self.limited_keys[key] = time.time()
-                self.using_keys.discard(key)
-            if unused_keys:
-                logging.info(f"{LOG_LABEL} limited_keys {len(self.limited_keys.keys())}")
-                new_key = random.choice(list(unused_keys))
-                self.using_keys.add(new_key)
+                self._limit(key, retry_after)
+            while True:
+                new_key, delay = self._acquire(tokens)
+                if new_key or expired(deadline):
+                    break
+                self.key_released.wait(bounded(delay, deadline))
+        end = time.monotonic()
+        KEY_WAIT_SECONDS.observe(end - start)
+        TRACER.add("key_wait", start, end)
+        return new_key
+
+    async def aget_new_key(self, key=None, tokens: int = 0, retry_after: float = None,
+                           timeout: float = None) -> Optional[str]:
+        """
+        Async variant of get_new_key: waits on a future that releases resolve, so the event loop keeps
+        running and waiting coroutines do not poll.
+        """
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        if key:
+            logging.info(f"{LOG_LABEL}limited key {key}")
+        while True:
+            with self.using_keys_lock:
+                if key:
+                    self._limit(key, retry_after)
+                    key = None
+                new_key, delay = self._acquire(tokens)
+                waiter = None if new_key or expired(deadline) else self.async_waiters.add()
+            if waiter is None:
+                end = time.monotonic()
+                KEY_WAIT_SECONDS.observe(end - start)
+                TRACER.add("key_wait", start, end, track=TRACER.task_track())
                 return new_key
-            else:
-                logging.info(f"{LOG_LABEL}keys {len(self.keys)}")
-                logging.info(f"{LOG_LABEL}using_keys {len(self.using_keys)}")
-                logging.info(f"{LOG_LABEL}limited_keys {len(self.limited_keys.keys())}")
-                if len(self.keys) == 0:
-                    raise Exception("No OpenAI keys available,All keys have expired")
-                else:
-                    min_key, min_ttl = self.get_min_ttl_key()
-                    if min_ttl:
-                        logging.info(f"{LOG_LABEL}min_ttl {min_ttl}, min_key {min_key}")
-                        self.limited_keys.pop(min_key)
-                        self.using_keys.add(min_key)
-            logging.info(f"{LOG_LABEL} {key}  leave lock ")
+            await self.async_waiters.wait(waiter, bounded(delay, deadline), self.using_keys_lock)
 
-        if min_ttl:
-            time.sleep(min_ttl)
-            return min_key
-        else:
-            time.sleep(random.randint(1, 5))
-            return self.get_new_key()
+    def try_get_new_key(self, tokens: int = 0):
+        """
+        Lease a key only if one is within its budgets right now, otherwise return None without waiting.
+        Used for hedged requests, which should only use idle capacity.
+        """
+        try:
+            return self.poll_key(tokens)[0]
+        except Exception:
+            return None  # No keys left, which the request itself will report
 
-    def release_key(self, key):
+    def poll_key(self, tokens: int = 0):
         """
-        Release a key. The key is removed from using_keys.
+        Lease the soonest ready key if it is within its budgets right now.
+        Returns:
+            tuple: (key, None) on success, otherwise (None, delay) where delay is how long to wait before
+                trying again, or None when every key is leased.
         """
-        self.using_keys.discard(key)
+        with self.using_keys_lock:
+            return self._acquire(tokens)
 
-    def remove_key(self, key):
+    def limit_key(self, key, retry_after: float = None):
+        """
+        Release a key that hit a rate limit, holding it back until its minute budgets refill, or for
+        retry_after seconds if given.
+        """
+        logging.info(f"{LOG_LABEL}limited key {key}")
+        with self.key_released:
+            self._limit(key, retry_after)
+
+    def record_failure(self, key) -> bool:
+        """
+        Report a network or server error on a request sent with key.
+        Returns:
+            bool: True when the key was released and the request should lease another one instead of
+                backing off. A single endpoint has nowhere else to go; see EndpointRouter.
+        """
+        return False
+
+    def api_base_for(self, key) -> str:
+        """
+        The endpoint to send requests made with key to.
+        """
+        return self.api_base
+
+    def release_key(self, key, tokens: int = None, latency: float = None):
+        """
+        Release a key. The key is removed from using_keys and queued by the time it is ready again.
+        Args:
+            tokens (int): Tokens the request actually used, charged against the key's TPM budget.
+            latency (float): Seconds a successful request took. Only used to route between endpoints.
+        """
+        with self.key_released:
+            if key not in self.using_keys:
+                return
+            self.using_keys.discard(key)
+            budget = self.budgets.get(key)
+            if budget is None:
+                return
+            if tokens is not None:
+                budget.tokens -= tokens - budget.reserved
+            budget.reserved = 0
+            now = time.time()
+            budget.refill(now, self.rpm, self.tpm)
+            self._push(key, budget.ready_at(now, 0, self.rpm, self.tpm, self.rpd))
+            self.key_released.notify()
+            self.async_waiters.wake()
+
+    def remove_key(self, key, exhausted: bool = False):
         """
         Remove a key. The key is removed from keys.
+        Args:
+            exhausted (bool): The key hit its daily limit rather than being revoked or out of quota. The
+                ledger then only skips it until its day is over.
         """
-        with self.using_keys_lock:
+        with self.key_released:
             self.keys.discard(key)
             self.using_keys.discard(key)
-            self.limited_keys.pop(key)
+            budget = self.budgets.pop(key, None)
+            if self.ledger:
+                if exhausted:
+                    now = time.time()
+                    day_start = budget.day_start if budget and budget.day_count else now
+                    self.ledger.update(key, exhausted_until=max(day_start + DAY, now + 60))
+                else:
+                    self.ledger.update(key, revoked=1)
+            self.key_released.notify_all()
+            self.async_waiters.wake_all()
         logging.warning(f"{LOG_LABEL}remove_key {key}")
 
+    def preflight(self, threads: int = 32, model_name: str = None) -> dict:
+        """
+        Check every key concurrently before a run, removing revoked keys and holding back rate limited ones.
+        Lists the models by default, which catches invalid and revoked keys for free. With model_name, a
+        1-token completion is sent instead, which also catches keys without quota or past their daily limit
+        but costs one request per key.
+        Returns:
+            dict: Number of keys by outcome: ok, removed, limited or error.
+        """
+        def check(key):
+            try:
+                if model_name:
+                    openai.ChatCompletion.create(model=model_name, messages=[{"role": "user", "content": "hi"}],
+                                                 max_tokens=1, api_key=key, api_base=self.api_base)
+                    with self.using_keys_lock:
+                        budget = self.budgets.get(key)
+                        if budget:
+                            budget.requests -= 1
+                            budget.day_count += 1
+                            self._record(key, budget)
+                else:
+                    openai.Model.list(api_key=key, api_base=self.api_base)
+                return "ok"
+            except Exception as e:
+                kind, retry_after = classify_error(e)
+                if kind in (QUOTA, DAILY_LIMIT):
+                    self.remove_key(key, exhausted=kind == DAILY_LIMIT)
+                    return "removed"
+                if kind == RATE_LIMIT:
+                    with self.key_released:
+                        if key in self.budgets:
+                            self._limit(key, retry_after)
+                    return "limited"
+                logging.info(f"{LOG_LABEL}Preflight check of key {key} failed: {e}")
+                return "error"
+
+        with self.using_keys_lock:
+            keys = list(self.keys)
+        counts = {"ok": 0, "removed": 0, "limited": 0, "error": 0}
+        with ThreadPoolExecutor(max_workers=max(1, min(threads, len(keys)))) as executor:
+            for outcome in executor.map(check, keys):
+                counts[outcome] += 1
+        logging.warning(f"{LOG_LABEL}Preflight checked {len(keys)} keys: {counts}")
+        return counts
+
+    def capacity(self) -> dict:
+        """
+        What the remaining keys can still send, for CapacityPlanner.
+        Returns:
+            dict: keys, the combined rpm and tpm of the keys, quota (requests left today across all keys)
+                and reset_in (seconds until the first key that has sent requests today starts a new day,
+                or None).
+        """
+        with self.using_keys_lock:
+            now = time.time()
+            quota = 0
+            reset_in = None
+            for budget in self.budgets.values():
+                budget.refill(now, self.rpm, self.tpm)
+                quota += max(0, self.rpd - budget.day_count)
+                if budget.day_count:
+                    remaining = budget.day_start + DAY - now
+                    reset_in = remaining if reset_in is None else min(reset_in, remaining)
+            keys = len(self.keys)
+        return {"keys": keys, "rpm": keys * self.rpm, "tpm": keys * self.tpm, "quota": quota, "reset_in": reset_in}
+
+    def set_pace(self, requests_per_second: float = None):
+        """
+        Lease keys at most requests_per_second times per second across the pool, evenly spaced, so requests
+        go out at a steady rate instead of in bursts whenever the minute buckets refill. None turns pacing off.
+        """
+        with self.key_released:
+            self.pace_interval = 1 / requests_per_second if requests_per_second else 0.0
+            self.next_lease = 0.0
+            self.key_released.notify_all()
+            self.async_waiters.wake_all()
+
+    def close(self):
+        """
+        Write the ledger to disk.
+        """
+        if self.ledger:
+            self.ledger.close()
+
     def get_key_length(self):
         return len(self.keys)
 
-    def get_min_ttl_key(self):
-        if not self.limited_keys:
-            return None, None
+    def get_limited_length(self):
+        """
+        Number of idle keys that cannot send a request right now.
+        """
+        with self.using_keys_lock:
+            now = time.time()
+            return sum(1 for key, budget in self.budgets.items() if key not in self.using_keys
+                       and budget.ready_at(now, 0, self.rpm, self.tpm, self.rpd) > now)
+
+    def _acquire(self, tokens=0):
+        """
+        Lease the soonest ready key if it is ready now. Must be called with using_keys_lock held.
+        Returns (key, None) on success, otherwise (None, delay) where delay is how long to wait
+        before trying again, or None when every key is leased.
+        """
+        if not self.keys:
+            raise Exception("No OpenAI keys available,All keys have expired")
+        tokens = min(tokens, self.tpm)
         now = time.time()
-        # Get the remaining TTL for each key and put them in a list
-        valid_keys = [(self.limited_keys[key] + self.limited_keys.ttl - now, key)
-                      for key in self.limited_keys if self.limited_keys[key] + self.limited_keys.ttl - now > 0]
+        if now < self.next_lease:
+            return None, self.next_lease - now
+        while self.ready_heap:
+            ready_at, seq, key = self.ready_heap[0]
+            budget = self.budgets.get(key)
+            if budget is None or budget.entry != seq:
+                heapq.heappop(self.ready_heap)  # Stale entry of a removed or re-queued key
+                continue
+            budget.refill(now, self.rpm, self.tpm)
+            actual = budget.ready_at(now, tokens, self.rpm, self.tpm, self.rpd)
+            if actual > ready_at:
+                # Heap entries assume an empty request; re-queue with the real readiness
+                heapq.heappop(self.ready_heap)
+                self._push(key, actual)
+                continue
+            if actual > now:
+                if actual - now > 60 and all(b.day_count >= self.rpd for b in self.budgets.values()):
+                    raise Exception("No OpenAI keys available,All keys have used up their daily quota")
+                return None, actual - now
+            heapq.heappop(self.ready_heap)
+            budget.entry = None
+            budget.requests -= 1
+            budget.tokens -= tokens
+            budget.reserved = tokens
+            budget.day_count += 1
+            self.using_keys.add(key)
+            self._record(key, budget)
+            if self.pace_interval:
+                # Idle time is not saved up, so the pace never allows a burst
+                self.next_lease = max(self.next_lease, now) + self.pace_interval
+            return key, None
+        return None, None
+
+    def _limit(self, key, retry_after: float = None):
+        """
+        Handle a rate limit error the budgets did not predict: drain the key's minute buckets
+        and release it.
+        """
+        budget = self.budgets.get(key)
+        self.using_keys.discard(key)
+        if budget is None:
+            return
+        now = time.time()
+        budget.refill(now, self.rpm, self.tpm)
+        budget.requests = min(budget.requests, 0)
+        budget.tokens = min(budget.tokens, 0)
+        budget.reserved = 0
+        if retry_after:
+            budget.blocked_until = now + retry_after
+        if self.ledger:
+            self.ledger.update(key, limited_at=now)
+        self._push(key, budget.ready_at(now, 0, self.rpm, self.tpm, self.rpd))
+        self.key_released.notify()
+        self.async_waiters.wake()
+
+    def _load_ledger(self, now):
+        """
+        Apply the state of the previous runs to the budgets.
+        """
+        revoked = exhausted = 0
+        for key in list(self.keys):
+            state = self.ledger.get(key)
+            if not state:
+                continue
+            budget = self.budgets[key]
+            if state["revoked"]:
+                self.keys.discard(key)
+                del self.budgets[key]
+                revoked += 1
+                continue
+            if state["exhausted_until"] > now:
+                # Restore as a full day, so the key waits until exhausted_until
+                budget.day_start = state["exhausted_until"] - DAY
+                budget.day_count = self.rpd
+                exhausted += 1
+            elif now - state["day_start"] < DAY:
+                budget.day_start = state["day_start"]
+                budget.day_count = state["day_count"]
+            if now - state["limited_at"] < 60:
+                # Rate limited moments ago: start from an empty minute bucket
+                budget.requests = 0
+                budget.updated = state["limited_at"]
+        if revoked or exhausted:
+            logging.warning(f"{LOG_LABEL}Key ledger: skipping {revoked} revoked keys, "
+                            f"{exhausted} keys are waiting for their daily limit to reset")
+
+    def _record(self, key, budget: KeyBudget):
+        if self.ledger:
+            self.ledger.update(key, day_start=budget.day_start, day_count=budget.day_count)
 
-        min_ttl_key = min(valid_keys)
-        return min_ttl_key[1], min_ttl_key[0],
+    def _push(self, key, ready_at):
+        seq = next(self.seq)
+        self.budgets[key].entry = seq
+        heapq.heappush(self.ready_heap, (ready_at, seq, key))
@@ -1,45 +1,261 @@
+import time
 from collections import namedtuple
+from typing import AsyncIterator, Callable, Iterator
 
 import openai
 
+from openai_parallel_toolkit.utils.metrics import TIME_TO_FIRST_TOKEN, key_label
+from openai_parallel_toolkit.utils.trace import TRACER
+from .tokens import CONTEXT_WINDOWS, TokenCounter
+
 Prompt = namedtuple("Prompt", ["instruction", "input"])
 
 
 class OpenAIModel:
-    def __init__(self, model_name="gpt-3.5-turbo-0613", api_key=None, **kwargs):
+    def __init__(self, model_name="gpt-3.5-turbo-0613", api_key=None, fallback_models=None, token_counter=None,
+                 request_timeout=None, stream: bool = False, max_output_chars: int = None,
+                 stop_when: Callable[[str], bool] = None, **kwargs):
         """
         Initialize an OpenAIModel instance.
         Args:
             model_name (str): Name of the OpenAI model.
             api_key (str): OpenAI API key.
+            fallback_models (list): Models with larger context windows, smallest first. Prompts that do not
+                fit model_name are sent to the first one that fits, and a "maximum context length" error
+                moves the prompt to the next one within the same run.
+            token_counter (TokenCounter): Counts prompt tokens, tiktoken when available.
+            request_timeout (float or tuple): Seconds to wait for a response, or (connect, read) timeouts.
+                The openai library waits up to 600 seconds by default.
+            stream (bool): Have generate and agenerate stream the completion and assemble it, so the
+                length cap and stop condition below can end a generation early and free its key.
+            max_output_chars (int): Stop a streamed completion once it is this many characters long.
+            stop_when (callable): Called with the text streamed so far after each token; returning True
+                stops the stream.
         """
         self.model_name = model_name
         self.api_key = api_key
+        self.fallback_models = list(fallback_models or [])
+        self.token_counter = token_counter or TokenCounter()
+        self.request_timeout = request_timeout
+        self.stream = stream
+        self.max_output_chars = max_output_chars
+        self.stop_when = stop_when
         self.kwargs = kwargs
 
-    def generate(self, instruction, input):
+    def count_tokens(self, prompt) -> int:
+        """
+        Tokens a request for the prompt is expected to use: the prompt plus max_tokens when it is set.
+        """
+        return self.token_counter.count_messages(prompt.instruction, prompt.input) + self.kwargs.get("max_tokens", 0)
+
+    def select_model(self, tokens: int) -> str:
+        """
+        The smallest model whose context window fits the request, or the largest one if none does.
+        """
+        models = [self.model_name] + self.fallback_models
+        for model in models:
+            if tokens <= CONTEXT_WINDOWS.get(model, float("inf")):
+                return model
+        return models[-1]
+
+    def next_model(self, model: str):
+        """
+        The model to retry with after a context length error, or None when there is no larger one.
+        """
+        models = [self.model_name] + self.fallback_models
+        index = models.index(model) if model in models else len(models)
+        return models[index + 1] if index + 1 < len(models) else None
+
+    def generate(self, instruction, input, model_name=None, api_key=None, api_base=None):
         """
         Generate a completion using the OpenAI API.
         Args:
             input (str): User input to be processed by the model.
             instruction (str): System message that guides the conversation.
+            model_name (str): Model for this request, model_name of the instance by default.
+            api_key (str): Key for this request. Worker threads share the model, so the key is passed
+                per call instead of through set_key.
+            api_base (str): Base URL for this request, openai.api_base by default.
         Returns:
-            dict: Response from the OpenAI API.
+            dict: Response from the OpenAI API, or one assembled from the streamed tokens when stream is set.
         """
+        if self.stream:
+            text = "".join(self.generate_stream(instruction, input, model_name=model_name, api_key=api_key,
+                                                api_base=api_base))
+            return self._assembled(instruction, input, text)
         # Create a chat completion with OpenAI
         completion = openai.ChatCompletion.create(
-                model=self.model_name,
+                model=model_name or self.model_name,
                 messages=[
                     {"role": "system", "content": instruction},
                     {"role": "user", "content": input}
                 ],
-                api_key=self.api_key,
+                api_key=api_key or self.api_key,
+                api_base=api_base,
+                request_timeout=self.request_timeout,
                 **self.kwargs,
         )
         return completion
 
+    async def agenerate(self, instruction, input, api_key=None, model_name=None, api_base=None):
+        """
+        Async variant of generate, backed by openai.ChatCompletion.acreate.
+        Args:
+            input (str): User input to be processed by the model.
+            instruction (str): System message that guides the conversation.
+            api_key (str): Key for this request. Coroutines share the model, so the key is passed
+                per call instead of through set_key.
+            model_name (str): Model for this request, model_name of the instance by default.
+            api_base (str): Base URL for this request, openai.api_base by default.
+        Returns:
+            dict: Response from the OpenAI API, or one assembled from the streamed tokens when stream is set.
+        """
+        if self.stream:
+            parts = []
+            async for token in self.agenerate_stream(instruction, input, api_key=api_key, model_name=model_name,
+                                                     api_base=api_base):
+                parts.append(token)
+            return self._assembled(instruction, input, "".join(parts))
+        completion = await openai.ChatCompletion.acreate(
+                model=model_name or self.model_name,
+                messages=[
+                    {"role": "system", "content": instruction},
+                    {"role": "user", "content": input}
+                ],
+                api_key=api_key or self.api_key,
+                api_base=api_base,
+                request_timeout=self.request_timeout,
+                **self.kwargs,
+        )
+        return completion
+
+    def generate_stream(self, instruction, input, model_name=None, api_key=None, api_base=None) -> Iterator[str]:
+        """
+        Stream a completion, yielding its content as it arrives. The time to the first token is recorded
+        per key. The stream is cancelled once max_output_chars or stop_when says so, or when the caller
+        closes the generator, which closes the HTTP response and ends the generation. A stream that ends
+        without a finish_reason, including one with no chunks at all, was cut short and raises
+        APIConnectionError.
+        Args: as for generate.
+        """
+        started = time.monotonic()
+        chunks = openai.ChatCompletion.create(
+                model=model_name or self.model_name,
+                messages=[
+                    {"role": "system", "content": instruction},
+                    {"role": "user", "content": input}
+                ],
+                api_key=api_key or self.api_key,
+                api_base=api_base,
+                request_timeout=self.request_timeout,
+                stream=True,
+                **self.kwargs,
+        )
+        text = ""
+        finish_reason = None
+        try:
+            for chunk in chunks:
+                finish_reason = _finish_reason(chunk) or finish_reason
+                token = _delta(chunk)
+                if not token:
+                    continue
+                if not text:
+                    self._record_first_token(api_key or self.api_key, started)
+                text += token
+                yield token
+                if self._should_stop(text):
+                    return
+            _check_finished(finish_reason)
+        finally:
+            # Closes the HTTP response, and with it the connection, instead of reading it to the end
+            close = getattr(chunks, "close", None)
+            if close:
+                close()
+
+    async def agenerate_stream(self, instruction, input, api_key=None, model_name=None,
+                               api_base=None) -> AsyncIterator[str]:
+        """
+        Async variant of generate_stream. Breaking out of `async for` and closing the generator
+        (or cancelling the task) closes the response.
+        """
+        started = time.monotonic()
+        chunks = await openai.ChatCompletion.acreate(
+                model=model_name or self.model_name,
+                messages=[
+                    {"role": "system", "content": instruction},
+                    {"role": "user", "content": input}
+                ],
+                api_key=api_key or self.api_key,
+                api_base=api_base,
+                request_timeout=self.request_timeout,
+                stream=True,
+                **self.kwargs,
+        )
+        text = ""
+        finish_reason = None
+        try:
+            async for chunk in chunks:
+                finish_reason = _finish_reason(chunk) or finish_reason
+                token = _delta(chunk)
+                if not token:
+                    continue
+                if not text:
+                    self._record_first_token(api_key or self.api_key, started, track=TRACER.task_track())
+                text += token
+                yield token
+                if self._should_stop(text):
+                    return
+            _check_finished(finish_reason)
+        finally:
+            await chunks.aclose()
+
     def set_key(self, key):
         """
-        Set the OpenAI API key.
+        Set the OpenAI API key used when no key is passed per call.
         """
         self.api_key = key
+
+    def _should_stop(self, text: str) -> bool:
+        if self.max_output_chars is not None and len(text) >= self.max_output_chars:
+            return True
+        return bool(self.stop_when and self.stop_when(text))
+
+    def _assembled(self, instruction: str, input: str, text: str) -> dict:
+        """
+        A ChatCompletion-shaped dict for a streamed completion. Streams carry no usage, so the tokens are
+        counted with token_counter. finish_reason is "client_stop" when the cut-off ended the stream.
+        """
+        finish_reason = "client_stop" if text and self._should_stop(text) else "stop"
+        prompt_tokens = self.token_counter.count_messages(instruction, input)
+        completion_tokens = self.token_counter.count(text)
+        return {
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                         "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    @staticmethod
+    def _record_first_token(key: str, started: float, track=None):
+        now = time.monotonic()
+        TIME_TO_FIRST_TOKEN.observe(now - started, key_label(key))
+        TRACER.add("first_token", started, now, track=track)
+
+
+def _delta(chunk) -> str:
+    """
+    The content of a streamed chunk, or None for role and finish chunks.
+    """
+    choices = chunk.get("choices") or [{}]
+    return (choices[0].get("delta") or {}).get("content")
+
+
+def _finish_reason(chunk) -> str:
+    choices = chunk.get("choices") or [{}]
+    return choices[0].get("finish_reason")
+
+
+def _check_finished(finish_reason: str):
+    if finish_reason is None:
+        # Raised as a connection error so that it is retried like one
+        raise openai.error.APIConnectionError("The stream ended without a finish_reason")
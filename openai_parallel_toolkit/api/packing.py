@@ -0,0 +1,82 @@
+import json
+from collections import OrderedDict
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from .model import OpenAIModel, Prompt
+
+PACK_INSTRUCTION = (
+    "\n\nThe user message is a JSON array of {count} separate inputs. Apply the instructions above to each "
+    "input on its own, and reply with only a JSON array of exactly {count} strings, where the i-th string is "
+    "the answer for the i-th input."
+)
+
+
+class PromptPacker:
+    """
+    Packs short prompts that share an instruction into one request whose input is a JSON array, and
+    splits the JSON array of the answer back into one result per prompt. With per-key limits of a few
+    requests per minute, this trades longer requests for fewer of them.
+    """
+
+    def __init__(self, max_items: int = 10, max_tokens: int = 1000, max_open_groups: int = 1000):
+        """
+        Args:
+            max_items (int): Most prompts in one request.
+            max_tokens (int): Most input tokens in one request. Longer inputs are sent on their own.
+            max_open_groups (int): Most instructions with a partly filled group while packing a stream.
+                The oldest group is sent as it is when a new instruction would exceed this.
+        """
+        self.max_items = max_items
+        self.max_tokens = max_tokens
+        self.max_open_groups = max_open_groups
+
+    def pack(self, items: Iterable[Tuple[str, Prompt]],
+             openai_model: OpenAIModel) -> Iterator[List[Tuple[str, Prompt]]]:
+        """
+        Group (index, prompt) items lazily. A group is yielded as soon as it is full, and partly filled
+        groups once the items run out.
+        """
+        groups = OrderedDict()  # instruction -> [items, tokens]
+        for index, prompt in items:
+            tokens = openai_model.token_counter.count(prompt.input)
+            if tokens >= self.max_tokens:
+                yield [(index, prompt)]
+                continue
+            group = groups.get(prompt.instruction)
+            if group and group[1] + tokens > self.max_tokens:
+                yield groups.pop(prompt.instruction)[0]
+                group = None
+            if group is None:
+                if len(groups) >= self.max_open_groups:
+                    yield groups.popitem(last=False)[1][0]
+                group = groups[prompt.instruction] = [[], 0]
+            group[0].append((index, prompt))
+            group[1] += tokens
+            if len(group[0]) >= self.max_items:
+                yield groups.pop(prompt.instruction)[0]
+        for group_items, _ in groups.values():
+            yield group_items
+
+    def build(self, group: List[Tuple[str, Prompt]]) -> Prompt:
+        """
+        The single prompt sent for a group.
+        """
+        return Prompt(instruction=group[0][1].instruction + PACK_INSTRUCTION.format(count=len(group)),
+                      input=json.dumps([prompt.input for _, prompt in group], ensure_ascii=False))
+
+    def split(self, output: str, count: int) -> Optional[List[str]]:
+        """
+        The answers in a packed response, or None unless it is a JSON array of exactly count answers.
+        """
+        start, end = output.find("["), output.rfind("]")
+        if start < 0 or end < start:
+            return None
+        try:
+            answers = json.loads(output[start:end + 1])
+        except ValueError:
+            return None
+        if not isinstance(answers, list) or len(answers) != count:
+            return None
+        if not all(isinstance(answer, (str, int, float)) and not isinstance(answer, bool) for answer in answers):
+            return None
+        return [str(answer).strip() for answer in answers]
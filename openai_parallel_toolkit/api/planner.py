@@ -0,0 +1,148 @@
+import logging
+from typing import Iterable, Optional, Tuple
+
+from openai_parallel_toolkit.utils.logger import LOG_LABEL
+from openai_parallel_toolkit.utils.metrics import REQUEST_SECONDS
+from .keys import DAY
+from .model import OpenAIModel, Prompt
+
+
+class CapacityPlan:
+    """
+    What a run can achieve with the keys left, worked out before any request is sent.
+    """
+    __slots__ = ("requests", "tokens_per_request", "keys", "quota", "reset_in", "requests_per_second", "bound",
+                 "pace", "shortfall", "eta")
+
+    def __init__(self, requests: int, tokens_per_request: float, keys: int, quota: int, reset_in: Optional[float],
+                 requests_per_second: float, bound: str, pace: Optional[float]):
+        self.requests = requests
+        self.tokens_per_request = tokens_per_request
+        self.keys = keys
+        self.quota = quota  # Requests the keys can still send today
+        self.reset_in = reset_in  # Seconds until the first key starts a new day
+        self.requests_per_second = requests_per_second  # Best achievable throughput
+        self.bound = bound  # What limits the throughput: "rpm", "tpm", "rpd" or "threads"
+        self.pace = pace  # Requests per second dispatch is throttled to, None without pacing
+        self.shortfall = max(0, requests - quota)  # Requests today's quota does not cover
+        # Seconds until the requests that fit today's quota are done
+        self.eta = min(requests, quota) / requests_per_second if requests_per_second else None
+
+    def describe(self) -> str:
+        text = (f"{self.requests} requests of ~{self.tokens_per_request:.0f} tokens on {self.keys} keys: "
+                f"{self.requests_per_second:.2f} requests/s ({self.bound} bound), ETA {_duration(self.eta)}")
+        if self.shortfall:
+            text += f"; today's quota covers {self.quota}, {self.shortfall} requests short"
+            if self.reset_in is not None:
+                text += f", the first key resets in {_duration(self.reset_in)}"
+        return text
+
+    def __repr__(self):
+        return f"CapacityPlan({self.describe()})"
+
+
+class CapacityPlanner:
+    """
+    Plans a run from the key manager's budgets and the token estimates of the prompts: the best
+    throughput the rate limits allow, the ETA and how many requests the daily quota cannot cover.
+    During the run, leases are paced to just under that throughput, spaced evenly across the keys and
+    the minute windows, so the run does not send a burst each time the buckets refill and then stall
+    on 429s. When the daily quota falls short, it is spread over the rest of the day.
+    """
+
+    def __init__(self, headroom: float = 0.9, pace: bool = True, sample_size: int = 1000,
+                 expected_latency: float = None):
+        """
+        Args:
+            headroom (float): Share of the rate limits dispatch is paced to.
+            pace (bool): Throttle dispatch during the run, otherwise only plan.
+            sample_size (int): Prompts whose tokens are counted to estimate the tokens per request.
+            expected_latency (float): Seconds a request takes, to bound the throughput by the threads. The
+                mean latency measured so far is used when there is one.
+        """
+        self.headroom = headroom
+        self.pace = pace
+        self.sample_size = sample_size
+        self.expected_latency = expected_latency
+
+    def plan(self, key_manager, openai_model: OpenAIModel, items: Iterable[Tuple[str, Prompt]] = None,
+             count: int = None, threads: int = None) -> Optional[CapacityPlan]:
+        """
+        Args:
+            key_manager: KeyManager, EndpointRouter or RemoteKeyManager. Key managers that cannot report
+                their budgets are not planned for.
+            items: The (index, prompt) pairs to send, of which sample_size are counted.
+            count (int): Number of requests, len(items) by default.
+            threads (int): Most requests in flight.
+        Returns:
+            CapacityPlan, or None when the key manager cannot be planned for.
+        """
+        if not hasattr(key_manager, "capacity"):
+            return None
+        capacity = key_manager.capacity()
+        if count is None:
+            count = len(items)
+        tokens = self._sample_tokens(items, count, openai_model) if items is not None else 0
+        rates = {"rpm": capacity["rpm"] / 60}
+        if tokens:
+            rates["tpm"] = capacity["tpm"] / 60 / tokens
+        if count > capacity["quota"]:
+            # Today's quota does not cover the run: spread it until the first key resets, rather than spend
+            # it at the minute rate and have every later request fail for the rest of the day
+            rates["rpd"] = capacity["quota"] / (capacity["reset_in"] or DAY)
+        latency = self._latency()
+        if threads and latency:
+            rates["threads"] = threads / latency
+        bound = min(rates, key=rates.get)
+        limit = min(rate for name, rate in rates.items() if name != "threads")
+        return CapacityPlan(requests=count, tokens_per_request=tokens, keys=capacity["keys"],
+                            quota=capacity["quota"], reset_in=capacity["reset_in"],
+                            requests_per_second=rates[bound], bound=bound,
+                            pace=limit * self.headroom if self.pace and limit else None)
+
+    def start(self, key_manager, plan: Optional[CapacityPlan]):
+        """
+        Log the plan and pace the key manager by it.
+        """
+        if plan is None:
+            return
+        logging.warning(f"{LOG_LABEL}Capacity plan: {plan.describe()}")
+        if plan.shortfall:
+            logging.warning(f"{LOG_LABEL}The daily quota runs out {plan.shortfall} requests before the end. "
+                            f"Those items will fail: add keys, or rerun once the quota resets to resume them.")
+        if plan.pace:
+            key_manager.set_pace(plan.pace)
+
+    def stop(self, key_manager, plan: Optional[CapacityPlan]):
+        if plan is not None and plan.pace:
+            key_manager.set_pace(None)
+
+    def _sample_tokens(self, items: Iterable[Tuple[str, Prompt]], count: int, openai_model: OpenAIModel) -> float:
+        """
+        Mean tokens per request of an evenly spaced sample of the items.
+        """
+        step = max(1, count // self.sample_size) if count else 1
+        total = sampled = 0
+        for position, (_, prompt) in enumerate(items):
+            if position % step == 0:
+                total += openai_model.count_tokens(prompt)
+                sampled += 1
+                if sampled >= self.sample_size:
+                    break
+        return total / sampled if sampled else 0
+
+    def _latency(self) -> Optional[float]:
+        observed = REQUEST_SECONDS.collect().get("")
+        if observed and observed["count"]:
+            return observed["sum"] / observed["count"]
+        return self.expected_latency
+
+
+def _duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "unknown"
+    if seconds >= 3600:
+        return f"{seconds / 3600:.1f}h"
+    if seconds >= 60:
+        return f"{seconds / 60:.1f}min"
+    return f"{seconds:.0f}s"
@@ -1,96 +1,326 @@
-import json
 import logging
+import time
 import traceback
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from functools import partial
-from threading import Lock
-from typing import Dict, Optional, Tuple
+from threading import BoundedSemaphore
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 from openai_parallel_toolkit.utils.logger import LOG_LABEL
+from openai_parallel_toolkit.utils.metrics import (
+    KEY_REQUEST_SECONDS,
+    PACKED_ITEMS,
+    REQUEST_SECONDS,
+    REQUESTS,
+    RETRIES,
+    TOKENS,
+    key_label,
+)
 from openai_parallel_toolkit.utils.process_bar import ProgressBar
+from openai_parallel_toolkit.utils.trace import TRACER
+from openai_parallel_toolkit.utils.writer import ResultWriter, open_writer
+from .cache import ResponseCache
+from .client import HTTPClient
+from .concurrency import limited
+from .errors import CONTEXT_LENGTH, DAILY_LIMIT, INVALID, QUOTA, RATE_LIMIT, TRANSIENT, classify_error
+from .hedge import generate_hedged
 from .keys import KeyManager
 from .model import OpenAIModel, Prompt
+from .packing import PromptPacker
+from .retry import RetryPolicy
+from .scheduler import RetryLater, Scheduler
 
 
-def request_openai_api(openai_model: OpenAIModel, prompt: Prompt, key_manager: KeyManager, max_retries: int) -> \
-        Optional[str]:
-    key = key_manager.get_new_key()
+def request_openai_api(openai_model: OpenAIModel, prompt: Prompt, key_manager: KeyManager, max_retries: int,
+                       cache: ResponseCache = None, retry_policy: RetryPolicy = None, defer: bool = False,
+                       state: tuple = None) -> Optional[str]:
+    """
+    Request a completion for the prompt, switching keys and retrying as the error requires.
+    Args:
+        defer (bool): Instead of sleeping through a backoff, release the key and raise RetryLater, so a
+            Scheduler can run other items meanwhile.
+        state (tuple): The state of a RetryLater, to continue an item where it stopped.
+    """
+    if cache:
+        return cache.get_or_request(
+                cache.make_key(openai_model, prompt),
+                partial(request_openai_api, openai_model=openai_model, prompt=prompt, key_manager=key_manager,
+                        max_retries=max_retries, retry_policy=retry_policy, defer=defer, state=state))
+    retry_policy = retry_policy or RetryPolicy(max_retries=max_retries)
+    tokens = openai_model.count_tokens(prompt)
+    # Attempts so far, start time and model, carried over from a deferred attempt
+    attempts, start, model_name = state or (0, time.monotonic(), openai_model.select_model(tokens))
+    key = None  # Leased once the request holds a concurrency slot, and released before every retry
     completion = None  # Initialize the completion variable
-    attempts = 0  # Initialize attempts
 
-    while attempts < max_retries:
+    while attempts < retry_policy.max_retries and not retry_policy.expired(start):
+        # Wait while the circuit breaker reports the endpoint as down
+        probe = retry_policy.wait_for_breaker(start)
+        if probe is None:
+            break
         try:
-            # Attempt to generate a completion
-            openai_model.set_key(key)
-            completion = openai_model.generate(instruction=prompt.instruction, input=prompt.input)
+            try:
+                with limited(retry_policy.concurrency) as slot:
+                    key = key_manager.get_new_key(tokens=tokens, timeout=retry_policy.remaining(start))
+                    if key is None:
+                        break  # The deadline passed while waiting for a key
+                    slot.start()
+                    # Attempt to generate a completion, passing the key per call as workers share the model
+                    with TRACER.span("http"):
+                        if retry_policy.hedge:
+                            # May answer with a spare key, which is then the one to release
+                            completion, key = generate_hedged(retry_policy.hedge, openai_model, prompt,
+                                                              model_name, key, key_manager, tokens)
+                            retry_policy.hedge.record(time.monotonic() - slot.started)
+                        else:
+                            completion = openai_model.generate(instruction=prompt.instruction, input=prompt.input,
+                                                               model_name=model_name, api_key=key,
+                                                               api_base=key_manager.api_base_for(key))
+            finally:
+                if probe:
+                    retry_policy.breaker.end_probe()
             logging.info(f"{LOG_LABEL}key {key} ,request ok")
-            key_manager.release_key(key)
+            retry_policy.breaker.record_success()
+            record_completion(key, slot.started, completion)
+            key_manager.release_key(key, tokens=completion.get('usage', {}).get('total_tokens'),
+                                    latency=time.monotonic() - slot.started)
             break
         except Exception as e:
-            # Handle different types of errors
-            if "exceeded your current quota" in str(e) or "<empty message>" in str(e) or "Limit: 200 / day" in str(e):
-                # If the quota has been exceeded, remove the key and try again
-                key_manager.remove_key(key)
-                key = key_manager.get_new_key()
-                continue
-            if "Limit: 3 / min" in str(e) or "Limit: 40000 / min" in str(e):
-                # If the rate limit is hit, switch the API key and try again
-                key = key_manager.get_new_key(key)
+            if key is None:
+                raise  # No key could be leased
+            kind, retry_after = classify_error(e)
+            RETRIES.inc(label=kind)
+            key, failed_key = None, key
+            if kind in (QUOTA, DAILY_LIMIT):
+                # If the quota or the daily limit has been exceeded, remove the key and try again
+                key_manager.remove_key(failed_key, exhausted=kind == DAILY_LIMIT)
                 continue
-            if "maximum context length" in str(e):
-                # If the context length is too long, log an error and break the loop
-                logging.error(f"{LOG_LABEL}Error occurred while accessing openai API: {e}")
-                break
-            if "Max retries exceeded with url" in str(e):
-                # If retries are exceeded, try again
+            if kind == RATE_LIMIT:
+                # If the rate limit is hit, hold the key back and try again with another one
+                key_manager.limit_key(failed_key, retry_after)
                 continue
-            if "That model is currently overloaded with other requests" in str(e):
-                # If the model is overloaded, try again
+            if kind == TRANSIENT and key_manager.record_failure(failed_key):
+                # The endpoint is out of rotation and has the key back: move to another one, without a backoff
+                attempts += 1
                 continue
-            if "The server is overloaded" in str(e):
+            key_manager.release_key(failed_key)
+            if kind == CONTEXT_LENGTH and openai_model.next_model(model_name):
+                # If the prompt is too long for this model, retry with the next larger one
+                model_name = openai_model.next_model(model_name)
+                logging.info(f"{LOG_LABEL}Prompt exceeds the context window, retrying with {model_name}")
                 continue
-            # If an unknown error occurs, log an error and increment the attempt counter
-            logging.error(
-                    f"{LOG_LABEL}Unknown error occurred while accessing OpenAI API: {e}. Retry attempt {attempts + 1} "
-                    f"of "
-                    f"{max_retries}")
+            if kind in (CONTEXT_LENGTH, INVALID):
+                # If the request itself is rejected, log an error and break the loop
+                logging.error(f"{LOG_LABEL}Error occurred while accessing openai API: {e}")
+                break
             attempts += 1
+            if kind == TRANSIENT:
+                retry_policy.breaker.record_failure()
+            else:
+                logging.error(
+                        f"{LOG_LABEL}Unknown error occurred while accessing OpenAI API: {e}. Retry attempt "
+                        f"{attempts} of {retry_policy.max_retries}")
+            delay = retry_policy.backoff(attempts, retry_after)
+            if defer and attempts < retry_policy.max_retries and not retry_policy.expired(start):
+                raise RetryLater(delay, (attempts, start, model_name))
+            with TRACER.span("backoff"):
+                time.sleep(delay)
 
     if not completion:
+        REQUESTS.inc(label="failed")
         return None
+    REQUESTS.inc(label="ok")
 
     output = completion['choices'][0]['message']['content'].strip()
 
     return output
 
 
+def request_openai_api_stream(openai_model: OpenAIModel, prompt: Prompt, key_manager: KeyManager, max_retries: int,
+                              retry_policy: RetryPolicy = None) -> Iterator[str]:
+    """
+    Stream the completion for the prompt, yielding tokens as they arrive. Errors before the first token
+    are handled as in request_openai_api; a stream that breaks after it ends the iteration, since a retry
+    would repeat the tokens already yielded. The model's max_output_chars and stop_when apply, and closing
+    the generator cancels the stream. Either way the key is released as soon as the stream ends.
+    """
+    retry_policy = retry_policy or RetryPolicy(max_retries=max_retries)
+    tokens = openai_model.count_tokens(prompt)
+    attempts, start, model_name = 0, time.monotonic(), openai_model.select_model(tokens)
+    key = None  # Leased once the request holds a concurrency slot, and released before every retry
+    parts = []
+    try:
+        while attempts < retry_policy.max_retries and not retry_policy.expired(start):
+            probe = retry_policy.wait_for_breaker(start)
+            if probe is None:
+                break
+            try:
+                try:
+                    # The slot and the key are held while the consumer reads the stream
+                    with limited(retry_policy.concurrency) as slot:
+                        key = key_manager.get_new_key(tokens=tokens, timeout=retry_policy.remaining(start))
+                        if key is None:
+                            break  # The deadline passed while waiting for a key
+                        slot.start()
+                        with closing(openai_model.generate_stream(instruction=prompt.instruction,
+                                                                  input=prompt.input, model_name=model_name,
+                                                                  api_key=key,
+                                                                  api_base=key_manager.api_base_for(key))) as stream:
+                            for token in stream:
+                                if probe:
+                                    # The endpoint answers; the consumer may hold the stream for a long time
+                                    retry_policy.breaker.end_probe()
+                                    probe = False
+                                parts.append(token)
+                                yield token
+                finally:
+                    if probe:
+                        retry_policy.breaker.end_probe()
+                retry_policy.breaker.record_success()
+                REQUESTS.inc(label="ok")
+                REQUEST_SECONDS.observe(time.monotonic() - slot.started)
+                KEY_REQUEST_SECONDS.observe(time.monotonic() - slot.started, key_label(key))
+                return
+            except Exception as e:
+                if key is None:
+                    raise  # No key could be leased
+                if parts:
+                    # Released with the tokens generated so far below
+                    logging.error(f"{LOG_LABEL}Stream broke after {len(parts)} tokens: {e}")
+                    break
+                kind, retry_after = classify_error(e)
+                RETRIES.inc(label=kind)
+                key, failed_key = None, key
+                if kind in (QUOTA, DAILY_LIMIT):
+                    key_manager.remove_key(failed_key, exhausted=kind == DAILY_LIMIT)
+                    continue
+                if kind == RATE_LIMIT:
+                    key_manager.limit_key(failed_key, retry_after)
+                    continue
+                if kind == TRANSIENT and key_manager.record_failure(failed_key):
+                    attempts += 1
+                    continue
+                key_manager.release_key(failed_key)
+                if kind == CONTEXT_LENGTH and openai_model.next_model(model_name):
+                    model_name = openai_model.next_model(model_name)
+                    continue
+                if kind in (CONTEXT_LENGTH, INVALID):
+                    logging.error(f"{LOG_LABEL}Error occurred while accessing openai API: {e}")
+                    break
+                attempts += 1
+                if kind == TRANSIENT:
+                    retry_policy.breaker.record_failure()
+                with TRACER.span("backoff"):
+                    time.sleep(retry_policy.backoff(attempts, retry_after))
+        REQUESTS.inc(label="failed")
+    finally:
+        if key is not None:
+            # Charge what was actually generated, which is less than max_tokens when the stream was cut off
+            used = None
+            if parts:
+                counter = openai_model.token_counter
+                used = counter.count_messages(prompt.instruction, prompt.input) + counter.count("".join(parts))
+                TOKENS.inc(used)
+            key_manager.release_key(key, tokens=used, latency=time.monotonic() - slot.started if parts else None)
+
+
+def request_packed(group: List[Tuple[str, Prompt]], openai_model: OpenAIModel, key_manager: KeyManager,
+                   max_retries: int, packer: PromptPacker, cache: ResponseCache = None,
+                   retry_policy: RetryPolicy = None) -> List[Tuple[str, Optional[str]]]:
+    """
+    Send a group from PromptPacker.pack as one request and split the answer. If the request fails or the
+    answer does not split into one result per prompt, the prompts are sent one by one instead.
+    Returns (index, result) pairs.
+    """
+    request = partial(request_openai_api, openai_model=openai_model, key_manager=key_manager,
+                      max_retries=max_retries, cache=cache, retry_policy=retry_policy)
+    if len(group) > 1:
+        output = request(prompt=packer.build(group))
+        results = packer.split(output, len(group)) if output is not None else None
+        if results is not None:
+            PACKED_ITEMS.inc(len(group), label="packed")
+            return [(index, result) for (index, _), result in zip(group, results)]
+        PACKED_ITEMS.inc(len(group), label="fallback")
+        logging.info(f"{LOG_LABEL}Packed request for {len(group)} prompts did not split, sending them one by one")
+    return [(index, request(prompt=prompt)) for index, prompt in group]
+
+
+def record_completion(key: str, started: float, completion):
+    elapsed = time.monotonic() - started
+    REQUEST_SECONDS.observe(elapsed)
+    KEY_REQUEST_SECONDS.observe(elapsed, key_label(key))
+    TOKENS.inc(completion.get('usage', {}).get('total_tokens', 0))
+
+
 def request_openai_api_with_tqdm(item: Tuple[int, Prompt], openai_model: OpenAIModel, key_manager: KeyManager,
-                                 process_bar: ProgressBar, lock: Lock, max_retries: int, output_path: str = None):
+                                 process_bar: ProgressBar, max_retries: int, writer: ResultWriter = None,
+                                 cache: ResponseCache = None, retry_policy: RetryPolicy = None, queued: float = None):
+    """
+    Args:
+        queued (float): TRACER.clock() when the item was submitted, to trace its time in the queue.
+    """
     key, prompt = item
-    result = request_openai_api(openai_model=openai_model, prompt=prompt, key_manager=key_manager,
-                                max_retries=max_retries)
-
-    if output_path:
-        with lock:
-            with open(output_path, 'a', encoding='utf-8') as file:
-                file.write(json.dumps({key: result}, ensure_ascii=False) + '\n')
-                file.flush()
+    TRACER.add("queue", queued, time.monotonic(), key)
+    with TRACER.span("item", key):
+        result = request_openai_api(openai_model=openai_model, prompt=prompt, key_manager=key_manager,
+                                    max_retries=max_retries, cache=cache, retry_policy=retry_policy)
+
+    if writer:
+        writer.put(key, result)
     process_bar.update()
     return result
 
 
+def request_packed_with_tqdm(group: List[Tuple[str, Prompt]], openai_model: OpenAIModel, key_manager: KeyManager,
+                             process_bar: ProgressBar, max_retries: int, packer: PromptPacker,
+                             writer: ResultWriter = None, cache: ResponseCache = None,
+                             retry_policy: RetryPolicy = None, queued: float = None):
+    TRACER.add("queue", queued, time.monotonic(), group[0][0])
+    with TRACER.span("group", group[0][0]):
+        results = request_packed(group, openai_model=openai_model, key_manager=key_manager,
+                                 max_retries=max_retries, packer=packer, cache=cache, retry_policy=retry_policy)
+    if writer:
+        for index, result in results:
+            writer.put(index, result)
+    process_bar.update(len(results))
+    return [result for _, result in results]
+
+
+def _request_func(openai_model: OpenAIModel, key_manager: KeyManager, process_bar: ProgressBar, max_retries: int,
+                  writer: ResultWriter, cache: ResponseCache, retry_policy: RetryPolicy, packer: PromptPacker):
+    """
+    The function a worker runs for one unit of work: an (index, prompt) item, or a group of them when packing.
+    """
+    if packer:
+        return partial(request_packed_with_tqdm, openai_model=openai_model, key_manager=key_manager,
+                       max_retries=max_retries, process_bar=process_bar, packer=packer, writer=writer, cache=cache,
+                       retry_policy=retry_policy)
+    return partial(request_openai_api_with_tqdm, openai_model=openai_model, key_manager=key_manager,
+                   max_retries=max_retries, process_bar=process_bar, writer=writer, cache=cache,
+                   retry_policy=retry_policy)
+
+
 def parallel_request_openai(data: Dict[int, Prompt], openai_model: OpenAIModel,
                             threads: int, key_manager: KeyManager, max_retries: int,
                             process_bar: ProgressBar,
-                            output_path: str):
-    lock = Lock()
-    with ThreadPoolExecutor(max_workers=threads) as executor:
-        request_func = partial(request_openai_api_with_tqdm, openai_model=openai_model, key_manager=key_manager,
-                               max_retries=max_retries, process_bar=process_bar, output_path=output_path, lock=lock)
+                            output_path: str, writer: ResultWriter = None, cache: ResponseCache = None,
+                            retry_policy: RetryPolicy = None, packer: PromptPacker = None,
+                            http_client: HTTPClient = None, scheduler: Scheduler = None):
+    if scheduler:
+        return scheduled_request_openai(data, openai_model=openai_model, threads=threads, key_manager=key_manager,
+                                        max_retries=max_retries, process_bar=process_bar, output_path=output_path,
+                                        writer=writer, cache=cache, retry_policy=retry_policy, packer=packer,
+                                        http_client=http_client, scheduler=scheduler)
+    with open_writer(output_path, writer) as writer, (http_client or HTTPClient()).installed(), \
+            ThreadPoolExecutor(max_workers=threads) as executor:
+        request_func = _request_func(openai_model, key_manager, process_bar, max_retries, writer, cache,
+                                     retry_policy, packer)
+        units = packer.pack(data.items(), openai_model) if packer else data.items()
         results = []
-        for prompt in data.items():
+        for prompt in units:
             try:
-                result = executor.submit(request_func, prompt)
+                result = executor.submit(request_func, prompt, queued=TRACER.clock())
                 results.append(result)
             except Exception as e:
                 tb = traceback.format_exc()
@@ -98,5 +328,159 @@ def parallel_request_openai(data: Dict[int, Prompt], openai_model: OpenAIModel,
 
     # Wait for all tasks to complete, regardless of whether they were successful or not
     results = [future.result() for future in as_completed(results)]
+    if packer:
+        results = [result for group_results in results for result in group_results]
 
     return results
+
+
+def scheduled_request_openai(data: Dict[int, Prompt], openai_model: OpenAIModel,
+                             threads: int, key_manager: KeyManager, max_retries: int,
+                             process_bar: ProgressBar, scheduler: Scheduler,
+                             output_path: str = None, writer: ResultWriter = None, cache: ResponseCache = None,
+                             retry_policy: RetryPolicy = None, packer: PromptPacker = None,
+                             http_client: HTTPClient = None):
+    """
+    Like parallel_request_openai, but each worker takes the next job from the scheduler, and items that
+    need a backoff go back to the scheduler instead of holding their worker.
+    """
+    retry_policy = retry_policy or RetryPolicy(max_retries=max_retries)
+    units = packer.pack(data.items(), openai_model) if packer else data.items()
+    scheduler.start(units, openai_model, packed=packer is not None)
+
+    def run_job(job, writer):
+        group = job.unit if packer else [job.unit]
+        if scheduler.expired(job):
+            REQUESTS.inc(len(group), label="expired")
+            logging.warning(f"{LOG_LABEL}Deadline passed before prompt {job.index} was sent")
+            results = [(index, None) for index, _ in group]
+        elif packer:
+            results = request_packed(group, openai_model=openai_model, key_manager=key_manager,
+                                     max_retries=max_retries, packer=packer, cache=cache, retry_policy=retry_policy)
+        else:
+            index, prompt = job.unit
+            try:
+                result = request_openai_api(openai_model=openai_model, prompt=prompt, key_manager=key_manager,
+                                            max_retries=max_retries, cache=cache, retry_policy=retry_policy,
+                                            defer=True, state=job.state)
+            except RetryLater as e:
+                scheduler.retry(job, e.delay, e.state)
+                return None
+            results = [(index, result)]
+        if writer:
+            for index, result in results:
+                writer.put(index, result)
+        process_bar.update(len(results))
+        return results
+
+    def worker(writer):
+        results = []
+        while True:
+            job = scheduler.get()
+            if job is None:
+                return results
+            try:
+                with TRACER.span("item", job.index):
+                    job_results = run_job(job, writer)
+                if job_results is None:
+                    continue  # Back in the scheduler
+                results.extend(result for _, result in job_results)
+            except Exception as e:
+                tb = traceback.format_exc()
+                logging.error(f"{LOG_LABEL}Error occurred while processing prompt {job.index}: {e}\n{tb}")
+            scheduler.task_done()
+
+    with open_writer(output_path, writer) as writer, (http_client or HTTPClient()).installed(), \
+            ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(worker, writer) for _ in range(threads)]
+        return [result for future in futures for result in future.result()]
+
+
+def stream_request_openai(items: Iterable[Tuple[int, Prompt]], openai_model: OpenAIModel,
+                          threads: int, key_manager: KeyManager, max_retries: int,
+                          process_bar: ProgressBar,
+                          output_path: str, queue_size: int = None, writer: ResultWriter = None,
+                          cache: ResponseCache = None, retry_policy: RetryPolicy = None,
+                          packer: PromptPacker = None, http_client: HTTPClient = None):
+    """
+    Process items pulled lazily from an iterable. At most queue_size items (or packed groups) are queued
+    or in flight, so reading blocks while workers are behind, and results are dropped once written.
+    """
+    slots = BoundedSemaphore(queue_size or threads * 2)
+
+    def done(future, index):
+        slots.release()
+        if future.exception():
+            logging.error(f"{LOG_LABEL}Error occurred while processing prompt {index}: {future.exception()}")
+
+    with open_writer(output_path, writer) as writer, (http_client or HTTPClient()).installed(), \
+            ThreadPoolExecutor(max_workers=threads) as executor:
+        request_func = _request_func(openai_model, key_manager, process_bar, max_retries, writer, cache,
+                                     retry_policy, packer)
+        units = packer.pack(items, openai_model) if packer else items
+        for item in units:
+            slots.acquire()
+            future = executor.submit(request_func, item, queued=TRACER.clock())
+            future.add_done_callback(partial(done, index=item[0][0] if packer else item[0]))
+
+
+def iter_request_openai(items: Iterable[Tuple[int, Prompt]], openai_model: OpenAIModel,
+                        threads: int, key_manager: KeyManager, max_retries: int,
+                        process_bar: ProgressBar,
+                        output_path: str = None, ordered: bool = False, buffer_size: int = None,
+                        writer: ResultWriter = None, cache: ResponseCache = None, retry_policy: RetryPolicy = None,
+                        packer: PromptPacker = None,
+                        http_client: HTTPClient = None) -> Iterator[Tuple[int, Optional[str]]]:
+    """
+    Yield (index, result) pairs as soon as each request finishes, or in the order of items when ordered
+    is set. At most buffer_size items (threads * 2 by default) are in flight or held in the reorder
+    buffer, so memory stays constant however many items there are. Stopping the iteration cancels the
+    requests that have not started.
+    """
+    if ordered and packer:
+        raise ValueError("Ordered delivery cannot be combined with prompt packing")
+    window = buffer_size or threads * 2
+    with open_writer(output_path, writer) as writer, (http_client or HTTPClient()).installed(), \
+            ThreadPoolExecutor(max_workers=threads) as executor:
+        request_func = _request_func(openai_model, key_manager, process_bar, max_retries, writer, cache,
+                                     retry_policy, packer)
+        units = iter(packer.pack(items, openai_model) if packer else items)
+        pending = {}  # future -> (sequence number, unit)
+        finished = {}  # sequence number -> results, waiting for earlier units in ordered mode
+        submitted = next_seq = 0
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) + len(finished) < window:
+                    unit = next(units, None)
+                    if unit is None:
+                        exhausted = True
+                        break
+                    pending[executor.submit(request_func, unit, queued=TRACER.clock())] = (submitted, unit)
+                    submitted += 1
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    seq, unit = pending.pop(future)
+                    results = _unit_results(future, unit, packer)
+                    if ordered:
+                        finished[seq] = results
+                    else:
+                        yield from results
+                while next_seq in finished:
+                    yield from finished.pop(next_seq)
+                    next_seq += 1
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _unit_results(future, unit, packer: PromptPacker) -> List[Tuple[int, Optional[str]]]:
+    group = unit if packer else [unit]
+    try:
+        results = future.result() if packer else [future.result()]
+    except Exception as e:
+        logging.error(f"{LOG_LABEL}Error occurred while processing prompt {group[0][0]}: {e}")
+        results = [None] * len(group)
+    return [(index, result) for (index, _), result in zip(group, results)]
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Optional, Tuple
+
+from openai_parallel_toolkit.utils.logger import LOG_LABEL
+
+
+class CircuitBreaker:
+    """
+    Shared by all workers. After `threshold` consecutive transient failures the circuit opens and
+    every request waits `cooldown` seconds; then a single probe request is let through, and its
+    result either closes the circuit or opens it again. A probe that ends any other way (a rate limit,
+    a rejected request, a switch of key or endpoint) calls end_probe, so the next request probes instead.
+    """
+
+    def __init__(self, threshold: int = 10, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_until = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Each sharded worker gets a closed breaker of its own
+        return {"threshold": self.threshold, "cooldown": self.cooldown}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def admit(self) -> Tuple[float, bool]:
+        """
+        Returns:
+            tuple: (seconds to wait before sending a request, 0 to go ahead; whether the request is the
+                probe of a half-open circuit, in which case the caller must call end_probe when it is done).
+        """
+        with self.lock:
+            if self.opened_until is None:
+                return 0, False
+            now = time.monotonic()
+            if now < self.opened_until:
+                return self.opened_until - now, False
+            if self.probing:
+                return min(self.cooldown, 1.0), False
+            self.probing = True
+            return 0, True
+
+    def end_probe(self):
+        """
+        Finish a probe. If neither record_success nor record_failure settled the circuit, it stays
+        half-open and the next request becomes the probe.
+        """
+        with self.lock:
+            self.probing = False
+
+    def record_success(self):
+        if self.failures or self.opened_until is not None:
+            with self.lock:
+                if self.opened_until is not None:
+                    logging.warning(f"{LOG_LABEL}Endpoint recovered, closing the circuit breaker")
+                self.failures = 0
+                self.opened_until = None
+                self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            now = time.monotonic()
+            # Past the cooldown, a failure is the probe's (whether or not it has ended yet) and reopens
+            half_open = self.opened_until is not None and now >= self.opened_until
+            if half_open or (self.opened_until is None and self.failures >= self.threshold):
+                if not half_open:
+                    logging.warning(f"{LOG_LABEL}{self.failures} consecutive transient errors, "
+                                    f"pausing requests for {self.cooldown}s")
+                self.opened_until = now + self.cooldown
+                self.probing = False
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, honouring Retry-After, bounded by max_retries and an
+    optional per-item deadline, plus a circuit breaker shared by every request using this policy.
+    """
+
+    def __init__(self, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0,
+                 deadline: float = None, breaker: CircuitBreaker = None, hedge=None,
+                 concurrency=None):
+        """
+        Args:
+            max_retries (int): Attempts allowed for transient and unknown errors.
+            base_delay (float): Backoff cap of the first retry, doubled on every further retry.
+            max_delay (float): Upper bound of the backoff cap.
+            deadline (float): Seconds after which an item is given up, whatever its retries.
+            breaker (CircuitBreaker): Breaker shared by all requests; a default one is created.
+            hedge (HedgePolicy): Send a duplicate of slow requests on a spare key (see HedgePolicy).
+            concurrency (AdaptiveConcurrency): Adjust the number of requests in flight to the endpoint.
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.breaker = breaker or CircuitBreaker()
+        self.hedge = hedge
+        self.concurrency = concurrency
+
+    def backoff(self, attempt: int, retry_after: float = None) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after:
+            delay = max(delay, retry_after)
+        return delay
+
+    def expired(self, start: float) -> bool:
+        return self.deadline is not None and time.monotonic() - start >= self.deadline
+
+    def remaining(self, start: float) -> Optional[float]:
+        """
+        Seconds left until the deadline of the item started at start, None without a deadline.
+        """
+        if self.deadline is None:
+            return None
+        return max(0.0, start + self.deadline - time.monotonic())
+
+    def wait_for_breaker(self, start: float) -> Optional[bool]:
+        """
+        Sleep while the circuit breaker is open, but not past the deadline of the item started at start.
+        Returns:
+            bool: Whether the request is the breaker's probe (see CircuitBreaker.admit), or None when the
+                deadline passed while waiting.
+        """
+        while True:
+            wait, probe = self.breaker.admit()
+            if not wait:
+                return probe
+            if self.expired(start):
+                return None
+            time.sleep(self._breaker_sleep(wait, start))
+
+    async def await_breaker(self, start: float) -> Optional[bool]:
+        """
+        Async variant of wait_for_breaker.
+        """
+        while True:
+            wait, probe = self.breaker.admit()
+            if not wait:
+                return probe
+            if self.expired(start):
+                return None
+            await asyncio.sleep(self._breaker_sleep(wait, start))
+
+    def _breaker_sleep(self, wait: float, start: float) -> float:
+        if self.deadline is None:
+            return wait
+        return min(wait, self.remaining(start))
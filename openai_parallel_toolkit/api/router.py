@@ -0,0 +1,380 @@
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+import requests
+
+from openai_parallel_toolkit.utils.ledger import KeyLedger
+from openai_parallel_toolkit.utils.logger import LOG_LABEL
+from openai_parallel_toolkit.utils.metrics import KEY_WAIT_SECONDS, METRICS
+from openai_parallel_toolkit.utils.reader import read_endpoints
+from openai_parallel_toolkit.utils.trace import TRACER
+from .client import HTTPClient
+from .concurrency import AsyncWaiters
+from .keys import KeyManager, bounded, expired
+
+
+class Endpoint:
+    """
+    One API base with its own key pool, and what has been measured of it.
+    """
+    __slots__ = ("name", "key_manager", "latency", "error_rate", "failures", "in_flight", "healthy")
+
+    def __init__(self, name: str, key_manager: KeyManager):
+        self.name = name
+        self.key_manager = key_manager
+        self.latency = None  # Moving average over about 10 successful requests, in seconds
+        self.error_rate = 0.0  # Moving average over about 10 requests of the share that failed
+        self.failures = 0  # Consecutive failures
+        self.in_flight = 0  # Keys leased
+        self.healthy = True
+
+    def score(self, default_latency: float, error_penalty: float) -> float:
+        """
+        Expected wait for an answer, lower is better: the latency, raised by the error rate and by the
+        share of the endpoint's keys already in use.
+        """
+        latency = self.latency if self.latency is not None else default_latency
+        keys = max(1, self.key_manager.get_key_length())
+        return latency * (1 + error_penalty * self.error_rate) * (1 + self.in_flight / keys)
+
+
+class EndpointRouter:
+    """
+    KeyManager interface over several endpoints (API bases, e.g. regional proxies), each with its own key
+    pool and rate limits. A key is leased from the endpoint expected to answer soonest (see Endpoint.score),
+    and from the next one when all keys of the best are waiting for their budgets. After unhealthy_after
+    consecutive failures an endpoint gets no traffic while another one is healthy; a background probe
+    requests its model list every probe_interval seconds and brings it back once it answers.
+    """
+
+    def __init__(self, endpoints: List[Dict], rpm: int = None, tpm: int = None, rpd: int = None,
+                 ledger_path: str = None, error_penalty: float = 4.0, unhealthy_after: int = 3,
+                 probe_interval: float = 10.0, probe_timeout: float = 5.0, http_client: HTTPClient = None):
+        """
+        Args:
+            endpoints (list): Dicts with name, api_base, api_keys and rate_limits, as from read_endpoints.
+                A key may only belong to one endpoint.
+            rpm (int): Requests per minute allowed for each key. Overrides the endpoints' rate_limits.
+            tpm (int): Tokens per minute allowed for each key. Overrides the endpoints' rate_limits.
+            rpd (int): Requests per day allowed for each key. Overrides the endpoints' rate_limits.
+            ledger_path (str): SQLite file that keeps key health across runs (see KeyLedger).
+            error_penalty (float): How much an error rate of 100% multiplies an endpoint's latency.
+            unhealthy_after (int): Consecutive failures after which an endpoint is taken out of rotation.
+            probe_interval (float): Seconds between health probes, None to disable them.
+            probe_timeout (float): Seconds a probe may take before the endpoint counts as down.
+            http_client (HTTPClient): Makes the session of the probes, which goes through openai.proxy like
+                the requests do.
+        """
+        if not endpoints:
+            raise Exception("No OpenAI keys available")
+        self.ledger = KeyLedger(ledger_path) if ledger_path else None
+        self.error_penalty = error_penalty
+        self.unhealthy_after = unhealthy_after
+        self.probe_timeout = probe_timeout
+        self.http_client = http_client or HTTPClient()
+        self.endpoints = []
+        self.endpoint_of = {}  # key -> Endpoint
+        for spec in endpoints:
+            limits = spec["rate_limits"]
+            key_manager = KeyManager(api_keys=spec["api_keys"], api_base=spec["api_base"],
+                                     rpm=rpm or limits["rpm"], tpm=tpm or limits["tpm"], rpd=rpd or limits["rpd"],
+                                     ledger=self.ledger)
+            endpoint = Endpoint(spec["name"], key_manager)
+            for key in spec["api_keys"]:
+                if key in self.endpoint_of:
+                    raise ValueError(f"Key {key} is listed under more than one endpoint")
+                self.endpoint_of[key] = endpoint
+            self.endpoints.append(endpoint)
+        self.api_base = self.endpoints[0].key_manager.api_base
+        self.leased = set()
+        self.releases = 0  # Bumped by every release, so waiters do not miss one
+        self.lock = threading.Lock()  # Lock for leased, releases and the measurements of the endpoints
+        self.key_released = threading.Condition(self.lock)
+        self.async_waiters = AsyncWaiters()  # Coroutines waiting in aget_new_key, woken with key_released
+        self.closed = threading.Event()
+        if probe_interval:
+            threading.Thread(target=self._probe_loop, args=(probe_interval,), name="EndpointProbe",
+                             daemon=True).start()
+        METRICS.gauge("openai_keys_total", "Keys that have not been removed", self.get_key_length)
+        METRICS.gauge("openai_keys_in_use", "Keys leased to a request", lambda: len(self.leased))
+        METRICS.gauge("openai_keys_limited", "Idle keys waiting for their rate budgets", self.get_limited_length)
+        METRICS.gauge("openai_endpoints_healthy", "Endpoints in rotation",
+                      lambda: sum(endpoint.healthy for endpoint in self.endpoints))
+
+    def get_new_key(self, key=None, tokens: int = 0, retry_after: float = None, timeout: float = None) -> Optional[str]:
+        """
+        Lease a key from the best endpoint that has one within its budgets, blocking until one has.
+        Passing the previous key marks it as rate limited, for retry_after seconds if given.
+        Returns None when no key is ready within timeout seconds (None to wait as long as it takes).
+        """
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        if key:
+            self._limit(key, retry_after)
+        while True:
+            with self.lock:
+                releases = self.releases
+            new_key, delay = self._acquire(tokens)
+            if new_key or expired(deadline):
+                break
+            with self.key_released:
+                if self.releases == releases:
+                    self.key_released.wait(bounded(delay, deadline))
+        end = time.monotonic()
+        KEY_WAIT_SECONDS.observe(end - start)
+        TRACER.add("key_wait", start, end)
+        return new_key
+
+    async def aget_new_key(self, key=None, tokens: int = 0, retry_after: float = None,
+                           timeout: float = None) -> Optional[str]:
+        """
+        Async variant of get_new_key: waits on a future that releases resolve, so the event loop keeps
+        running and waiting coroutines do not poll.
+        """
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        if key:
+            self._limit(key, retry_after)
+        while True:
+            with self.lock:
+                releases = self.releases
+            new_key, delay = self._acquire(tokens)
+            if new_key or expired(deadline):
+                end = time.monotonic()
+                KEY_WAIT_SECONDS.observe(end - start)
+                TRACER.add("key_wait", start, end, track=TRACER.task_track())
+                return new_key
+            with self.lock:
+                if self.releases != releases:
+                    continue
+                waiter = self.async_waiters.add()
+            await self.async_waiters.wait(waiter, bounded(delay, deadline), self.lock)
+
+    def try_get_new_key(self, tokens: int = 0):
+        """
+        Lease a key only if one is within its budgets right now, otherwise return None without waiting.
+        """
+        try:
+            return self._acquire(tokens)[0]
+        except Exception:
+            return None
+
+    def limit_key(self, key, retry_after: float = None):
+        """
+        Release a key that hit a rate limit, holding it back like get_new_key(key) does.
+        """
+        self._limit(key, retry_after)
+
+    def release_key(self, key, tokens: int = None, latency: float = None):
+        """
+        Release a key to its endpoint. A latency marks the request as successful and updates the
+        endpoint's moving averages.
+        """
+        endpoint = self.endpoint_of.get(key)
+        if endpoint is None:
+            return
+        endpoint.key_manager.release_key(key, tokens=tokens)
+        with self.key_released:
+            if latency is not None:
+                endpoint.latency = latency if endpoint.latency is None else 0.9 * endpoint.latency + 0.1 * latency
+                endpoint.error_rate *= 0.9
+                endpoint.failures = 0
+            self._end_lease(key, endpoint)
+
+    def record_failure(self, key) -> bool:
+        """
+        Count a network or server error against the key's endpoint, taking the endpoint out of rotation
+        after unhealthy_after consecutive ones.
+        Returns:
+            bool: True when the key was released because its endpoint is out of rotation while another one
+                is healthy. The request should then lease a new key rather than back off.
+        """
+        endpoint = self.endpoint_of.get(key)
+        if endpoint is None:
+            return False
+        with self.lock:
+            endpoint.error_rate = 0.9 * endpoint.error_rate + 0.1
+            endpoint.failures += 1
+            if endpoint.healthy and endpoint.failures >= self.unhealthy_after:
+                endpoint.healthy = False
+                logging.warning(f"{LOG_LABEL}Endpoint {endpoint.name} failed {endpoint.failures} times in a row, "
+                                f"taking it out of rotation")
+            switch = not endpoint.healthy and any(other.healthy for other in self.endpoints)
+        if switch:
+            self.release_key(key)
+        return switch
+
+    def remove_key(self, key, exhausted: bool = False):
+        endpoint = self.endpoint_of.get(key)
+        if endpoint is None:
+            return
+        endpoint.key_manager.remove_key(key, exhausted=exhausted)
+        with self.key_released:
+            self._end_lease(key, endpoint)
+
+    def api_base_for(self, key) -> str:
+        endpoint = self.endpoint_of.get(key)
+        return endpoint.key_manager.api_base if endpoint else self.api_base
+
+    def preflight(self, threads: int = 32, model_name: str = None) -> dict:
+        """
+        KeyManager.preflight on every endpoint.
+        Returns:
+            dict: Number of keys by outcome over all endpoints.
+        """
+        counts = {}
+        for endpoint in self.endpoints:
+            for outcome, count in endpoint.key_manager.preflight(threads, model_name).items():
+                counts[outcome] = counts.get(outcome, 0) + count
+        return counts
+
+    def status(self) -> List[Dict]:
+        """
+        The measurements of every endpoint, for logs and dashboards.
+        """
+        with self.lock:
+            return [{"name": endpoint.name, "healthy": endpoint.healthy, "latency": endpoint.latency,
+                     "error_rate": endpoint.error_rate, "in_flight": endpoint.in_flight,
+                     "keys": endpoint.key_manager.get_key_length()} for endpoint in self.endpoints]
+
+    def capacity(self) -> dict:
+        """
+        KeyManager.capacity summed over all endpoints.
+        """
+        total = {"keys": 0, "rpm": 0, "tpm": 0, "quota": 0, "reset_in": None}
+        for endpoint in self.endpoints:
+            capacity = endpoint.key_manager.capacity()
+            for name in ("keys", "rpm", "tpm", "quota"):
+                total[name] += capacity[name]
+            if capacity["reset_in"] is not None and (total["reset_in"] is None
+                                                     or capacity["reset_in"] < total["reset_in"]):
+                total["reset_in"] = capacity["reset_in"]
+        return total
+
+    def set_pace(self, requests_per_second: float = None):
+        """
+        Split the pace between the endpoints by their share of the request rate limits.
+        """
+        rpm = [endpoint.key_manager.capacity()["rpm"] for endpoint in self.endpoints]
+        total = sum(rpm)
+        for endpoint, share in zip(self.endpoints, rpm):
+            endpoint.key_manager.set_pace(requests_per_second * share / total
+                                          if requests_per_second and total and share else None)
+
+    def close(self):
+        """
+        Stop the health probe and write the ledger to disk.
+        """
+        self.closed.set()
+        if self.ledger:
+            self.ledger.close()
+
+    def get_key_length(self):
+        return sum(endpoint.key_manager.get_key_length() for endpoint in self.endpoints)
+
+    def get_limited_length(self):
+        return sum(endpoint.key_manager.get_limited_length() for endpoint in self.endpoints)
+
+    def _ranked(self) -> List[Endpoint]:
+        """
+        Endpoints in rotation, best first. All endpoints are in rotation when none is healthy.
+        """
+        with self.lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.healthy] or self.endpoints
+            # Endpoints without a measurement yet are assumed as fast as the fastest one
+            known = [endpoint.latency for endpoint in candidates if endpoint.latency is not None]
+            default_latency = min(known) if known else 1.0
+            return sorted(candidates, key=lambda endpoint: endpoint.score(default_latency, self.error_penalty))
+
+    def _acquire(self, tokens: int = 0):
+        """
+        Lease a key from the best endpoint that has one ready now. Returns (key, None) on success,
+        otherwise (None, delay) like KeyManager.poll_key, with the shortest delay of all endpoints.
+        """
+        delays = []
+        error = None
+        for endpoint in self._ranked():
+            try:
+                key, delay = endpoint.key_manager.poll_key(tokens)
+            except Exception as e:
+                error = e  # No usable keys left on this endpoint
+                continue
+            if key:
+                with self.lock:
+                    self.leased.add(key)
+                    endpoint.in_flight += 1
+                return key, None
+            delays.append(delay)
+        if len(delays) == 0:
+            raise error or Exception("No OpenAI keys available,All keys have expired")
+        delays = [delay for delay in delays if delay is not None]
+        return None, min(delays) if delays else None
+
+    def _limit(self, key, retry_after: float = None):
+        endpoint = self.endpoint_of.get(key)
+        if endpoint is None:
+            return
+        endpoint.key_manager.limit_key(key, retry_after)
+        with self.key_released:
+            self._end_lease(key, endpoint)
+
+    def _end_lease(self, key, endpoint: Endpoint):
+        """
+        Forget a lease once the endpoint's key manager has the key back, and wake the waiters. Must be
+        called with lock held.
+        """
+        if key in self.leased:
+            self.leased.discard(key)
+            endpoint.in_flight -= 1
+        self.releases += 1
+        self.key_released.notify_all()
+        self.async_waiters.wake_all()
+
+    def _probe_loop(self, interval: float):
+        # The first round runs at once, so an endpoint that is down at the start gets little traffic
+        while True:
+            # A session per round, so a proxy set after the router was created is used
+            with self.http_client.make_session() as session:
+                for endpoint in self.endpoints:
+                    self._probe(endpoint, session)
+            if self.closed.wait(interval):
+                return
+
+    def _probe(self, endpoint: Endpoint, session: requests.Session):
+        """
+        Request the model list of an endpoint. Any HTTP answer below 500, even an authentication error,
+        shows that the endpoint is up; a timeout, a connection error or a server error that it is not.
+        """
+        with endpoint.key_manager.using_keys_lock:
+            key = next(iter(endpoint.key_manager.keys), None)
+        if key is None:
+            return
+        try:
+            response = session.get(f"{endpoint.key_manager.api_base.rstrip('/')}/models",
+                                   headers={"Authorization": f"Bearer {key}"}, timeout=self.probe_timeout)
+            up = response.status_code < 500
+        except Exception:
+            up = False
+        with self.lock:
+            if up and not endpoint.healthy:
+                endpoint.healthy = True
+                endpoint.failures = 0
+                endpoint.error_rate = 0.0
+                logging.warning(f"{LOG_LABEL}Endpoint {endpoint.name} answers again, back in rotation")
+            elif not up and endpoint.healthy:
+                endpoint.healthy = False
+                logging.warning(f"{LOG_LABEL}Health probe of endpoint {endpoint.name} failed, "
+                                f"taking it out of rotation")
+
+
+def open_key_manager(config_path: str, ledger_path: str = None, http_client: HTTPClient = None):
+    """
+    A KeyManager for config.json, or an EndpointRouter when it lists several endpoints.
+    """
+    if config_path:
+        endpoints = read_endpoints(config_path)
+        if endpoints:
+            return EndpointRouter(endpoints, ledger_path=ledger_path, http_client=http_client)
+    return KeyManager(config_path=config_path, ledger_path=ledger_path)
@@ -0,0 +1,153 @@
+import heapq
+import itertools
+import threading
+import time
+from typing import Iterable, Optional
+
+from .model import OpenAIModel
+
+
+class RetryLater(Exception):
+    """
+    Raised by request_openai_api with defer set instead of sleeping through a backoff. The item should be
+    tried again after delay seconds, passing state back so its attempts and deadline carry over.
+    """
+
+    def __init__(self, delay: float, state: tuple):
+        super().__init__(f"Retry in {delay:.1f}s")
+        self.delay = delay
+        self.state = state
+
+
+class Job:
+    """
+    A unit of work in the scheduler: an (index, prompt) item, or a group of them when packing.
+    """
+    __slots__ = ("unit", "index", "priority", "tokens", "deadline", "state", "retried")
+
+    def __init__(self, unit, index, priority, tokens, deadline):
+        self.unit = unit
+        self.index = index
+        self.priority = priority
+        self.tokens = tokens
+        self.deadline = deadline  # time.monotonic() after which the job is given up, or None
+        self.state = None  # Retry state from RetryLater
+        self.retried = False
+
+    def rank(self):
+        # Higher priority first, then retries ahead of fresh work, then the longest prompts
+        return -self.priority, not self.retried, -self.tokens
+
+
+class Scheduler:
+    """
+    Orders the work of the thread engine. Items with a higher priority go first, then the longest
+    prompts by estimated tokens, so that a long request does not start last and set the end of the run.
+    An item that needs a backoff is put back with a not-before time, ahead of fresh items of the same
+    priority, and its worker moves on to other items instead of sleeping. Items still waiting when their
+    deadline passes are given up.
+    Tokens are counted lazily: jobs wait in a backlog by priority and input order, and only the next
+    window of them is counted and ordered longest first, so the first request goes out right away.
+    """
+
+    def __init__(self, longest_first: bool = True, priorities: dict = None, deadlines: dict = None,
+                 deadline: float = None, window: int = 1024):
+        """
+        Args:
+            longest_first (bool): Start the items with the most tokens first.
+            priorities (dict): Priority of an index, higher first. Items not in the dict have priority 0.
+            deadlines (dict): Seconds after the start of the run by which an index has to be sent.
+            deadline (float): Deadline of the items not in deadlines, None for no deadline.
+            window (int): Jobs whose tokens are counted ahead, among which the longest goes first.
+        """
+        self.longest_first = longest_first
+        self.priorities = priorities or {}
+        self.deadlines = deadlines or {}
+        self.deadline = deadline
+        self.window = window
+        self.backlog = []  # (-priority, seq, job) for jobs whose tokens are not counted yet
+        self.ready = []  # (rank, seq, job)
+        self.waiting = []  # (not_before, seq, job) for jobs in backoff
+        self.seq = itertools.count()
+        self.unfinished = 0
+        self.openai_model = None
+        self.packed = False
+        self.cond = threading.Condition()
+
+    def __getstate__(self):
+        return {"longest_first": self.longest_first, "priorities": self.priorities, "deadlines": self.deadlines,
+                "deadline": self.deadline, "window": self.window}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def start(self, units: Iterable, openai_model: OpenAIModel, packed: bool = False):
+        """
+        Queue the units of a run, replacing any left from a previous run.
+        """
+        now = time.monotonic()
+        backlog = []
+        for unit in units:
+            items = unit if packed else [unit]
+            priority = max(self.priorities.get(index, 0) for index, _ in items)
+            deadlines = [self.deadlines.get(index, self.deadline) for index, _ in items]
+            deadlines = [deadline for deadline in deadlines if deadline is not None]
+            job = Job(unit, items[0][0], priority, 0, now + min(deadlines) if deadlines else None)
+            backlog.append((-priority, next(self.seq), job))
+        heapq.heapify(backlog)
+        with self.cond:
+            self.openai_model = openai_model
+            self.packed = packed
+            self.backlog = backlog
+            self.ready = []
+            self.waiting = []
+            self.unfinished = len(backlog)
+
+    def get(self) -> Optional[Job]:
+        """
+        Block until a job can start, or return None once every job is finished.
+        """
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.waiting and self.waiting[0][0] <= now:
+                    _, _, job = heapq.heappop(self.waiting)
+                    heapq.heappush(self.ready, (job.rank(), next(self.seq), job))
+                self._fill()
+                if self.ready:
+                    return heapq.heappop(self.ready)[2]
+                if not self.unfinished:
+                    return None
+                # Jobs are either in flight or in backoff
+                self.cond.wait(self.waiting[0][0] - now if self.waiting else None)
+
+    def retry(self, job: Job, delay: float, state: tuple):
+        """
+        Put a job back after a failed attempt, to start again in delay seconds.
+        """
+        job.state = state
+        job.retried = True
+        with self.cond:
+            heapq.heappush(self.waiting, (time.monotonic() + delay, next(self.seq), job))
+            self.cond.notify()
+
+    def task_done(self):
+        with self.cond:
+            self.unfinished -= 1
+            if not self.unfinished:
+                self.cond.notify_all()
+
+    def _fill(self):
+        """
+        Move jobs from the backlog to the ready queue, counting their tokens, until window are ready. The
+        backlog is taken in priority order, so no fresh job left behind outranks one that is ready.
+        """
+        while self.backlog and len(self.ready) < self.window:
+            job = heapq.heappop(self.backlog)[2]
+            if self.longest_first:
+                items = job.unit if self.packed else [job.unit]
+                job.tokens = sum(self.openai_model.count_tokens(prompt) for _, prompt in items)
+            heapq.heappush(self.ready, (job.rank(), next(self.seq), job))
+
+    def expired(self, job: Job) -> bool:
+        return job.deadline is not None and time.monotonic() >= job.deadline
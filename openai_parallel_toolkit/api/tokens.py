@@ -0,0 +1,75 @@
+import logging
+import threading
+
+from openai_parallel_toolkit.utils.logger import LOG_LABEL
+
+# Context window of the chat models, in tokens
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-0301": 4096,
+    "gpt-3.5-turbo-0613": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-3.5-turbo-16k-0613": 16384,
+    "gpt-4": 8192,
+    "gpt-4-0314": 8192,
+    "gpt-4-0613": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-32k-0314": 32768,
+    "gpt-4-32k-0613": 32768,
+}
+
+# Tokens the chat format adds around the system and user messages
+MESSAGE_OVERHEAD = 11
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Offline estimate that errs on the high side: about four ASCII characters per token and one
+    token per non-ASCII character (CJK text is usually a little under that).
+    """
+    if not text:
+        return 0
+    non_ascii = len(text) - len(text.encode("ascii", "ignore"))
+    return (len(text) - non_ascii + 3) // 4 + non_ascii
+
+
+class TokenCounter:
+    """
+    Counts tokens with tiktoken when it is installed and its encoding can be loaded,
+    otherwise with estimate_tokens. The encoding is loaded on first use.
+    """
+
+    def __init__(self, encoding_name: str = "cl100k_base"):
+        self.encoding_name = encoding_name
+        self.encoding = None
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def count(self, text: str) -> int:
+        if not self.loaded:
+            self._load()
+        if self.encoding is None or not text:
+            return estimate_tokens(text)
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def count_messages(self, instruction: str, input: str) -> int:
+        return self.count(instruction) + self.count(input) + MESSAGE_OVERHEAD
+
+    def __getstate__(self):
+        # Locks and encodings do not pickle: sharded runs send the model to other processes
+        return {"encoding_name": self.encoding_name}
+
+    def __setstate__(self, state):
+        self.__init__(state["encoding_name"])
+
+    def _load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            try:
+                import tiktoken
+                self.encoding = tiktoken.get_encoding(self.encoding_name)
+            except Exception as e:
+                # Not installed, or the encoding file cannot be downloaded
+                logging.info(f"{LOG_LABEL}tiktoken unavailable ({e}), estimating token counts")
+            self.loaded = True
@@ -1,20 +1,49 @@
+import copy
 import logging
 import multiprocessing
-from typing import Dict
+import os
+from typing import AsyncIterator, Dict, Iterable, Iterator, Optional, Tuple, Union
 
-from openai_parallel_toolkit.api.keys import KeyManager
+from openai_parallel_toolkit.api.async_request import (
+    iter_request_openai_async,
+    parallel_request_openai_async,
+    stream_request_openai_async,
+)
+from openai_parallel_toolkit.api.cache import ResponseCache
+from openai_parallel_toolkit.api.client import HTTPClient
+from openai_parallel_toolkit.api.coordinator import KeyCoordinator, RemoteKeyManager
 from openai_parallel_toolkit.api.model import OpenAIModel, Prompt
-from openai_parallel_toolkit.api.request import parallel_request_openai, request_openai_api
+from openai_parallel_toolkit.api.packing import PromptPacker
+from openai_parallel_toolkit.api.planner import CapacityPlan, CapacityPlanner
+from openai_parallel_toolkit.api.request import (
+    iter_request_openai,
+    parallel_request_openai,
+    request_openai_api,
+    request_openai_api_stream,
+    stream_request_openai,
+)
+from openai_parallel_toolkit.api.retry import RetryPolicy
+from openai_parallel_toolkit.api.router import open_key_manager
+from openai_parallel_toolkit.api.scheduler import Scheduler
+from openai_parallel_toolkit.utils.checkpoint import Checkpoint
+from openai_parallel_toolkit.utils.dataset import PromptDataset
 from openai_parallel_toolkit.utils.logger import LOG_LABEL, Logger
+from openai_parallel_toolkit.utils.metrics import METRICS
 from openai_parallel_toolkit.utils.process_bar import ProgressBar
 from openai_parallel_toolkit.utils.reader import (
+    count_lines,
     count_null_values,
-    filter,
+    iter_jsonl_prompts,
     merge_jsonl_files,
-    read_jsonl_to_dict,
+    merge_shard_outputs,
+    read_processed_indexes,
     read_sort_write_jsonl,
     remove_nulls_from_jsonl,
+    shard_of,
+    shard_path,
 )
+from openai_parallel_toolkit.utils.trace import TRACER
+from openai_parallel_toolkit.utils.writer import ResultWriter
 
 
 class ParallelToolkit:
@@ -28,23 +57,275 @@ class ParallelToolkit:
         name="ParallelToolkit Progress",
         max_retries=5,
         log_level=logging.WARNING,
+        checkpoint_path: str = None,
+        fsync: bool = False,
+        cache: ResponseCache = None,
+        retry_policy: RetryPolicy = None,
+        metrics_port: int = None,
+        coordinator_address=None,
+        coordinator_authkey: bytes = None,
+        packer: PromptPacker = None,
+        key_ledger_path: str = None,
+        preflight: bool = False,
+        http_client: HTTPClient = None,
+        scheduler: Scheduler = None,
+        trace_path: str = None,
+        planner: CapacityPlanner = None,
     ):
-        self.key_manager = KeyManager(config_path=config_path)
+        if coordinator_address:
+            if not coordinator_authkey:
+                raise ValueError("coordinator_address requires the coordinator's authkey")
+            # Lease keys from a KeyCoordinator shared with other processes or hosts
+            self.key_manager = RemoteKeyManager(coordinator_address, authkey=coordinator_authkey)
+        else:
+            # A KeyManager, or an EndpointRouter when config.json lists several endpoints
+            self.key_manager = open_key_manager(config_path, ledger_path=key_ledger_path, http_client=http_client)
+        if preflight:
+            self.key_manager.preflight()
         self.logger = Logger(level=log_level)
+        self.log_level = log_level
         self.input_path = input_path
         self.output_path = output_path
         self.threads = threads
         self.openai_model = openai_model
         self.name = name
         self.max_retries = max_retries
+        self.fsync = fsync
+        self.cache = cache
+        self.retry_policy = retry_policy or RetryPolicy(max_retries=max_retries)
+        self.packer = packer
+        self.http_client = http_client or HTTPClient()
+        self.scheduler = scheduler
+        self.planner = planner
+        self.active_plan = None  # Plan of the current run, paced until _stop_plan
+        self.shard = None  # (shard, num_shards) while running a single shard
+        self.trace_path = trace_path
+        if trace_path:
+            TRACER.enable()
+        if metrics_port:
+            METRICS.serve(metrics_port)
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint = self._open_checkpoint(checkpoint_path) if checkpoint_path else None
+
+    def run(self, stream: bool = False):
+        """
+        Process the input file, resuming from the results already in the output file.
+        Args:
+            stream (bool): Read the input lazily through a bounded queue so memory stays flat for
+                datasets of any size.
+        """
+        if stream:
+            self._check_scheduler("run(stream=True)")
+            items, threads, process_bar = self._prepare_stream()
+            try:
+                with self._open_writer() as writer:
+                    stream_request_openai(
+                        items=items,
+                        openai_model=self.openai_model,
+                        key_manager=self.key_manager,
+                        threads=threads,
+                        max_retries=self.max_retries,
+                        process_bar=process_bar,
+                        output_path=self.output_path,
+                        writer=writer,
+                        cache=self.cache,
+                        retry_policy=self.retry_policy,
+                        packer=self.packer,
+                        http_client=self.http_client,
+                    )
+            finally:
+                self._stop_plan()
+            self._finish_run(process_bar)
+            return
+        prepared = self._prepare_run()
+        if not prepared:
+            return
+        filtered_data, threads, process_bar = prepared
+        try:
+            with filtered_data.dataset, self._open_writer() as writer:
+                parallel_request_openai(
+                    data=filtered_data,
+                    openai_model=self.openai_model,
+                    key_manager=self.key_manager,
+                    threads=threads,
+                    max_retries=self.max_retries,
+                    process_bar=process_bar,
+                    output_path=self.output_path,
+                    writer=writer,
+                    cache=self.cache,
+                    retry_policy=self.retry_policy,
+                    packer=self.packer,
+                    http_client=self.http_client,
+                    scheduler=self.scheduler,
+                )
+        finally:
+            self._stop_plan()
+        self._finish_run(process_bar)
+
+    async def arun(self, stream: bool = False):
+        """
+        Same as run(), but drives the requests from a single asyncio event loop instead of a thread pool.
+        """
+        self._check_scheduler("arun()")
+        if stream:
+            items, concurrency, process_bar = self._prepare_stream()
+            try:
+                with self._open_writer() as writer:
+                    await stream_request_openai_async(
+                        items=items,
+                        openai_model=self.openai_model,
+                        key_manager=self.key_manager,
+                        concurrency=concurrency,
+                        max_retries=self.max_retries,
+                        process_bar=process_bar,
+                        output_path=self.output_path,
+                        writer=writer,
+                        cache=self.cache,
+                        retry_policy=self.retry_policy,
+                        packer=self.packer,
+                        http_client=self.http_client,
+                    )
+            finally:
+                self._stop_plan()
+            self._finish_run(process_bar)
+            return
+        prepared = self._prepare_run()
+        if not prepared:
+            return
+        filtered_data, concurrency, process_bar = prepared
+        try:
+            with filtered_data.dataset, self._open_writer() as writer:
+                await parallel_request_openai_async(
+                    data=filtered_data,
+                    openai_model=self.openai_model,
+                    key_manager=self.key_manager,
+                    concurrency=concurrency,
+                    max_retries=self.max_retries,
+                    process_bar=process_bar,
+                    output_path=self.output_path,
+                    writer=writer,
+                    cache=self.cache,
+                    retry_policy=self.retry_policy,
+                    packer=self.packer,
+                    http_client=self.http_client,
+                )
+        finally:
+            self._stop_plan()
+        self._finish_run(process_bar)
+
+    def run_shard(self, shard: int, num_shards: int, stream: bool = False):
+        """
+        Process only the input indexes of one shard, writing them to the shard's own output file
+        (see shard_path). Run one shard per process or host, all created with the same
+        coordinator_address, then combine the results with merge_shards().
+        """
+        output_path = self.output_path
+        self.shard = (shard, num_shards)
+        self.output_path = shard_path(output_path, shard, num_shards)
+        try:
+            self.run(stream=stream)
+        finally:
+            self.shard = None
+            self.output_path = output_path
+
+    def run_sharded(self, num_shards: int, stream: bool = False):
+        """
+        Split the input across num_shards worker processes that lease keys from this process's key
+        pool through a KeyCoordinator, then merge their outputs into output_path.
+        The calling script must be guarded by `if __name__ == "__main__":`, as workers are spawned.
+        Each worker gets a copy of cache (sharing its SQLite file), retry_policy and scheduler. With a
+        planner, the whole input is planned and paced here, as the workers lease keys from this pool.
+        With trace_path, each worker writes its own trace (see shard_path).
+        """
+        if stream:
+            self._check_scheduler("run_sharded(stream=True)")
+        authkey = os.urandom(16)
+        coordinator = KeyCoordinator(None, authkey=authkey, key_manager=self.key_manager).start()
+        try:
+            if self.planner:
+                # Resumed shards make this an upper bound: their outputs are only read by the workers
+                with PromptDataset(self.input_path) as data:
+                    self._start_plan(items=data.items(), count=len(data), threads=self.threads)
+            options = dict(
+                openai_model=self.openai_model,
+                input_path=self.input_path,
+                output_path=self.output_path,
+                threads=self.threads,
+                max_retries=self.max_retries,
+                log_level=self.log_level,
+                fsync=self.fsync,
+                packer=self.packer,
+                http_client=self.http_client,
+                cache=self.cache,
+                retry_policy=self.retry_policy,
+                scheduler=self.scheduler,
+                coordinator_address=coordinator.address,
+                coordinator_authkey=authkey,
+            )
+            context = multiprocessing.get_context("spawn")
+            processes = [
+                context.Process(target=_run_shard_process, args=(options, self.checkpoint_path, self.trace_path,
+                                                                 self.name, shard, num_shards, stream))
+                for shard in range(num_shards)
+            ]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+        finally:
+            coordinator.close()
+            self._stop_plan()
+        failed = [shard for shard, process in enumerate(processes) if process.exitcode != 0]
+        if failed:
+            logging.error(f"{LOG_LABEL}Shards {failed} exited with an error, rerun to resume them")
+        self.merge_shards(num_shards)
+
+    def merge_shards(self, num_shards: int):
+        """
+        Combine the output files of all shards into output_path, sorted by index. With checkpoint_path,
+        each shard's checkpoint is first exported to its output file.
+        """
+        if self.checkpoint_path:
+            for shard in range(num_shards):
+                checkpoint = Checkpoint(shard_path(self.checkpoint_path, shard, num_shards))
+                try:
+                    checkpoint.export_jsonl(shard_path(self.output_path, shard, num_shards))
+                finally:
+                    checkpoint.close()
+        merge_shard_outputs(self.output_path, num_shards)
+        null_values = count_null_values(self.output_path)
+        logging.warning(f"{LOG_LABEL}Merged {num_shards} shards into {self.output_path}, "
+                        f"{null_values} data processing failures")
 
-    def run(self):
-        remove_nulls_from_jsonl(self.output_path)
-        data = read_jsonl_to_dict(self.input_path)
-        filtered_data = filter(data, self.output_path)
+    def export(self, path: str = None):
+        """
+        Write the checkpointed results to a JSONL file sorted by index (output_path by default).
+        """
+        self.checkpoint.export_jsonl(path or self.output_path)
+
+    def _open_writer(self) -> ResultWriter:
+        return ResultWriter(output_path=self.output_path, checkpoint=self.checkpoint, fsync=self.fsync)
+
+    def _open_checkpoint(self, checkpoint_path: str) -> Checkpoint:
+        checkpoint = Checkpoint(checkpoint_path, durable=self.fsync)
+        if checkpoint.count_done() == 0 and checkpoint.count_failed() == 0 and self.output_path:
+            # First run with a checkpoint: carry over results from an existing output file
+            checkpoint.import_jsonl(self.output_path)
+        return checkpoint
+
+    def _prepare_run(self):
+        # Only offsets and interned instructions are loaded; inputs are read when they are sent. The caller
+        # closes the dataset (filtered_data.dataset) once the run is over
+        data = PromptDataset(self.input_path).select(shard=self.shard)
+        if self.checkpoint:
+            filtered_data = data.select(skip=self.checkpoint)
+        else:
+            remove_nulls_from_jsonl(self.output_path)
+            filtered_data = data.select(skip=read_processed_indexes(self.output_path))
         if len(filtered_data) == 0:
+            data.dataset.close()
             logging.warning(f"{LOG_LABEL}All data have been processed")
-            return
+            return None
         logging.warning(
             f"{LOG_LABEL}Data is being processed, waiting for the first returned result."
             f"If the progress bar hasn't moved for a long time, it's likely due to a network issue."
@@ -52,19 +333,71 @@ class ParallelToolkit:
         )
         threads = min(len(filtered_data), self.threads, self.key_manager.get_key_length())
         threads = max(threads, 1)
-        process_bar = ProgressBar(total=len(data), desc=self.name, initial=len(data) - len(filtered_data))
-        parallel_request_openai(
-            data=filtered_data,
-            openai_model=self.openai_model,
-            key_manager=self.key_manager,
-            threads=threads,
-            max_retries=self.max_retries,
-            process_bar=process_bar,
-            output_path=self.output_path,
-        )
-        read_sort_write_jsonl(self.output_path)
+        try:
+            if self.planner:
+                self._start_plan(items=filtered_data.items(), count=len(filtered_data), threads=threads)
+            process_bar = self._progress_bar(total=len(data), initial=len(data) - len(filtered_data))
+        except BaseException:
+            # The caller only takes over the pace and the dataset once they are returned
+            self._stop_plan()
+            data.dataset.close()
+            raise
+        return filtered_data, threads, process_bar
+
+    def _prepare_stream(self):
+        if self.checkpoint:
+            processed = self.checkpoint
+            initial = self.checkpoint.count_done()
+        else:
+            remove_nulls_from_jsonl(self.output_path)
+            processed = read_processed_indexes(self.output_path)
+            initial = len(processed)
+        items = iter_jsonl_prompts(self.input_path, skip=processed)
+        total = count_lines(self.input_path)
+        if self.shard:
+            shard, num_shards = self.shard
+            items = ((index, prompt) for index, prompt in items if shard_of(index, num_shards) == shard)
+            total = -(-total // num_shards)  # Approximate: indexes are dealt evenly across shards
+        logging.warning(f"{LOG_LABEL}Data is being streamed, waiting for the first returned result.")
+        threads = max(min(self.threads, self.key_manager.get_key_length()), 1)
+        try:
+            if self.planner:
+                # The input is read lazily, so tokens are not sampled and only the request budgets are planned for
+                self._start_plan(items=None, count=max(total - initial, 0), threads=threads)
+            process_bar = self._progress_bar(total=total, initial=initial)
+        except BaseException:
+            self._stop_plan()
+            raise
+        return items, threads, process_bar
+
+    def _progress_bar(self, total, initial=0) -> ProgressBar:
+        concurrency = self.retry_policy.concurrency
+        return ProgressBar(total=total, desc=self.name, initial=initial,
+                           postfix=concurrency.describe if concurrency else None)
+
+    def _start_plan(self, items, count: int, threads: int):
+        self.active_plan = self.planner.plan(self.key_manager, self.openai_model, items=items, count=count,
+                                             threads=threads)
+        self.planner.start(self.key_manager, self.active_plan)
+
+    def _stop_plan(self):
+        """
+        Clear the pace of the current run. Safe to call more than once.
+        """
+        if self.planner:
+            self.planner.stop(self.key_manager, self.active_plan)
+            self.active_plan = None
+
+    def _finish_run(self, process_bar: ProgressBar):
         process_bar.close()
-        null_values = count_null_values(self.output_path)
+        if self.trace_path:
+            self.export_trace()
+        if self.checkpoint:
+            # output_path is only written by export(), so a resumed run does not rewrite it every time
+            null_values = self.checkpoint.count_failed()
+        else:
+            read_sort_write_jsonl(self.output_path)
+            null_values = count_null_values(self.output_path)
         if null_values == 0:
             logging.warning(f"{LOG_LABEL}All data processing is complete")
         else:
@@ -72,26 +405,202 @@ class ParallelToolkit:
                 f"{LOG_LABEL}There are {null_values} data processing failures. "
                 f"Please attempt to reprocess this data again. "
                 f"If the data length exceeds the default model limit, "
-                f"you can refer to the solution in the documentation and use gpt-3.5-turbo-16k-0613 for reprocessing."
+                f"pass fallback_models=['gpt-3.5-turbo-16k-0613'] to OpenAIModel "
+                f"so long prompts are sent to the larger model in the same run."
             )
 
-    def api(self, prompt: Prompt):
+    def api(self, prompt: Prompt, stream: bool = False) -> Union[Optional[str], Iterator[str]]:
+        """
+        Request a completion for one prompt.
+        Args:
+            stream (bool): Return an iterator of the tokens as they arrive instead of the whole answer.
+                The max_output_chars and stop_when of the model end the stream early, and so does
+                closing the iterator; the key is released as soon as the stream ends. Not cached.
+        """
+        if stream:
+            return request_openai_api_stream(
+                openai_model=self.openai_model, prompt=prompt, key_manager=self.key_manager,
+                max_retries=self.max_retries, retry_policy=self.retry_policy,
+            )
         return request_openai_api(
-            openai_model=self.openai_model, prompt=prompt, key_manager=self.key_manager, max_retries=self.max_retries
+            openai_model=self.openai_model, prompt=prompt, key_manager=self.key_manager, max_retries=self.max_retries,
+            cache=self.cache,
+            retry_policy=self.retry_policy,
         )
 
-    def parallel_api(self, data: Dict[int, Prompt]):
+    def parallel_api(self, data: Dict[int, Prompt], stream: bool = False):
+        """
+        Request completions for all prompts, returning the results in the order they finished.
+        Args:
+            stream (bool): Stream each completion, as OpenAIModel(stream=True) does, so the cut-off of
+                the model frees keys early and time to first token is recorded.
+        """
         logging.warning(f"{LOG_LABEL}Data is being processed, waiting for the first returned result")
-        process_bar = ProgressBar(total=len(data), desc=self.name)
-        return parallel_request_openai(
+        process_bar = self._progress_bar(total=len(data))
+        results = parallel_request_openai(
             data=data,
-            openai_model=self.openai_model,
+            openai_model=self._streaming_model() if stream else self.openai_model,
             key_manager=self.key_manager,
             threads=self.threads,
             max_retries=self.max_retries,
             process_bar=process_bar,
             output_path=self.output_path,
+            cache=self.cache,
+            retry_policy=self.retry_policy,
+            packer=self.packer,
+            http_client=self.http_client,
+            scheduler=self.scheduler,
         )
+        if self.trace_path:
+            self.export_trace()
+        return results
+
+    async def aparallel_api(self, data: Dict[int, Prompt]):
+        self._check_scheduler("aparallel_api()")
+        logging.warning(f"{LOG_LABEL}Data is being processed, waiting for the first returned result")
+        process_bar = self._progress_bar(total=len(data))
+        results = await parallel_request_openai_async(
+            data=data,
+            openai_model=self.openai_model,
+            key_manager=self.key_manager,
+            concurrency=self.threads,
+            max_retries=self.max_retries,
+            process_bar=process_bar,
+            output_path=self.output_path,
+            cache=self.cache,
+            retry_policy=self.retry_policy,
+            packer=self.packer,
+            http_client=self.http_client,
+        )
+        if self.trace_path:
+            self.export_trace()
+        return results
+
+    def iter_api(self, data: Union[Dict[int, Prompt], Iterable[Tuple[int, Prompt]]], ordered: bool = False,
+                 buffer_size: int = None) -> Iterator[Tuple[int, Optional[str]]]:
+        """
+        Yield (index, result) pairs as soon as each request finishes, so results can be used while the
+        batch is still running.
+        Args:
+            data: Dict of prompts, or any iterable of (index, prompt) pairs, which is read lazily.
+            ordered (bool): Yield in the order of data, holding early results in a reorder buffer.
+            buffer_size (int): Most items in flight or in the reorder buffer, threads * 2 by default.
+        """
+        self._check_scheduler("iter_api()")
+        items = data.items() if isinstance(data, dict) else data
+        process_bar = self._progress_bar(total=len(items) if hasattr(items, "__len__") else None)
+        try:
+            yield from iter_request_openai(
+                items=items,
+                openai_model=self.openai_model,
+                key_manager=self.key_manager,
+                threads=self.threads,
+                max_retries=self.max_retries,
+                process_bar=process_bar,
+                output_path=self.output_path,
+                ordered=ordered,
+                buffer_size=buffer_size,
+                cache=self.cache,
+                retry_policy=self.retry_policy,
+                packer=self.packer,
+                http_client=self.http_client,
+            )
+        finally:
+            process_bar.close()
+
+    async def aiter_api(self, data: Union[Dict[int, Prompt], Iterable[Tuple[int, Prompt]]], ordered: bool = False,
+                        buffer_size: int = None) -> AsyncIterator[Tuple[int, Optional[str]]]:
+        """
+        Async variant of iter_api, for use with `async for`.
+        """
+        self._check_scheduler("aiter_api()")
+        items = data.items() if isinstance(data, dict) else data
+        process_bar = self._progress_bar(total=len(items) if hasattr(items, "__len__") else None)
+        try:
+            async for pair in iter_request_openai_async(
+                items=items,
+                openai_model=self.openai_model,
+                key_manager=self.key_manager,
+                concurrency=self.threads,
+                max_retries=self.max_retries,
+                process_bar=process_bar,
+                output_path=self.output_path,
+                ordered=ordered,
+                buffer_size=buffer_size,
+                cache=self.cache,
+                retry_policy=self.retry_policy,
+                packer=self.packer,
+                http_client=self.http_client,
+            ):
+                yield pair
+        finally:
+            process_bar.close()
+
+    def _check_scheduler(self, engine: str):
+        """
+        Only run() and parallel_api() order their work with the scheduler, as the other engines take
+        items in the order they are read.
+        """
+        if self.scheduler:
+            raise ValueError(f"scheduler is supported by run() and parallel_api() only, not by {engine}")
+
+    def _streaming_model(self) -> OpenAIModel:
+        if self.openai_model.stream:
+            return self.openai_model
+        # A shallow copy shares the token counter and settings with the model of the other calls
+        model = copy.copy(self.openai_model)
+        model.stream = True
+        return model
+
+    def plan(self) -> Optional[CapacityPlan]:
+        """
+        Plan the items of input_path that have no result yet, without sending any request: the best
+        achievable throughput, the ETA and how many requests today's quota cannot cover (see CapacityPlanner).
+        With coordinator_address, the budgets are those of the coordinator's whole pool.
+        """
+        with PromptDataset(self.input_path) as dataset:
+            data = dataset.select(shard=self.shard)
+            data = data.select(skip=self.checkpoint if self.checkpoint else read_processed_indexes(self.output_path))
+            threads = max(min(len(data), self.threads, self.key_manager.get_key_length()), 1)
+            return (self.planner or CapacityPlanner()).plan(self.key_manager, self.openai_model, items=data.items(),
+                                                            count=len(data), threads=threads)
+
+    def metrics(self) -> dict:
+        """
+        JSON-serialisable snapshot of the runtime metrics: latencies, key waits, retries, key counts and tokens.
+        """
+        return METRICS.snapshot()
+
+    def export_trace(self, path: str = None) -> int:
+        """
+        Write the spans recorded so far (see Tracer) as a Chrome trace, to open in chrome://tracing or
+        https://ui.perfetto.dev.
+        Args:
+            path (str): Output file, trace_path by default.
+        Returns:
+            int: Number of spans written.
+        """
+        path = path or self.trace_path
+        count = TRACER.export_chrome(path)
+        logging.warning(f"{LOG_LABEL}Wrote {count} trace spans to {path}")
+        return count
+
+    def merge(self, merged_file, indent: int = 4, presorted: bool = False):
+        """
+        Write the input objects with their results to merged_file as a JSON array (see merge_jsonl_files).
+        With a checkpoint, its results are exported to output_path first.
+        """
+        if self.checkpoint:
+            self.export()
+        merge_jsonl_files(self.input_path, self.output_path, merged_file, indent=indent, presorted=presorted)
+
 
-    def merge(self, merged_file):
-        merge_jsonl_files(self.input_path, self.output_path, merged_file)
+def _run_shard_process(options: dict, checkpoint_path: str, trace_path: str, name: str, shard: int,
+                       num_shards: int, stream: bool):
+    if checkpoint_path:
+        checkpoint_path = shard_path(checkpoint_path, shard, num_shards)
+    if trace_path:
+        trace_path = shard_path(trace_path, shard, num_shards)
+    toolkit = ParallelToolkit(config_path=None, checkpoint_path=checkpoint_path, trace_path=trace_path,
+                              name=f"{name} [{shard}]", **options)
+    toolkit.run_shard(shard, num_shards, stream=stream)
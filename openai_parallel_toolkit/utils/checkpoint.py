@@ -0,0 +1,99 @@
+import os
+import sqlite3
+import threading
+
+from openai_parallel_toolkit.utils import fastjson
+
+
+class Checkpoint:
+    """
+    Index of finished items kept in SQLite (WAL mode), so resuming answers "is index X done?" with a
+    primary key lookup instead of scanning output.jsonl. Failures are recorded as NULL outputs and
+    simply overwritten when the item succeeds on a later run.
+    """
+
+    def __init__(self, path: str, durable: bool = False):
+        """
+        Args:
+            path (str): SQLite database file.
+            durable (bool): Sync every commit to disk (synchronous=FULL) instead of only at WAL checkpoints.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=%s" % ("FULL" if durable else "NORMAL"))
+        self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS results (idx TEXT PRIMARY KEY, position INTEGER, output TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_position ON results (position, idx)")
+        self.conn.commit()
+
+    def __contains__(self, index) -> bool:
+        """
+        Whether the index has a successful result.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                    "SELECT 1 FROM results WHERE idx = ? AND output IS NOT NULL", (str(index),)
+            ).fetchone()
+        return row is not None
+
+    def record(self, index, result):
+        self.record_many([(index, result)])
+
+    def record_many(self, items):
+        """
+        Record (index, result) pairs. A None result marks the item as failed.
+        """
+        rows = [(str(index), _position(index), None if result is None else fastjson.dumps(result))
+                for index, result in items]
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", rows)
+            self.conn.commit()
+
+    def count_done(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM results WHERE output IS NOT NULL").fetchone()[0]
+
+    def count_failed(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM results WHERE output IS NULL").fetchone()[0]
+
+    def import_jsonl(self, path: str):
+        """
+        Seed the checkpoint from an existing output file, ignoring failed items.
+        """
+        if not os.path.exists(path):
+            return
+        batch = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                batch.extend((index, result) for index, result in fastjson.loads(line).items()
+                             if result is not None)
+                if len(batch) >= 10000:
+                    self.record_many(batch)
+                    batch = []
+        self.record_many(batch)
+
+    def export_jsonl(self, path: str):
+        """
+        Write all results sorted by index. SQLite walks the position index (or sorts with temporary
+        B-trees on disk), so the export never holds the whole dataset in memory.
+        """
+        tmp_path = path + ".exporting"
+        with self.lock, open(tmp_path, "w", encoding="utf-8") as f:
+            for index, output in self.conn.execute("SELECT idx, output FROM results ORDER BY position, idx"):
+                f.write('{%s: %s}\n' % (fastjson.dumps(index), output or "null"))
+        os.replace(tmp_path, path)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def _position(index):
+    try:
+        return int(index)
+    except (TypeError, ValueError):
+        return None
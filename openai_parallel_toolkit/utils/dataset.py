@@ -0,0 +1,231 @@
+import mmap
+from array import array
+from typing import Iterator, Optional, Tuple
+
+from openai_parallel_toolkit.utils import fastjson
+from openai_parallel_toolkit.utils.reader import shard_of
+
+
+class LazyPrompt:
+    """
+    Reads like a Prompt, but only the position of its line is kept: instruction comes from the dataset's
+    table and input is read from the file each time it is accessed.
+    """
+    __slots__ = ("dataset", "position")
+
+    def __init__(self, dataset: "PromptDataset", position: int):
+        self.dataset = dataset
+        self.position = position
+
+    @property
+    def instruction(self) -> str:
+        return self.dataset.instructions[self.dataset.instruction_ids[self.position]]
+
+    @property
+    def input(self) -> str:
+        return self.dataset.read(self.position)["input"]
+
+    def __repr__(self):
+        return f"LazyPrompt(index={self.dataset.index(self.position)!r})"
+
+
+class PromptDataset:
+    """
+    Compact, read-only view of an input JSONL file of {"index", "instruction", "input"} lines. Distinct
+    instructions are stored once in a table, and each line costs about 20 bytes: the offset of the line,
+    the number of its instruction and its index, in arrays. Integer indexes, or strings of them, are stored
+    as integers; other indexes in a list. The file is memory-mapped and a line is only parsed again when
+    its input is needed, so large datasets load fast and take little memory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offsets = array("q")
+        self.instruction_ids = array("i")
+        self.instructions = []  # Table of distinct instructions
+        numbers = array("q")  # Indexes while they are all integers or strings of integers
+        index_type = None  # int or str while numbers are used
+        indexes = None  # Any other indexes
+        in_order = True  # Whether numbers are sorted
+        instruction_ids = {}
+        # Bound once: this loop runs for every line of files with millions of them
+        loads = fastjson.loads
+        append_offset = self.offsets.append
+        append_instruction_id = self.instruction_ids.append
+        previous = None
+        with open(path, "rb") as f:
+            offset = 0
+            for line in f:
+                if line.isspace():
+                    offset += len(line)
+                    continue
+                obj = loads(line)
+                try:
+                    index = obj["index"]
+                except KeyError:
+                    raise ValueError(f"Line at byte {offset} of {path} has no index") from None
+                if numbers is not None:
+                    if type(index) is index_type and index_type is int:
+                        number = index
+                    else:
+                        number = _as_number(index, index_type)
+                    if number is None:
+                        indexes = [self._from_number(number, index_type) for number in numbers]
+                        numbers = None
+                    else:
+                        index_type = type(index)
+                        if previous is not None and number < previous:
+                            in_order = False
+                        previous = number
+                        numbers.append(number)
+                if numbers is None:
+                    indexes.append(index)
+                instruction = obj.get("instruction")
+                instruction_id = instruction_ids.get(instruction)
+                if instruction_id is None:
+                    instruction_id = instruction_ids[instruction] = len(self.instructions)
+                    self.instructions.append(instruction)
+                append_offset(offset)
+                append_instruction_id(instruction_id)
+                offset += len(line)
+        self.numbers = numbers
+        self.index_type = index_type
+        self.indexes = indexes
+        # Positions sorted by index for find, built on the first call unless the file is sorted already
+        self.order = range(len(self.offsets)) if in_order else None
+        self.positions = None  # index -> position for indexes that are not integers
+        self.file = open(path, "rb")
+        # An empty file cannot be mapped
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if offset else None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.file.close()
+
+    def index(self, position: int):
+        """
+        The index of the line at position, as written in the file.
+        """
+        if self.indexes is not None:
+            return self.indexes[position]
+        return self._from_number(self.numbers[position], self.index_type)
+
+    def prompt(self, position: int) -> LazyPrompt:
+        return LazyPrompt(self, position)
+
+    def read(self, position: int) -> dict:
+        """
+        Parse the line at position.
+        """
+        start = self.offsets[position]
+        end = self.mmap.find(b"\n", start)
+        return fastjson.loads(self.mmap[start:end if end >= 0 else len(self.mmap)])
+
+    def items(self) -> Iterator[Tuple[object, LazyPrompt]]:
+        return ((self.index(position), LazyPrompt(self, position)) for position in range(len(self)))
+
+    def select(self, skip=None, shard: Tuple[int, int] = None) -> "DatasetSubset":
+        """
+        The lines whose index is not in skip (e.g. a set of processed indexes or a Checkpoint), and that
+        belong to shard, a (shard, num_shards) pair.
+        """
+        return DatasetSubset(self, array("q", range(len(self)))).select(skip, shard)
+
+    def find(self, index) -> Optional[int]:
+        """
+        Position of the last line with the index, compared as strings like the keys of an output file,
+        or None.
+        """
+        if self.indexes is not None:
+            if self.positions is None:
+                self.positions = {str(index): position for position, index in enumerate(self.indexes)}
+            return self.positions.get(str(index))
+        number = _as_number(str(index), str)
+        if number is None:
+            return None
+        if self.order is None:
+            self.order = array("q", sorted(range(len(self.numbers)), key=self.numbers.__getitem__))
+        # Last position with a number <= the one searched for
+        low, high = 0, len(self.order)
+        while low < high:
+            middle = (low + high) // 2
+            if self.numbers[self.order[middle]] <= number:
+                low = middle + 1
+            else:
+                high = middle
+        if low and self.numbers[self.order[low - 1]] == number:
+            return self.order[low - 1]
+        return None
+
+    @staticmethod
+    def _from_number(number, index_type):
+        return str(number) if index_type is str else number
+
+
+class DatasetSubset:
+    """
+    Some lines of a PromptDataset, held as an array of positions. Offers items() and len() like the dicts
+    the engines take.
+    """
+
+    def __init__(self, dataset: PromptDataset, positions: array):
+        self.dataset = dataset
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def items(self) -> Iterator[Tuple[object, LazyPrompt]]:
+        dataset = self.dataset
+        return ((dataset.index(position), LazyPrompt(dataset, position)) for position in self.positions)
+
+    def select(self, skip=None, shard: Tuple[int, int] = None) -> "DatasetSubset":
+        """
+        See PromptDataset.select.
+        """
+        if skip is None and shard is None:
+            return self
+        dataset = self.dataset
+        index = dataset.index
+        positions = array("q")
+        append = positions.append
+        for position in self.positions:
+            value = index(position)
+            if skip is not None and value in skip:
+                continue
+            if shard is not None and shard_of(value, shard[1]) != shard[0]:
+                continue
+            append(position)
+        return DatasetSubset(dataset, positions)
+
+
+def _as_number(index, index_type) -> Optional[int]:
+    """
+    index as an integer if it can be stored as one: an int, or a str that converts back to the same str,
+    of the same type as the indexes so far.
+    """
+    if index_type is not None and type(index) is not index_type:
+        return None
+    if type(index) is int:
+        number = index
+    elif type(index) is str:
+        # Checked instead of comparing str(int(index)) with index, which is slower: "007", "+7" or " 7"
+        # would not round-trip
+        digits = index[1:] if index[:1] == "-" else index
+        if not (digits.isascii() and digits.isdecimal()) or (digits[0] == "0" and index != "0"):
+            return None
+        number = int(index)
+    else:
+        return None
+    return number if -(1 << 63) <= number < (1 << 63) else None
@@ -0,0 +1,44 @@
+import json
+
+# JSON for the dataset files: orjson when it is installed, the standard json module otherwise. Both write
+# UTF-8 text without escaping non-ASCII characters and accept non-string keys such as integer indexes.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson else "json"
+
+
+# Parse a str or bytes document, e.g. one line of a JSONL file. The backend's function itself rather than a
+# wrapper, as it is called for every line
+loads = orjson.loads if orjson else json.loads
+
+
+def dumps(obj, indent: int = None) -> str:
+    """
+    Serialize to a str. orjson only indents by 2 spaces, so other even indents widen its output (see
+    _reindent). Odd indents use the json module.
+    """
+    if orjson and not (indent or 0) % 2:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        text = orjson.dumps(obj, option=option).decode("utf-8")
+        if indent and indent != 2:
+            text = _reindent(text, indent)
+        return text
+    return json.dumps(obj, ensure_ascii=False, indent=indent)
+
+
+def _reindent(text: str, indent: int) -> str:
+    """
+    Turn 2-space indentation into indent spaces. Every newline in JSON output starts an indented line,
+    as newlines inside strings are escaped. Pass k adds the missing spaces of depth k to every line at
+    depth k or deeper, so each pass is a single str.replace.
+    """
+    depth = 1
+    while True:
+        old = "\n" + " " * (indent * (depth - 1) + 2)
+        if old not in text:
+            return text
+        text = text.replace(old, old + " " * (indent - 2))
+        depth += 1
@@ -0,0 +1,71 @@
+import atexit
+import sqlite3
+import threading
+
+FIELDS = ("day_start", "day_count", "exhausted_until", "revoked", "limited_at")
+
+
+class KeyLedger:
+    """
+    Per-key health kept in SQLite across runs: requests sent in the current day, when a key that hit
+    its daily limit is usable again, revoked keys and the last unexpected rate limit.
+    Updates only touch a dict; a background thread writes the changed keys every flush_interval seconds.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0):
+        """
+        Args:
+            path (str): SQLite database file.
+            flush_interval (float): Seconds between writes of changed keys.
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, day_start REAL, day_count INTEGER, "
+                "exhausted_until REAL, revoked INTEGER, limited_at REAL)"
+        )
+        self.conn.commit()
+        self.rows = {row[0]: dict(zip(FIELDS, row[1:])) for row in self.conn.execute("SELECT * FROM keys")}
+        self.dirty = set()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._loop, name="KeyLedger", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def get(self, key) -> dict:
+        with self.lock:
+            return dict(self.rows.get(key) or {})
+
+    def update(self, key, **fields):
+        """
+        Change some fields of a key. Written to disk by the next flush.
+        """
+        with self.lock:
+            row = self.rows.setdefault(key, dict.fromkeys(FIELDS, 0))
+            row.update(fields)
+            self.dirty.add(key)
+
+    def flush(self):
+        with self.lock:
+            rows = [(key, *(self.rows[key][field] for field in FIELDS)) for key in self.dirty]
+            self.dirty.clear()
+            if rows:
+                self.conn.executemany("INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?, ?, ?)", rows)
+                self.conn.commit()
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.thread.join()
+        self.flush()
+        with self.lock:
+            self.conn.close()
+
+    def _loop(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
@@ -18,11 +18,13 @@ class LogFilter(logging.Filter):
         self.label = label
 
     def filter(self, record):
-        if self.label in record.getMessage():
-            record.msg = record.msg.replace(self.label, '')
+        # The toolkit's messages start with the label, so check the prefix of the raw message instead
+        # of formatting every record and searching it
+        msg = record.msg
+        if isinstance(msg, str) and msg.startswith(self.label):
+            record.msg = msg[len(self.label):]
             return True
-        else:
-            return False
+        return False
 
 
 class Logger:
@@ -0,0 +1,197 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+class Counter:
+    """
+    Monotonic counter, optionally split by one label. Updates take no lock: they rely on the GIL,
+    so a rare increment may be lost under heavy contention, which is fine for monitoring.
+    """
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, amount=1, label=None):
+        self.values[label] = self.values.get(label, 0) + amount
+
+    def collect(self):
+        return {str(label) if label is not None else "": value for label, value in self.values.items()}
+
+
+class Gauge:
+    """
+    Value read from a callback at collection time, so the hot path does not update it at all.
+    """
+
+    def __init__(self, name, help, callback=None):
+        self.name = name
+        self.help = help
+        self.callback = callback
+
+    def collect(self):
+        return {"": self.callback() if self.callback else 0}
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram, optionally split by one label.
+    """
+
+    def __init__(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.series = {}  # label -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, label=None):
+        series = self.series.get(label)
+        if series is None:
+            series = self.series.setdefault(label, [0] * (len(self.buckets) + 2))
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def collect(self):
+        result = {}
+        for label, series in list(self.series.items()):
+            counts = series[:-1]
+            total = sum(counts)
+            result[str(label) if label is not None else ""] = {
+                "count": total,
+                "sum": series[-1],
+                "buckets": dict(zip([str(bucket) for bucket in self.buckets] + ["+Inf"], _cumulative(counts))),
+                "p50": _quantile(self.buckets, counts, total, 0.5),
+                "p99": _quantile(self.buckets, counts, total, 0.99),
+            }
+        return result
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.started = time.time()
+        self.server = None
+
+    def counter(self, name, help, label=None) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, help, label))
+
+    def histogram(self, name, help, label=None, buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help, label, buckets))
+
+    def gauge(self, name, help, callback) -> Gauge:
+        gauge = self.metrics.setdefault(name, Gauge(name, help))
+        gauge.callback = callback
+        return gauge
+
+    def snapshot(self) -> dict:
+        uptime = time.time() - self.started
+        snapshot = {"uptime_seconds": uptime}
+        for name, metric in list(self.metrics.items()):
+            snapshot[name] = metric.collect()
+        tokens = snapshot.get("openai_tokens_total", {}).get("", 0)
+        snapshot["openai_tokens_per_second"] = tokens / uptime if uptime > 0 else 0
+        return snapshot
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for name, metric in list(self.metrics.items()):
+            kind = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}[type(metric)]
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for label, value in metric.collect().items():
+                labels = f'{metric.label}="{label}"' if label and getattr(metric, "label", None) else ""
+                if kind != "histogram":
+                    lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+                    continue
+                for bound, count in value["buckets"].items():
+                    bucket_labels = ",".join(filter(None, [labels, f'le="{bound}"']))
+                    lines.append(f"{name}_bucket{{{bucket_labels}}} {count}")
+                suffix = f"{{{labels}}}" if labels else ""
+                lines.append(f"{name}_sum{suffix} {value['sum']}")
+                lines.append(f"{name}_count{suffix} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        """
+        Serve /metrics (Prometheus text) and /metrics.json from a daemon thread.
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith("/metrics.json"):
+                    body, content_type = json.dumps(registry.snapshot()).encode(), "application/json"
+                elif self.path.startswith("/metrics"):
+                    body, content_type = registry.to_prometheus().encode(), "text/plain; version=0.0.4"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="MetricsServer", daemon=True).start()
+        return self.server
+
+
+def key_label(key: str) -> str:
+    """
+    Label for a key that does not leak it: only its last four characters.
+    """
+    return "..." + key[-4:] if key else ""
+
+
+def _cumulative(counts):
+    total = 0
+    result = []
+    for count in counts:
+        total += count
+        result.append(total)
+    return result
+
+
+def _quantile(buckets, counts, total, q):
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for bound, count in zip(list(buckets) + [float("inf")], counts):
+        seen += count
+        if seen >= rank:
+            return bound
+    return float("inf")
+
+
+METRICS = MetricsRegistry()
+
+REQUEST_SECONDS = METRICS.histogram("openai_request_seconds", "Latency of successful OpenAI requests")
+KEY_REQUEST_SECONDS = METRICS.histogram("openai_key_request_seconds", "Latency of OpenAI requests per key",
+                                        label="key")
+TIME_TO_FIRST_TOKEN = METRICS.histogram("openai_time_to_first_token_seconds",
+                                        "Time to the first token of streamed requests per key", label="key")
+KEY_WAIT_SECONDS = METRICS.histogram("openai_key_wait_seconds", "Time spent waiting for a key in get_new_key")
+RETRIES = METRICS.counter("openai_retries_total", "Failed attempts by error class", label="kind")
+REQUESTS = METRICS.counter("openai_requests_total", "Finished items by outcome", label="outcome")
+PACKED_ITEMS = METRICS.counter("openai_packed_items_total", "Items sent in packed requests by outcome",
+                               label="outcome")
+HEDGES = METRICS.counter("openai_hedges_total", "Hedged requests: duplicates sent and duplicates that won",
+                         label="outcome")
+TOKENS = METRICS.counter("openai_tokens_total", "Tokens reported by successful responses")
+WRITE_SECONDS = METRICS.histogram("writer_batch_seconds", "Time spent writing a batch of results",
+                                  buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+WRITE_BATCH = METRICS.histogram("writer_batch_size", "Results per written batch",
+                                buckets=(1, 8, 32, 128, 512, 2048))
@@ -4,12 +4,19 @@ from tqdm import tqdm
 
 
 class ProgressBar:
-    def __init__(self, initial=0, total=0, desc="Progress"):
+    def __init__(self, initial=0, total=0, desc="Progress", postfix=None):
+        """
+        Args:
+            postfix (callable): Returns a short status shown after the bar, refreshed on every update.
+        """
         self.lock = threading.Lock()
+        self.postfix = postfix
         self.progress_bar = tqdm(total=total, desc=desc, initial=initial, smoothing=0.1)
 
     def update(self, n=1):
         with self.lock:
+            if self.postfix:
+                self.progress_bar.set_postfix_str(self.postfix(), refresh=False)
             self.progress_bar.update(n)
 
     def close(self):
@@ -1,8 +1,13 @@
+import heapq
 import json
 import os
-from typing import Dict
+import shutil
+import tempfile
+import zlib
+from typing import Dict, Iterator, List, Set, Tuple
 
 from openai_parallel_toolkit.api.model import Prompt
+from openai_parallel_toolkit.utils import fastjson
 
 
 def read_config(config_path: str) -> (str, str):
@@ -15,16 +20,129 @@ def read_config(config_path: str) -> (str, str):
     return api_keys, api_base
 
 
+def read_rate_limits(config_path: str = None) -> Dict[str, int]:
+    """
+    Per-key limits from the optional "rate_limits" section of config.json.
+    Defaults match the limits of a $5 account.
+    """
+    limits = {"rpm": 3, "tpm": 40000, "rpd": 200}
+    if config_path:
+        with open(config_path, "r") as f:
+            config = json.load(f)
+        limits.update(config.get("rate_limits", {}))
+    return limits
+
+
+def read_endpoints(config_path: str) -> List[Dict]:
+    """
+    Endpoints from the optional "endpoints" section of config.json. Each has an api_base, its own api_keys,
+    and optionally a name and rate_limits, which default to the api_base and the top-level rate_limits.
+    Returns an empty list when config.json has a single api_base.
+    """
+    with open(config_path, "r") as f:
+        config = json.load(f)
+    limits = read_rate_limits(config_path)
+    return [{"name": endpoint.get("name", endpoint["api_base"]), "api_base": endpoint["api_base"],
+             "api_keys": endpoint["api_keys"], "rate_limits": {**limits, **endpoint.get("rate_limits", {})}}
+            for endpoint in config.get("endpoints", [])]
+
+
 def read_jsonl_to_dict(jsonl_file: str) -> Dict[int, Prompt]:
     new_dict = {}
     with open(jsonl_file, "r", encoding="utf-8") as f:
         for line in f:
-            obj = json.loads(line)
+            obj = fastjson.loads(line)
             index = obj["index"]
             new_dict[index] = Prompt(instruction=obj["instruction"], input=obj["input"])
     return new_dict
 
 
+def iter_jsonl_prompts(jsonl_file: str, skip: Set = None) -> Iterator[Tuple[str, Prompt]]:
+    """
+    Lazily yield (index, Prompt) pairs from an input file, skipping indexes in skip.
+    """
+    with open(jsonl_file, "r", encoding="utf-8") as f:
+        for line in f:
+            obj = fastjson.loads(line)
+            index = obj["index"]
+            if skip and index in skip:
+                continue
+            yield index, Prompt(instruction=obj["instruction"], input=obj["input"])
+
+
+class IndexSet:
+    """
+    Set of result indexes for resuming. Indexes that are non-negative integers, or strings of them, are
+    kept as bits of a bytearray indexed by their value, an eighth of a byte each instead of a string in a
+    set; other indexes in a set. An int and the string of it are the same index, as output files
+    store indexes as JSON keys.
+    """
+    MAX_BITS = 1 << 28  # Larger numbers go in the set, so one huge index cannot allocate the bitmap
+
+    def __init__(self):
+        self.bits = bytearray()
+        self.others = set()
+        self.count = 0
+
+    def add(self, index):
+        number = _bit_number(index)
+        if number is None:
+            if index not in self.others:
+                self.others.add(index)
+                self.count += 1
+            return
+        byte, mask = number >> 3, 1 << (number & 7)
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(max(byte + 1 - len(self.bits), len(self.bits))))
+        if not self.bits[byte] & mask:
+            self.bits[byte] |= mask
+            self.count += 1
+
+    def __contains__(self, index) -> bool:
+        number = _bit_number(index)
+        if number is None:
+            return index in self.others
+        byte = number >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (number & 7)))
+
+    def __len__(self):
+        return self.count
+
+
+def _bit_number(index):
+    if type(index) is str:
+        if not (index.isascii() and index.isdecimal()) or (index[0] == "0" and index != "0"):
+            return None
+        index = int(index)
+    elif type(index) is not int:
+        return None
+    return index if 0 <= index < IndexSet.MAX_BITS else None
+
+
+def read_processed_indexes(path: str) -> IndexSet:
+    """
+    Indexes that already have a non-null result in the output file.
+    """
+    processed = IndexSet()
+    if not os.path.exists(path):
+        return processed
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            item = fastjson.loads(line)
+            for key, value in item.items():
+                if value is not None:
+                    processed.add(key)
+    return processed
+
+
+def count_lines(path: str) -> int:
+    count = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            count += block.count(b"\n")
+    return count
+
+
 def filter(data: dict, path) -> dict:
     data_copy = data.copy()
 
@@ -33,7 +151,7 @@ def filter(data: dict, path) -> dict:
 
     with open(path, "r", encoding="utf-8") as f:
         for line in f:
-            item = json.loads(line)
+            item = fastjson.loads(line)
             key = list(item.keys())[0]
             if key in data_copy:
                 del data_copy[key]
@@ -41,45 +159,68 @@ def filter(data: dict, path) -> dict:
     return data_copy
 
 
-def read_sort_write_jsonl(path: str):
-    data = []
+def read_sort_write_jsonl(path: str, chunk_size: int = 1000000):
+    """
+    Sort an output file by index in place. Files with more than chunk_size lines are sorted as an
+    external merge: sorted runs are spilled to temporary files and merged back with heapq.merge.
+    """
+    runs = []
+    handles = []
+    chunk = []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                chunk.append((int(next(iter(fastjson.loads(line)))), line))
+                if len(chunk) >= chunk_size:
+                    runs.append(_spill_run(chunk, os.path.dirname(os.path.abspath(path))))
+                    chunk = []
+        chunk.sort(key=lambda x: x[0])
+        if not runs:
+            sorted_lines = (line for _, line in chunk)
+        else:
+            handles = [open(run, "r", encoding="utf-8") for run in runs]
+            sorted_lines = heapq.merge((line for _, line in chunk), *handles,
+                                       key=lambda line: int(next(iter(fastjson.loads(line)))))
+        tmp_path = path + ".sorting"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(sorted_lines)
+        os.replace(tmp_path, path)
+    finally:
+        for handle in handles:
+            handle.close()
+        for run in runs:
+            os.remove(run)
 
-    with open(path, "r") as f:
-        for line in f:
-            item = json.loads(line)
-            data.append((int(list(item.keys())[0]), list(item.values())[0]))
-    data.sort(key=lambda x: x[0])
 
-    with open(path, "w", encoding="utf-8") as f:
-        for key, value in data:
-            json.dump({key: value}, f, ensure_ascii=False)
-            f.write("\n")
+def _spill_run(chunk, directory) -> str:
+    chunk.sort(key=lambda x: x[0])
+    fd, run = tempfile.mkstemp(suffix=".jsonl", dir=directory)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.writelines(line for _, line in chunk)
+    return run
 
 
 def remove_nulls_from_jsonl(file_path):
+    """
+    Drop the lines with a null result, copying the others line by line to a temporary file that then
+    replaces the output file.
+    """
     if not os.path.exists(file_path):
         return
-    non_null_data = []
-
-    # Read non-null data into a list.
-    with open(file_path, "r", encoding="utf-8") as f:
+    tmp_path = file_path + ".cleaning"
+    with open(file_path, "r", encoding="utf-8") as f, open(tmp_path, "w", encoding="utf-8") as out:
         for line in f:
-            data = json.loads(line)
-            if any(value is None for value in data.values()):
+            if not line.strip() or any(value is None for value in fastjson.loads(line).values()):
                 continue
-            non_null_data.append(data)
-
-    # Write the non-null data back to the file.
-    with open(file_path, "w") as f:
-        for data in non_null_data:
-            f.write(json.dumps(data, ensure_ascii=False) + "\n")
+            out.write(line if line.endswith("\n") else line + "\n")
+    os.replace(tmp_path, file_path)
 
 
 def jsonl_to_dict_special(filename):
     with open(filename, "r", encoding="utf-8") as file:
         data = {}
         for line in file:
-            json_data = json.loads(line.strip())
+            json_data = fastjson.loads(line.strip())
             if "index" in json_data.keys():
                 data[json_data["index"]] = json_data
             else:
@@ -87,26 +228,142 @@ def jsonl_to_dict_special(filename):
         return data
 
 
-def merge_jsonl_files(input_file, output_file, merged_file):
-    input = jsonl_to_dict_special(input_file)
-    output = jsonl_to_dict_special(output_file)
-    # Combine the dictionaries
-    merged = []
-    for key, value in output.items():
-        if key in input:
-            temp = input[key].copy()  # Make a copy to prevent changing the original dictionary
-            temp.update({"output": value})
-            merged.append(temp)  # Directly merge the inner objects
+def shard_of(index, num_shards: int) -> int:
+    """
+    Shard an index belongs to: integer indexes are dealt round-robin, other indexes by a stable hash.
+    """
+    try:
+        return int(index) % num_shards
+    except (TypeError, ValueError):
+        return zlib.crc32(str(index).encode("utf-8")) % num_shards
+
+
+def shard_path(path: str, shard: int, num_shards: int) -> str:
+    """
+    Output file of one shard, e.g. output.jsonl -> output.shard-1-of-4.jsonl
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard-{shard}-of-{num_shards}{ext}"
 
-    # Save the result to a new json file
+
+def merge_shard_outputs(path: str, num_shards: int):
+    """
+    Combine the output files of all shards into path, sorted by index.
+    """
+    tmp_path = path + ".merging"
+    with open(tmp_path, "w", encoding="utf-8") as out:
+        for shard in range(num_shards):
+            shard_file = shard_path(path, shard, num_shards)
+            if os.path.exists(shard_file):
+                with open(shard_file, "r", encoding="utf-8") as f:
+                    shutil.copyfileobj(f, out)
+    os.replace(tmp_path, path)
+    read_sort_write_jsonl(path)
+
+
+def merge_jsonl_files(input_file, output_file, merged_file, indent: int = 4, presorted: bool = False):
+    """
+    Write a JSON array of the input objects, each with an "output" field holding its result, in the
+    order of the output file. The array is written element by element: by default the input file is
+    loaded as a PromptDataset, which only holds the indexes and offsets of its lines in arrays, and each
+    input line is read back when its result comes up.
+    Args:
+        indent (int): Indentation of the merged file, None for one object per line. Without orjson,
+            indenting is done in pure Python and takes most of the time.
+        presorted (bool): Both files are sorted by integer index, as output files are after a run. They
+            are then walked side by side and no index is built at all.
+    """
+    pairs = _merge_presorted(input_file, output_file) if presorted else _merge_indexed(input_file, output_file)
     with open(merged_file, "w", encoding="utf-8") as f:
-        json.dump(merged, f, ensure_ascii=False, indent=4)
+        first = True
+        for obj, value in pairs:
+            obj = dict(obj, output=value)
+            text = fastjson.dumps(obj, indent=indent)
+            if indent:
+                text = text.replace("\n", "\n" + " " * indent)
+                f.write(("[\n" if first else ",\n") + " " * indent + text)
+            else:
+                f.write(("[" if first else ", ") + text)
+            first = False
+        f.write("[]" if first else "\n]" if indent else "]")
+
+
+def _iter_results(output_file) -> Iterator[Tuple[str, object]]:
+    """
+    (index, result) pairs of an output file. A repeated index directly after itself (a failure followed
+    by its retry in a sorted file) only yields the last result.
+    """
+    previous = None
+    with open(output_file, "rb") as f:
+        for line in f:
+            for key, value in fastjson.loads(line).items():
+                if previous is not None and previous[0] != key:
+                    yield previous
+                previous = (key, value)
+    if previous is not None:
+        yield previous
+
+
+def _input_objects(obj: dict):
+    """
+    (index, object) pairs of one input line: a prompt with an "index" field, or {index: object} entries.
+    """
+    if "index" in obj:
+        return [(str(obj["index"]), obj)]
+    return [(str(key), value) for key, value in obj.items()]
+
+
+def _merge_indexed(input_file, output_file):
+    # Imported here because dataset imports this module
+    from openai_parallel_toolkit.utils.dataset import PromptDataset
+
+    try:
+        dataset = PromptDataset(input_file)
+    except ValueError:
+        # Lines of {index: object} entries rather than prompts with an index field
+        yield from _merge_keyed(input_file, output_file)
+        return
+    with dataset:
+        for key, value in _iter_results(output_file):
+            position = dataset.find(key)
+            if position is not None:
+                yield dataset.read(position), value
+
+
+def _merge_keyed(input_file, output_file):
+    offsets = {}
+    with open(input_file, "rb") as f:
+        offset = 0
+        for line in f:
+            for index, _ in _input_objects(fastjson.loads(line)):
+                offsets[index] = offset
+            offset += len(line)
+    with open(input_file, "rb") as f:
+        for key, value in _iter_results(output_file):
+            offset = offsets.get(key)
+            if offset is None:
+                continue
+            f.seek(offset)
+            yield dict(_input_objects(fastjson.loads(f.readline())))[key], value
+
+
+def _merge_presorted(input_file, output_file):
+    with open(input_file, "rb") as f:
+        objects = (pair for line in f for pair in _input_objects(fastjson.loads(line)))
+        current = next(objects, None)
+        for key, value in _iter_results(output_file):
+            while current is not None and int(current[0]) < int(key):
+                current = next(objects, None)
+            if current is None:
+                break
+            if current[0] == key:
+                yield current[1], value
 
 
 def count_null_values(filename):
     count = 0
     with open(filename, "r") as file:
         for line in file:
-            data = json.loads(line)
+            data = fastjson.loads(line)
             count += sum(1 for value in data.values() if value is None)
     return count
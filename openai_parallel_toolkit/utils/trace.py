@@ -0,0 +1,120 @@
+import asyncio
+import itertools
+import json
+import os
+import threading
+import time
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "index", "track", "start")
+
+    def __init__(self, tracer, name, index, track):
+        self.tracer = tracer
+        self.name = name
+        self.index = index
+        self.track = track
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tracer.add(self.name, self.start, time.monotonic(), self.index, self.track,
+                        {"error": exc_type.__name__} if exc_type else None)
+        return False
+
+
+class Tracer:
+    """
+    Records spans (name, start, end) of each item's life: waiting in the queue, waiting for a key,
+    HTTP calls, backoffs and writes. Spans go into a fixed-size ring buffer without taking a lock:
+    a slot is claimed with next() on an itertools.count, which is atomic under the GIL. Once the
+    buffer is full the oldest spans are overwritten. When disabled, every call returns at once.
+    Export with export_chrome and open the file in chrome://tracing or https://ui.perfetto.dev.
+    """
+
+    def __init__(self, capacity: int = 1 << 16, enabled: bool = False):
+        self.capacity = capacity
+        self.enabled = enabled
+        self.spans = [None] * capacity
+        self.counter = itertools.count()
+
+    def enable(self, capacity: int = None):
+        """
+        Start recording, clearing the spans recorded so far.
+        """
+        if capacity:
+            self.capacity = capacity
+        self.spans = [None] * self.capacity
+        self.counter = itertools.count()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clock(self):
+        """
+        A start time for add, or None when disabled.
+        """
+        return time.monotonic() if self.enabled else None
+
+    def task_track(self):
+        """
+        Track of the running asyncio task, so that concurrent coroutines get a row each, or None when
+        disabled.
+        """
+        return id(asyncio.current_task()) if self.enabled else None
+
+    def span(self, name: str, index=None, track=None):
+        """
+        Context manager recording the time spent in the block. Spans of the same track (the current
+        thread by default; the engines pass the task for coroutines) are drawn on one row.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, name, index, track)
+
+    def add(self, name: str, start: float, end: float, index=None, track=None, args: dict = None):
+        if not self.enabled or start is None:
+            return
+        slot = next(self.counter) % self.capacity
+        self.spans[slot] = (name, start, end, track or threading.get_ident(), index, args)
+
+    def export_chrome(self, path: str) -> int:
+        """
+        Write the recorded spans in the Chrome trace event format, oldest first.
+        Returns:
+            int: Number of spans written.
+        """
+        spans = sorted((span for span in list(self.spans) if span is not None), key=lambda span: span[1])
+        origin = spans[0][1] if spans else 0
+        pid = os.getpid()
+        tracks = {}
+        events = []
+        for name, start, end, track, index, args in spans:
+            args = dict(args or {})
+            if index is not None:
+                args["index"] = index
+            tid = tracks.setdefault(track, len(tracks) + 1)
+            events.append({"name": name, "ph": "X", "ts": round((start - origin) * 1e6, 1),
+                           "dur": round((end - start) * 1e6, 1), "pid": pid, "tid": tid, "args": args})
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        return len(events)
+
+
+TRACER = Tracer()
@@ -0,0 +1,146 @@
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from openai_parallel_toolkit.utils import fastjson
+from openai_parallel_toolkit.utils.checkpoint import Checkpoint
+from openai_parallel_toolkit.utils.logger import LOG_LABEL
+from openai_parallel_toolkit.utils.metrics import WRITE_BATCH, WRITE_SECONDS
+from openai_parallel_toolkit.utils.trace import TRACER
+
+_CLOSE = object()
+
+
+class ResultWriter:
+    """
+    Dedicated thread that collects results from a queue and writes them in batches (group commit),
+    either appended to a JSONL file that stays open or recorded in a Checkpoint.
+    A batch is written once it reaches batch_size results or flush_interval seconds after its first result.
+    A batch that cannot be written is retried write_retries times; after that the error is raised by close(),
+    so the run fails instead of silently losing the results. The output file is truncated back to where a
+    failed batch started, so a partial write leaves no cut-off line and a retry no duplicates.
+    """
+
+    def __init__(self, output_path: str = None, checkpoint: Checkpoint = None, batch_size: int = 512,
+                 flush_interval: float = 1.0, fsync: bool = False, write_retries: int = 3):
+        """
+        Args:
+            output_path (str): JSONL file the results are appended to, when there is no checkpoint.
+            checkpoint (Checkpoint): Checkpoint the results are recorded in.
+            batch_size (int): Maximum number of results per write.
+            flush_interval (float): Maximum seconds a result waits in the queue.
+            fsync (bool): fsync the output file after every batch instead of only flushing it.
+            write_retries (int): Retries of a failed write, with a growing delay, before giving up on the batch.
+        """
+        self.output_path = output_path
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.write_retries = write_retries
+        self.error = None  # First write that failed for good, raised by close()
+        self.lost = 0  # Results in the batches that could not be written
+        self.queue = queue.SimpleQueue()
+        self.file = None
+        if not checkpoint:
+            # Unbuffered, so nothing of a failed batch is left in a buffer to be written after the truncation
+            self.file = open(output_path, "ab", buffering=0)
+        self.thread = threading.Thread(target=self._loop, name="ResultWriter", daemon=True)
+        self.thread.start()
+
+    def put(self, index, result):
+        self.queue.put((index, result))
+
+    def close(self):
+        """
+        Write everything still queued and stop the thread. Raises the write error if results were lost.
+        """
+        self.queue.put(_CLOSE)
+        self.thread.join()
+        if self.file:
+            self.file.close()
+        if self.error is not None:
+            raise IOError(f"{self.lost} results could not be written, rerun to process them again") from self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _loop(self):
+        closing = False
+        while not closing:
+            item = self.queue.get()
+            if item is _CLOSE:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _CLOSE:
+                    closing = True
+                    break
+                batch.append(item)
+            self._write_with_retries(batch)
+
+    def _write_with_retries(self, batch):
+        offset = self.file.tell() if self.file else None
+        for attempt in range(self.write_retries + 1):
+            started = time.monotonic()
+            try:
+                self._write(batch)
+            except Exception as e:
+                if offset is not None:
+                    self._truncate(offset)
+                if attempt < self.write_retries:
+                    logging.warning(f"{LOG_LABEL}Error occurred while writing {len(batch)} results, retrying: {e}")
+                    time.sleep(0.1 * 2 ** attempt)
+                    continue
+                logging.error(f"{LOG_LABEL}Error occurred while writing {len(batch)} results: {e}")
+                self.lost += len(batch)
+                self.error = self.error or e
+                return
+            ended = time.monotonic()
+            WRITE_SECONDS.observe(ended - started)
+            TRACER.add("write", started, ended, args={"batch": len(batch)})
+            WRITE_BATCH.observe(len(batch))
+            return
+
+    def _write(self, batch):
+        if self.checkpoint:
+            self.checkpoint.record_many(batch)
+            return
+        data = memoryview("".join(fastjson.dumps({index: result}) + "\n" for index, result in batch).encode("utf-8"))
+        while data:
+            data = data[self.file.write(data):]
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def _truncate(self, offset: int):
+        try:
+            self.file.truncate(offset)
+        except OSError as e:
+            logging.error(f"{LOG_LABEL}Could not truncate {self.output_path} after a failed write: {e}")
+
+
+@contextmanager
+def open_writer(output_path: str = None, writer: ResultWriter = None):
+    """
+    Yield the given writer, or a new one for output_path that is closed on exit, or None
+    when results are not written anywhere.
+    """
+    if writer or not output_path:
+        yield writer
+        return
+    with ResultWriter(output_path=output_path) as new_writer:
+        yield new_writer
@@ -0,0 +1,256 @@
+"""
+Local stand-in for the chat completions endpoint, used by the benchmark.
+
+Every key gets the per-minute request and token limits and the per-day request limit of an account,
+and breaking them returns the same error messages as OpenAI. Latency follows a configurable
+distribution, and overload and server errors can be injected at a given rate. Requests with
+"stream": true get server-sent events: the first token arrives after ttft_share of the latency and
+the other tokens are spread over the rest.
+"""
+import json
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RPM_MESSAGE = ("Rate limit reached for default-gpt-3.5-turbo in organization org-bench on requests per min. "
+               "Limit: {limit} / min. Please try again in 20s.")
+TPM_MESSAGE = ("Rate limit reached for default-gpt-3.5-turbo in organization org-bench on tokens per min. "
+               "Limit: {limit} / min. Please try again in 1s.")
+RPD_MESSAGE = ("Rate limit reached for default-gpt-3.5-turbo in organization org-bench on requests per day. "
+               "Limit: {limit} / day. Please try again in 7m12s.")
+QUOTA_MESSAGE = "You exceeded your current quota, please check your plan and billing details."
+OVERLOADED_MESSAGE = ("That model is currently overloaded with other requests. You can retry your request, "
+                      "or contact us through our help center at help.openai.com if the error persists.")
+SERVER_MESSAGE = "The server had an error while processing your request. Sorry about that!"
+CONTEXT_MESSAGE = ("This model's maximum context length is {limit} tokens. However, your messages resulted in "
+                   "{tokens} tokens. Please reduce the length of the messages.")
+
+
+class Latency:
+    """
+    Latency distribution parsed from "fixed:0.2", "uniform:0.1,0.5" or "lognormal:0.3,0.5"
+    (median seconds and sigma).
+    """
+
+    def __init__(self, spec: str = "lognormal:0.3,0.5"):
+        kind, _, args = spec.partition(":")
+        self.kind = kind
+        self.args = [float(arg) for arg in args.split(",") if arg]
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            return self.args[0]
+        if self.kind == "uniform":
+            return random.uniform(*self.args)
+        if self.kind == "lognormal":
+            median, sigma = self.args
+            return random.lognormvariate(0, sigma) * median
+        raise ValueError(f"Unknown latency distribution {self.kind}")
+
+
+class MockState:
+    def __init__(self, keys, rpm=3, tpm=40000, rpd=200, latency="lognormal:0.3,0.5", overload_rate=0.0,
+                 error_rate=0.0, quota_keys=(), context_window=4096, capacity=None, ttft_share=0.3):
+        self.keys = set(keys)
+        self.quota_keys = set(quota_keys)
+        self.rpm = rpm
+        self.tpm = tpm
+        self.rpd = rpd
+        self.latency = Latency(latency)
+        self.overload_rate = overload_rate
+        self.error_rate = error_rate
+        self.context_window = context_window
+        # Requests the endpoint serves at full speed. Beyond it latency grows with the load,
+        # and beyond twice as many requests are rejected as overloaded.
+        self.capacity = capacity
+        self.ttft_share = ttft_share  # Share of a streamed request's latency before its first token
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.minute_requests = defaultdict(deque)  # key -> request times in the last minute
+            self.minute_tokens = defaultdict(deque)  # key -> (time, tokens) in the last minute
+            self.day_requests = defaultdict(int)
+            self.stats = defaultdict(int)
+
+    def admit(self, key, tokens):
+        """
+        Apply the limits of the key. Returns None when the request may proceed, else (status, message, type).
+        """
+        now = time.time()
+        with self.lock:
+            self.stats["requests"] += 1
+            if key not in self.keys:
+                return self._reject("invalid_key", 401, "Incorrect API key provided.", "invalid_request_error")
+            if key in self.quota_keys:
+                return self._reject("quota", 429, QUOTA_MESSAGE, "insufficient_quota")
+            if tokens > self.context_window:
+                return self._reject("context_length", 400,
+                                    CONTEXT_MESSAGE.format(limit=self.context_window, tokens=tokens),
+                                    "invalid_request_error")
+            requests = self.minute_requests[key]
+            used_tokens = self.minute_tokens[key]
+            while requests and now - requests[0] >= 60:
+                requests.popleft()
+            while used_tokens and now - used_tokens[0][0] >= 60:
+                used_tokens.popleft()
+            if self.day_requests[key] >= self.rpd:
+                return self._reject("rpd", 429, RPD_MESSAGE.format(limit=self.rpd), "requests")
+            if len(requests) >= self.rpm:
+                return self._reject("rpm", 429, RPM_MESSAGE.format(limit=self.rpm), "requests")
+            if sum(count for _, count in used_tokens) + tokens > self.tpm:
+                return self._reject("tpm", 429, TPM_MESSAGE.format(limit=self.tpm), "tokens")
+            if self.capacity and self.in_flight >= 2 * self.capacity:
+                return self._reject("overloaded", 503, OVERLOADED_MESSAGE, "server_error")
+            if random.random() < self.overload_rate:
+                return self._reject("overloaded", 503, OVERLOADED_MESSAGE, "server_error")
+            if random.random() < self.error_rate:
+                return self._reject("server_error", 500, SERVER_MESSAGE, "server_error")
+            requests.append(now)
+            used_tokens.append((now, tokens))
+            self.day_requests[key] += 1
+            self.stats["ok"] += 1
+            self.in_flight += 1
+            return None
+
+    def sample_latency(self) -> float:
+        """
+        Latency of an admitted request, slowed down by the load above capacity.
+        """
+        with self.lock:
+            load = self.in_flight / self.capacity if self.capacity else 1
+        return self.latency.sample() * max(1.0, load)
+
+    def done(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def _reject(self, reason, status, message, error_type):
+        self.stats[reason] += 1
+        self.stats["wasted"] += 1
+        return status, message, error_type
+
+
+def make_handler(state: MockState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            with state.lock:
+                state.stats["connections"] += 1
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if self.path.endswith("/reset"):
+                state.reset()
+                return self._send(200, {})
+            key = self.headers.get("Authorization", "").replace("Bearer ", "")
+            content = " ".join(message["content"] for message in body.get("messages", []))
+            prompt_tokens = len(content) // 4 + 11
+            rejection = state.admit(key, prompt_tokens + 20)
+            if rejection:
+                time.sleep(0.005)
+                status, message, error_type = rejection
+                return self._send(status, {"error": {"message": message, "type": error_type, "param": None,
+                                                     "code": None}})
+            if body.get("stream"):
+                try:
+                    return self._stream(body, _answer(body, content), state.sample_latency())
+                finally:
+                    state.done()
+            time.sleep(state.sample_latency())
+            state.done()
+            self._send(200, {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": _answer(body, content)},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 20,
+                          "total_tokens": prompt_tokens + 20},
+            })
+
+        def do_GET(self):
+            if self.path.endswith("/stats"):
+                with state.lock:
+                    return self._send(200, dict(state.stats))
+            if self.path.endswith("/models"):
+                if self.headers.get("Authorization", "").replace("Bearer ", "") not in state.keys:
+                    return self._send(401, {"error": {"message": "Incorrect API key provided.",
+                                                      "type": "invalid_request_error", "param": None,
+                                                      "code": "invalid_api_key"}})
+                return self._send(200, {"object": "list", "data": [{"id": "gpt-3.5-turbo-0613", "object": "model"}]})
+            self._send(404, {"error": {"message": "Not found"}})
+
+        def _send(self, status, payload):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _stream(self, body, answer, latency):
+            """
+            Send the answer as chat.completion.chunk events in a chunked response, ending with a
+            finish_reason chunk and [DONE].
+            """
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            tokens = answer.split(" ")
+            deltas = [{"role": "assistant"}] + [{"content": token if number == 0 else " " + token}
+                                                for number, token in enumerate(tokens)]
+            time.sleep(latency * state.ttft_share)
+            for number, delta in enumerate(deltas):
+                if number > 1:
+                    time.sleep(latency * (1 - state.ttft_share) / max(1, len(tokens) - 1))
+                self._send_event(_chunk(body, delta, None))
+            self._send_event(_chunk(body, {}, "stop"))
+            self._send_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _send_event(self, payload):
+            data = f"data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n".encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def _answer(body, content):
+    """
+    Echo the end of the prompt, or one answer per item when the user message is a packed JSON array.
+    """
+    try:
+        items = json.loads(body["messages"][-1]["content"])
+    except (ValueError, KeyError, IndexError):
+        items = None
+    if isinstance(items, list):
+        return json.dumps([f"bench {item}" for item in items], ensure_ascii=False)
+    return "bench " + content[-32:]
+
+
+def _chunk(body, delta, finish_reason):
+    return {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+            "model": body.get("model"), "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+
+def start_server(state: MockState, host="127.0.0.1", port=0) -> ThreadingHTTPServer:
+    """
+    Start the server on a daemon thread. Port 0 picks a free port: read it from server.server_port.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="MockOpenAI", daemon=True).start()
+    return server
@@ -0,0 +1,247 @@
+"""
+Throughput benchmark against the local mock server in mock_server.py. No real keys or network needed.
+
+Every scenario (engine x key count x thread count x dataset size) runs in its own subprocess, so that
+peak RSS is measured per scenario, and reports items/s, p50/p99 request latency, requests wasted on
+rate limits and injected errors, and peak RSS. With --stream every request is streamed over server-sent
+events and the time to first token is reported as well.
+
+    python test/benchmark/run_benchmark.py --engines run,arun --keys 10,40 --threads 20,80 --sizes 500
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_server import MockState, start_server  # noqa: E402
+
+ENGINES = ("run", "arun", "stream", "astream", "parallel_api", "aparallel_api")
+
+
+def run_scenario(args):
+    """
+    Child process: run one engine against the mock server and print the results as JSON.
+    """
+    import logging
+
+    from openai_parallel_toolkit import (
+        AdaptiveConcurrency,
+        HedgePolicy,
+        OpenAIModel,
+        ParallelToolkit,
+        Prompt,
+        PromptPacker,
+        RetryPolicy,
+        Scheduler,
+    )
+
+    latencies = []
+    first_tokens = []  # Seconds to the first token of streamed requests
+
+    class TimedOpenAIModel(OpenAIModel):
+        def generate(self, *a, **kw):
+            started = time.monotonic()
+            try:
+                return super().generate(*a, **kw)
+            finally:
+                latencies.append(time.monotonic() - started)
+
+        async def agenerate(self, *a, **kw):
+            started = time.monotonic()
+            try:
+                return await super().agenerate(*a, **kw)
+            finally:
+                latencies.append(time.monotonic() - started)
+
+        def generate_stream(self, *a, **kw):
+            started = time.monotonic()
+            for number, token in enumerate(super().generate_stream(*a, **kw)):
+                if number == 0:
+                    first_tokens.append(time.monotonic() - started)
+                yield token
+
+        async def agenerate_stream(self, *a, **kw):
+            started = time.monotonic()
+            number = 0
+            async for token in super().agenerate_stream(*a, **kw):
+                if number == 0:
+                    first_tokens.append(time.monotonic() - started)
+                number += 1
+                yield token
+
+    workdir = args.workdir
+    input_path = os.path.join(workdir, "input.jsonl")
+    output_path = os.path.join(workdir, f"output-{os.getpid()}.jsonl")
+    with open(input_path, "w", encoding="utf-8") as f:
+        for index in range(args.size):
+            f.write(json.dumps({"index": str(index), "instruction": "Translate into English",
+                                "input": f"benchmark item {index}"}, ensure_ascii=False) + "\n")
+    tool = ParallelToolkit(config_path=args.config, openai_model=TimedOpenAIModel(stream=args.stream),
+                           input_path=input_path, output_path=output_path, threads=args.threads,
+                           log_level=logging.ERROR,
+                           packer=PromptPacker(max_items=args.pack) if args.pack > 1 else None,
+                           retry_policy=RetryPolicy(
+                                   hedge=HedgePolicy(quantile=args.hedge) if args.hedge else None,
+                                   concurrency=AdaptiveConcurrency(max_limit=args.threads) if args.adaptive else None),
+                           scheduler=Scheduler() if args.schedule else None,
+                           trace_path=os.path.join(args.trace, f"{args.engine}-{args.threads}-{args.size}.json")
+                           if args.trace else None)
+    data = {str(index): Prompt("Translate into English", f"benchmark item {index}") for index in range(args.size)}
+
+    started = time.monotonic()
+    if args.engine == "run":
+        tool.run()
+    elif args.engine == "stream":
+        tool.run(stream=True)
+    elif args.engine == "arun":
+        asyncio.run(tool.arun())
+    elif args.engine == "astream":
+        asyncio.run(tool.arun(stream=True))
+    elif args.engine == "parallel_api":
+        tool.parallel_api(data)
+    elif args.engine == "aparallel_api":
+        asyncio.run(tool.aparallel_api(data))
+    elapsed = time.monotonic() - started
+
+    print(json.dumps({
+        "seconds": elapsed,
+        "items_per_second": args.size / elapsed if elapsed else 0,
+        "p50": _percentile(latencies, 0.5),
+        "p99": _percentile(latencies, 0.99),
+        "ttft_p50": _percentile(first_tokens, 0.5),
+        "ttft_p99": _percentile(first_tokens, 0.99),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engines", default="run,arun")
+    parser.add_argument("--keys", default="20")
+    parser.add_argument("--threads", default="40")
+    parser.add_argument("--sizes", default="300")
+    parser.add_argument("--rpm", type=int, default=60, help="Per-key requests per minute (3 on a $5 account)")
+    parser.add_argument("--tpm", type=int, default=40000)
+    parser.add_argument("--rpd", type=int, default=200)
+    parser.add_argument("--latency", default="lognormal:0.3,0.5",
+                        help="fixed:S, uniform:MIN,MAX or lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--overload-rate", type=float, default=0.0)
+    parser.add_argument("--capacity", type=int, help="Concurrent requests the mock serves before slowing down; "
+                                                      "twice as many are rejected as overloaded")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--pack", type=int, default=1, help="Pack up to this many prompts into one request")
+    parser.add_argument("--hedge", type=float, default=0.0,
+                        help="Hedge requests slower than this percentile of recent latencies, e.g. 0.95")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Adjust the requests in flight with AdaptiveConcurrency, up to --threads")
+    parser.add_argument("--schedule", action="store_true",
+                        help="Order work with a Scheduler (longest first, retries re-queued) in run and parallel_api")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream every request (OpenAIModel(stream=True)) and report the time to first token")
+    parser.add_argument("--endpoints", help="Split the keys over several mock endpoints with these latencies, "
+                                            "separated by ';'; 'down' is an endpoint that refuses connections")
+    parser.add_argument("--output", help="Also write the results as JSON lines to this file")
+    parser.add_argument("--trace", help="Write a Chrome trace of every scenario to this directory")
+    # Internal: run a single scenario in this process
+    parser.add_argument("--scenario", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--engine", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--config", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.scenario:
+        args.threads = int(args.threads)
+        run_scenario(args)
+        return
+
+    max_keys = max(int(count) for count in args.keys.split(","))
+    keys = [f"sk-bench-{index:05d}" for index in range(max_keys)]
+    latencies = args.endpoints.split(";") if args.endpoints else [args.latency]
+    states, servers, api_bases = [], [], []
+    for latency in latencies:
+        if latency == "down":
+            # A port that was free a moment ago, so connections are refused
+            with socket.socket() as sock:
+                sock.bind(("127.0.0.1", 0))
+                api_bases.append(f"http://127.0.0.1:{sock.getsockname()[1]}/v1")
+            continue
+        state = MockState(keys, rpm=args.rpm, tpm=args.tpm, rpd=args.rpd, latency=latency,
+                          overload_rate=args.overload_rate, error_rate=args.error_rate, capacity=args.capacity)
+        server = start_server(state)
+        states.append(state)
+        servers.append(server)
+        api_bases.append(f"http://127.0.0.1:{server.server_port}/v1")
+    results = []
+    print(f"{'engine':<14}{'keys':>6}{'threads':>8}{'items':>7}{'items/s':>9}{'p50 s':>8}{'p99 s':>8}"
+          f"{'ttft p50':>9}{'ttft p99':>9}{'wasted':>8}{'rss MB':>8}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for engine in args.engines.split(","):
+            for key_count in (int(count) for count in args.keys.split(",")):
+                config_path = os.path.join(workdir, f"config-{key_count}.json")
+                config = {"rate_limits": {"rpm": args.rpm, "tpm": args.tpm, "rpd": args.rpd}}
+                if args.endpoints:
+                    config["endpoints"] = [{"api_base": api_base, "api_keys": keys[number:key_count:len(api_bases)]}
+                                           for number, api_base in enumerate(api_bases)]
+                else:
+                    config.update(api_keys=keys[:key_count], api_base=api_bases[0])
+                with open(config_path, "w") as f:
+                    json.dump(config, f)
+                for threads in args.threads.split(","):
+                    for size in (int(size) for size in args.sizes.split(",")):
+                        # Fresh daily and minute windows for every scenario
+                        for state in states:
+                            state.reset()
+                        child = subprocess.run(
+                                [sys.executable, os.path.abspath(__file__), "--scenario", "--engine", engine,
+                                 "--threads", threads, "--size", str(size), "--config", config_path,
+                                 "--workdir", workdir, "--pack", str(args.pack), "--hedge", str(args.hedge)]
+                                + (["--schedule"] if args.schedule else [])
+                                + (["--adaptive"] if args.adaptive else [])
+                                + (["--stream"] if args.stream else [])
+                                + (["--trace", os.path.abspath(args.trace)] if args.trace else []),
+                                capture_output=True, text=True)
+                        if child.returncode != 0:
+                            print(f"{engine} keys={key_count} threads={threads} size={size} failed:\n{child.stderr}")
+                            continue
+                        result = json.loads(child.stdout.strip().splitlines()[-1])
+                        stats = []
+                        for server in servers:
+                            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_port}/v1/stats") as response:
+                                stats.append(json.load(response))
+                        result.update(engine=engine, keys=key_count, threads=int(threads), size=size,
+                                      wasted=sum(stat.get("wasted", 0) for stat in stats),
+                                      server=stats[0] if len(stats) == 1 else stats)
+                        results.append(result)
+                        print(f"{engine:<14}{key_count:>6}{threads:>8}{size:>7}{result['items_per_second']:>9.2f}"
+                              f"{_fmt(result['p50']):>8}{_fmt(result['p99']):>8}{_fmt(result['ttft_p50']):>9}"
+                              f"{_fmt(result['ttft_p99']):>9}{result['wasted']:>8}"
+                              f"{result['peak_rss_mb']:>8.1f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+    for server in servers:
+        server.shutdown()
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else None
+
+
+def _fmt(value):
+    return f"{value:.3f}" if value is not None else "-"
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,56 @@
+import asyncio
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
-from openai_parallel_toolkit import OpenAIModel, ParallelToolkit, Prompt
+from openai import error
+
+from openai_parallel_toolkit import (
+    AdaptiveConcurrency,
+    CapacityPlanner,
+    CircuitBreaker,
+    HedgePolicy,
+    OpenAIModel,
+    ParallelToolkit,
+    Prompt,
+    PromptPacker,
+    ResponseCache,
+    RetryPolicy,
+    Scheduler,
+)
+from openai_parallel_toolkit.api.errors import (
+    CONTEXT_LENGTH,
+    DAILY_LIMIT,
+    INVALID,
+    QUOTA,
+    RATE_LIMIT,
+    TRANSIENT,
+    classify_error,
+)
+from openai_parallel_toolkit.api.coordinator import KeyCoordinator, RemoteKeyManager
+from openai_parallel_toolkit.api.hedge import agenerate_hedged, generate_hedged
+from openai_parallel_toolkit.api.keys import KeyManager
+from openai_parallel_toolkit.api.request import request_openai_api, request_openai_api_stream
+from openai_parallel_toolkit.api.router import EndpointRouter
+from openai_parallel_toolkit.api.tokens import estimate_tokens
+from openai_parallel_toolkit.utils.checkpoint import Checkpoint
+from openai_parallel_toolkit.utils.dataset import PromptDataset
+from openai_parallel_toolkit.utils.metrics import TIME_TO_FIRST_TOKEN
+from openai_parallel_toolkit.utils.reader import read_endpoints, read_processed_indexes, remove_nulls_from_jsonl
+from openai_parallel_toolkit.utils.trace import Tracer
+from openai_parallel_toolkit.utils.writer import ResultWriter
+
+
+def write_config(directory, keys, **extra):
+    path = os.path.join(directory, "config.json")
+    with open(path, "w") as f:
+        json.dump({"api_keys": keys, **extra}, f)
+    return path
 
 
 class TestApi(unittest.TestCase):
@@ -28,6 +78,18 @@ class TestParallelApi(unittest.TestCase):
         print(ans)
         self.assertTrue(len(ans) == 10)
 
+    def test_iter_api(self):
+        data = {
+            i: Prompt(
+                instruction="Please write a sentence about the following topic: ",
+                input="china",
+            )
+            for i in range(10)
+        }
+        ans = list(ParallelToolkit(config_path="config.json").iter_api(data=data, ordered=True))
+        print(ans)
+        self.assertEqual([index for index, _ in ans], list(range(10)))
+
 
 class TestRun(unittest.TestCase):
     def test_run(self):
@@ -38,3 +100,658 @@ class TestRun(unittest.TestCase):
         )
         tool.run()
         tool.merge("merged.json")
+
+
+class TestKeyManager(unittest.TestCase):
+    def test_rate_budget(self):
+        with tempfile.TemporaryDirectory() as directory:
+            key_manager = KeyManager(config_path=write_config(directory, ["a", "b"]), rpm=1, rpd=2)
+            first, second = key_manager.get_new_key(), key_manager.get_new_key()
+            self.assertEqual({first, second}, {"a", "b"})
+            key_manager.release_key(first)
+            key_manager.release_key(second)
+            # Both keys spent their one request for this minute
+            self.assertEqual(key_manager._acquire()[0], None)
+            self.assertIsNone(key_manager.try_get_new_key())
+
+    def test_remove_all_keys(self):
+        with tempfile.TemporaryDirectory() as directory:
+            key_manager = KeyManager(config_path=write_config(directory, ["a"]))
+            key_manager.remove_key(key_manager.get_new_key())
+            self.assertRaises(Exception, key_manager.get_new_key)
+
+    def test_ledger(self):
+        with tempfile.TemporaryDirectory() as directory:
+            config_path = write_config(directory, ["a", "b", "c"])
+            ledger_path = os.path.join(directory, "ledger.db")
+            key_manager = KeyManager(config_path=config_path, rpd=10, ledger_path=ledger_path)
+            key_manager.remove_key("a")
+            key_manager.remove_key("b", exhausted=True)
+            key_manager.release_key(key_manager.get_new_key())
+            key_manager.close()
+            key_manager = KeyManager(config_path=config_path, rpd=10, ledger_path=ledger_path)
+            # Revoked keys stay removed, exhausted keys wait for their day and daily counts carry over
+            self.assertEqual(key_manager.keys, {"b", "c"})
+            self.assertEqual(key_manager.budgets["b"].day_count, 10)
+            self.assertEqual(key_manager.budgets["c"].day_count, 1)
+            key_manager.close()
+
+    def test_async_wait_woken_on_release(self):
+        with tempfile.TemporaryDirectory() as directory:
+            key_manager = KeyManager(config_path=write_config(directory, ["a"]))
+
+            async def run():
+                key = await key_manager.aget_new_key()
+                waiter = asyncio.ensure_future(key_manager.aget_new_key())
+                await asyncio.sleep(0)
+                self.assertFalse(waiter.done())
+                self.assertEqual(len(key_manager.async_waiters), 1)
+                threading.Thread(target=key_manager.release_key, args=(key,)).start()
+                self.assertEqual(await asyncio.wait_for(waiter, timeout=1), "a")
+
+            asyncio.run(run())
+
+
+class TestKeyCoordinator(unittest.TestCase):
+    def test_remote_leases(self):
+        with tempfile.TemporaryDirectory() as directory:
+            key_manager = KeyManager(config_path=write_config(directory, ["a", "b"]))
+            coordinator = KeyCoordinator(None, key_manager=key_manager).start()
+            try:
+                remote = RemoteKeyManager(coordinator.address, authkey=coordinator.authkey)
+                key = remote.get_new_key()
+                self.assertEqual(key_manager.using_keys, {key})
+                remote.release_key(key)
+                self.assertEqual(key_manager.using_keys, set())
+                remote.remove_key("a")
+                self.assertEqual(remote.get_key_length(), 1)
+                with self.assertRaises(Exception):
+                    RemoteKeyManager(coordinator.address, authkey=b"wrong")
+            finally:
+                coordinator.close()
+
+    def test_remote_capacity_and_pace(self):
+        with tempfile.TemporaryDirectory() as directory:
+            key_manager = KeyManager(config_path=write_config(directory, ["a", "b"]), rpm=3, rpd=2)
+            coordinator = KeyCoordinator(None, key_manager=key_manager).start()
+            try:
+                remote = RemoteKeyManager(coordinator.address, authkey=coordinator.authkey)
+                self.assertEqual(remote.capacity(), key_manager.capacity())
+                remote.set_pace(0.5)
+                self.assertEqual(key_manager.pace_interval, 2)
+                remote.set_pace(None)
+                self.assertEqual(key_manager.pace_interval, 0)
+                remote.close()
+                self.assertEqual(remote.conns, [])
+            finally:
+                coordinator.close()
+
+    def test_authkey_required(self):
+        with self.assertRaises(ValueError):
+            KeyCoordinator(None, address=("0.0.0.0", 0), key_manager=object())
+        with self.assertRaises(ValueError):
+            ParallelToolkit(config_path=None, coordinator_address=("127.0.0.1", 6000))
+
+    def test_worker_options_pickle(self):
+        policy = pickle.loads(pickle.dumps(RetryPolicy(concurrency=AdaptiveConcurrency(initial=8),
+                                                       breaker=CircuitBreaker(threshold=3))))
+        self.assertEqual((policy.breaker.threshold, int(policy.concurrency.limit)), (3, 8))
+        scheduler = pickle.loads(pickle.dumps(Scheduler(priorities={"1": 2})))
+        self.assertEqual(scheduler.priorities, {"1": 2})
+
+
+class TestCapacityPlanner(unittest.TestCase):
+    def test_plan_and_pace(self):
+        with tempfile.TemporaryDirectory() as directory:
+            key_manager = KeyManager(config_path=write_config(directory, ["a", "b"]), rpm=3, rpd=6)
+            items = [(str(i), Prompt("translate", "text")) for i in range(10)]
+            planner = CapacityPlanner(headroom=0.5)
+            plan = planner.plan(key_manager, OpenAIModel(), items=items, threads=2)
+            # Two keys at 3 requests per minute, with 6 requests each left today
+            self.assertEqual(plan.bound, "rpm")
+            self.assertAlmostEqual(plan.requests_per_second, 0.1)
+            self.assertEqual((plan.quota, plan.shortfall), (12, 0))
+            self.assertAlmostEqual(plan.eta, 100)
+            planner.start(key_manager, plan)
+            key_manager.get_new_key()
+            # Both keys are within their budgets, but the next lease waits 1 / 0.05 seconds
+            key, delay = key_manager.poll_key()
+            self.assertIsNone(key)
+            self.assertAlmostEqual(delay, 20, delta=1)
+            planner.stop(key_manager, plan)
+            self.assertIsNotNone(key_manager.poll_key()[0])
+
+    def test_quota_bound(self):
+        with tempfile.TemporaryDirectory() as directory:
+            key_manager = KeyManager(config_path=write_config(directory, ["a", "b"]), rpm=3, rpd=2)
+            items = [(str(i), Prompt("translate", "text")) for i in range(10)]
+            plan = CapacityPlanner(headroom=0.5).plan(key_manager, OpenAIModel(), items=items, threads=2)
+            # 4 requests left today for 10 items: they are spread over the day instead of sent within a minute
+            self.assertEqual(plan.bound, "rpd")
+            self.assertEqual((plan.quota, plan.shortfall), (4, 6))
+            self.assertAlmostEqual(plan.requests_per_second, 4 / 86400)
+            self.assertAlmostEqual(plan.pace, 2 / 86400)
+
+
+class TestEndpointRouter(unittest.TestCase):
+    def test_routing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            config_path = write_config(directory, [], endpoints=[
+                    {"name": "slow", "api_base": "http://slow/v1", "api_keys": ["a", "b"]},
+                    {"name": "fast", "api_base": "http://fast/v1", "api_keys": ["c", "d"]}])
+            router = EndpointRouter(read_endpoints(config_path), probe_interval=None)
+            router.release_key(router.endpoint_of["a"].key_manager.get_new_key(), latency=2.0)
+            router.release_key(router.endpoint_of["c"].key_manager.get_new_key(), latency=0.1)
+            key = router.get_new_key()
+            self.assertEqual(router.api_base_for(key), "http://fast/v1")
+            # Three failures in a row take the fast endpoint out of rotation
+            self.assertFalse(router.record_failure(key))
+            self.assertFalse(router.record_failure(key))
+            self.assertTrue(router.record_failure(key))
+            self.assertEqual(router.api_base_for(router.get_new_key()), "http://slow/v1")
+
+    def test_probe_uses_proxy(self):
+        with tempfile.TemporaryDirectory() as directory:
+            config_path = write_config(directory, [], endpoints=[
+                    {"name": "only", "api_base": "http://only/v1", "api_keys": ["a"]}])
+            router = EndpointRouter(read_endpoints(config_path), probe_interval=None)
+            endpoint = router.endpoints[0]
+            endpoint.healthy = False
+            with mock.patch("openai.proxy", "http://proxy:3128"):
+                session = router.http_client.make_session()
+            with mock.patch.object(session, "get", return_value=mock.Mock(status_code=401)) as get:
+                router._probe(endpoint, session)
+            get.assert_called_once()
+            self.assertEqual(session.proxies["https"], "http://proxy:3128")
+            # An authentication error still shows the endpoint is up
+            self.assertTrue(endpoint.healthy)
+
+    def test_async_wait_woken_on_release(self):
+        with tempfile.TemporaryDirectory() as directory:
+            config_path = write_config(directory, [], endpoints=[
+                    {"name": "only", "api_base": "http://only/v1", "api_keys": ["a"]}])
+            router = EndpointRouter(read_endpoints(config_path), probe_interval=None)
+
+            async def run():
+                key = await router.aget_new_key()
+                waiter = asyncio.ensure_future(router.aget_new_key())
+                await asyncio.sleep(0)
+                self.assertEqual(len(router.async_waiters), 1)
+                threading.Thread(target=router.release_key, args=(key,)).start()
+                self.assertEqual(await asyncio.wait_for(waiter, timeout=1), "a")
+
+            asyncio.run(run())
+
+
+class TestRetry(unittest.TestCase):
+    def test_classify_error(self):
+        self.assertEqual(classify_error(error.RateLimitError("Rate limit reached: 3 / min"))[0], RATE_LIMIT)
+        self.assertEqual(classify_error(error.RateLimitError("Rate limit reached: 200 / day"))[0], DAILY_LIMIT)
+        self.assertEqual(classify_error(error.RateLimitError("You exceeded your current quota"))[0], QUOTA)
+        self.assertEqual(classify_error(error.AuthenticationError("Incorrect API key"))[0], QUOTA)
+        self.assertEqual(classify_error(error.APIConnectionError("reset"))[0], TRANSIENT)
+        self.assertEqual(classify_error(error.APIError("bad gateway", http_status=502))[0], TRANSIENT)
+        self.assertEqual(classify_error(error.InvalidRequestError("bad", None))[0], INVALID)
+        self.assertEqual(classify_error(error.InvalidRequestError(
+                "This model's maximum context length is 4097 tokens", None))[0], CONTEXT_LENGTH)
+        self.assertEqual(classify_error(error.RateLimitError("slow down", headers={"retry-after": "7"})),
+                         (RATE_LIMIT, 7.0))
+
+    def test_retry_policy(self):
+        policy = RetryPolicy(base_delay=1, max_delay=4, deadline=10)
+        for attempt in range(1, 6):
+            self.assertTrue(0 <= policy.backoff(attempt) <= min(4, 2 ** attempt))
+        self.assertGreaterEqual(policy.backoff(1, retry_after=30), 30)
+        self.assertFalse(policy.expired(time.monotonic()))
+        self.assertTrue(policy.expired(time.monotonic() - 11))
+        # An open breaker is not waited out past the deadline
+        policy = RetryPolicy(deadline=0.05, breaker=CircuitBreaker(threshold=1, cooldown=60))
+        policy.breaker.record_failure()
+        started = time.monotonic()
+        self.assertIsNone(policy.wait_for_breaker(started))
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+        self.assertEqual(breaker.admit(), (0, False))
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertGreater(breaker.admit()[0], 0)
+        time.sleep(0.06)
+        self.assertEqual(breaker.admit(), (0, True))
+        self.assertGreater(breaker.admit()[0], 0)  # Only one probe at a time
+        # A probe that ends without settling the circuit lets the next request probe
+        breaker.end_probe()
+        self.assertEqual(breaker.admit(), (0, True))
+        breaker.record_failure()
+        breaker.end_probe()
+        self.assertGreater(breaker.admit()[0], 0.01)  # Reopened for a full cooldown
+        time.sleep(0.06)
+        self.assertEqual(breaker.admit(), (0, True))
+        breaker.record_success()
+        breaker.end_probe()
+        self.assertEqual(breaker.admit(), (0, False))
+
+    def test_probe_rate_limited(self):
+        with tempfile.TemporaryDirectory() as directory:
+            key_manager = KeyManager(config_path=write_config(directory, ["a", "b"]), rpm=60)
+            policy = RetryPolicy(base_delay=0.01, breaker=CircuitBreaker(threshold=1, cooldown=0.05))
+            outcomes = [error.APIConnectionError("reset"), error.RateLimitError("Rate limit reached: 60 / min")]
+
+            def generate(**kwargs):
+                if outcomes:
+                    raise outcomes.pop(0)
+                return {"choices": [{"message": {"content": "ok"}}], "usage": {"total_tokens": 1}}
+
+            model = OpenAIModel()
+            with mock.patch.object(model, "generate", side_effect=generate):
+                result = request_openai_api(model, Prompt("a", "b"), key_manager, max_retries=3, retry_policy=policy)
+            self.assertEqual(result, "ok")
+            self.assertFalse(policy.breaker.probing)
+
+    def test_key_wait_bounded_by_deadline(self):
+        with tempfile.TemporaryDirectory() as directory:
+            key_manager = KeyManager(config_path=write_config(directory, ["a"]))
+            held = key_manager.get_new_key()
+            self.assertIsNone(key_manager.get_new_key(timeout=0.01))
+            # Every key stays leased, so the item gives up at its deadline instead of waiting for a release
+            model = OpenAIModel()
+            started = time.monotonic()
+            with mock.patch.object(model, "generate") as generate:
+                result = request_openai_api(model, Prompt("a", "b"), key_manager, max_retries=3,
+                                            retry_policy=RetryPolicy(deadline=0.05))
+            self.assertIsNone(result)
+            self.assertLess(time.monotonic() - started, 1)
+            generate.assert_not_called()
+            key_manager.release_key(held)
+
+
+class TestCheckpoint(unittest.TestCase):
+    def test_record_and_export(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = Checkpoint(os.path.join(directory, "output.jsonl.ckpt"))
+            checkpoint.record_many([("10", "ten"), ("2", None), ("1", "one")])
+            self.assertIn("1", checkpoint)
+            self.assertNotIn("2", checkpoint)
+            self.assertEqual(checkpoint.count_failed(), 1)
+            output_path = os.path.join(directory, "output.jsonl")
+            checkpoint.export_jsonl(output_path)
+            with open(output_path, encoding="utf-8") as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual(lines, [{"1": "one"}, {"2": None}, {"10": "ten"}])
+            checkpoint.close()
+
+    def test_resume_without_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output_path = os.path.join(directory, "output.jsonl")
+            with open(output_path, "w", encoding="utf-8") as f:
+                f.write('{"1": "one"}\n{"2": null}\n{"a": "x"}\n{"100000": "big"}\n')
+            remove_nulls_from_jsonl(output_path)
+            with open(output_path, encoding="utf-8") as f:
+                self.assertEqual(f.read(), '{"1": "one"}\n{"a": "x"}\n{"100000": "big"}\n')
+            processed = read_processed_indexes(output_path)
+            self.assertEqual(len(processed), 3)
+            self.assertEqual([index in processed for index in ("1", 1, "2", "a", "100000", "01")],
+                             [True, True, False, True, True, False])
+
+
+class TestResultWriter(unittest.TestCase):
+    def test_failed_write_retried(self):
+        checkpoint = mock.Mock()
+        checkpoint.record_many.side_effect = [OSError("disk full"), None]
+        with ResultWriter(checkpoint=checkpoint, flush_interval=0.01) as writer:
+            writer.put("1", "one")
+        checkpoint.record_many.assert_called_with([("1", "one")])
+        self.assertEqual(checkpoint.record_many.call_count, 2)
+
+    def test_lost_results_raised_by_close(self):
+        checkpoint = mock.Mock()
+        checkpoint.record_many.side_effect = OSError("disk full")
+        writer = ResultWriter(checkpoint=checkpoint, flush_interval=0.01, write_retries=1)
+        writer.put("1", "one")
+        with self.assertRaises(IOError) as raised:
+            writer.close()
+        self.assertIsInstance(raised.exception.__cause__, OSError)
+        self.assertEqual(writer.lost, 1)
+
+    def test_partial_write_truncated_before_retry(self):
+        write = ResultWriter._write
+        failures = [OSError("disk full")]
+
+        def partial_write(writer, batch):
+            if failures:
+                writer.file.write(b'{"1": "on')
+                raise failures.pop()
+            write(writer, batch)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "output.jsonl")
+            with open(path, "w") as f:
+                f.write('{"0": "zero"}\n')
+            with mock.patch.object(ResultWriter, "_write", partial_write):
+                with ResultWriter(output_path=path, flush_interval=0.01) as writer:
+                    writer.put("1", "one")
+            with open(path) as f:
+                self.assertEqual([json.loads(line) for line in f], [{"0": "zero"}, {"1": "one"}])
+
+
+class TestHedgePolicy(unittest.TestCase):
+    def test_delay_quantile(self):
+        hedge = HedgePolicy(quantile=0.9, min_samples=10, min_delay=0.5)
+        for seconds in range(1, 10):
+            hedge.record(seconds)
+        self.assertIsNone(hedge.delay())
+        hedge.record(10)
+        self.assertEqual(hedge.delay(), 10)
+        hedge = HedgePolicy(quantile=0.5, min_samples=1, min_delay=0.5)
+        hedge.record(0.1)
+        self.assertEqual(hedge.delay(), 0.5)
+
+    def make_hedge(self, agenerate=False):
+        delays = {"slow": 0.5, "fast": 0}
+        model = mock.Mock()
+        if agenerate:
+            async def call(api_key, **kwargs):
+                await asyncio.sleep(delays[api_key])
+                return {"answer": api_key}
+            model.agenerate = call
+        else:
+            def call(api_key, **kwargs):
+                time.sleep(delays[api_key])
+                return {"answer": api_key}
+            model.generate = call
+        key_manager = mock.Mock()
+        key_manager.try_get_new_key.return_value = "fast"
+        hedge = HedgePolicy(min_samples=1, min_delay=0.01)
+        hedge.record(0.01)
+        return hedge, model, key_manager
+
+    def test_first_answer_wins(self):
+        hedge, model, key_manager = self.make_hedge()
+        completion, key = generate_hedged(hedge, model, Prompt("translate", "text"), "gpt-3.5-turbo", "slow",
+                                          key_manager, tokens=1)
+        self.assertEqual((completion, key), ({"answer": "fast"}, "fast"))
+        # The slow request keeps its key until it finishes
+        key_manager.release_key.assert_not_called()
+        hedge.get_executor().shutdown(wait=True)
+        key_manager.release_key.assert_called_once_with("slow", tokens=None)
+
+    def test_first_answer_wins_async(self):
+        hedge, model, key_manager = self.make_hedge(agenerate=True)
+        completion, key = asyncio.run(agenerate_hedged(hedge, model, Prompt("translate", "text"), "gpt-3.5-turbo",
+                                                       "slow", key_manager, tokens=1))
+        self.assertEqual((completion, key), ({"answer": "fast"}, "fast"))
+        key_manager.release_key.assert_called_once_with("slow")
+
+    def test_failed_spare_key_classified(self):
+        hedge, model, key_manager = self.make_hedge()
+
+        def call(api_key, **kwargs):
+            if api_key == "slow":
+                time.sleep(0.05)
+                raise error.APIError("bad gateway", http_status=502)
+            raise error.RateLimitError("Rate limit reached", headers={"retry-after": "7"})
+
+        model.generate = call
+        with self.assertRaises(error.APIError):
+            generate_hedged(hedge, model, Prompt("translate", "text"), "gpt-3.5-turbo", "slow", key_manager, tokens=1)
+        # The primary key stays leased for the caller; the rate limited spare is held back, not released
+        key_manager.limit_key.assert_called_once_with("fast", 7.0)
+        key_manager.release_key.assert_not_called()
+
+
+class TestResponseCache(unittest.TestCase):
+    def test_memory_tier(self):
+        cache = ResponseCache(memory_size=2)
+        cache.put("a", "1")
+        cache.put("b", "2")
+        self.assertEqual(cache.get("a"), "1")
+        cache.put("c", "3")
+        # "b" was the least recently used
+        self.assertEqual([cache.get(key) for key in "abc"], ["1", None, "3"])
+
+    def test_disk_tier_and_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.db")
+            cache = ResponseCache(path, memory_size=1, disk_max_bytes=100)
+            for number in range(5):
+                cache.put(str(number), "x" * 20)
+            self.assertEqual(cache.get("0"), "x" * 20)  # From disk, and now the most recently used
+            cache.put("5", "x" * 20)
+            # 120 bytes: the least recently used entries go until 90 bytes are left
+            self.assertEqual(cache.disk_bytes, 80)
+            self.assertIsNone(cache.get("1"))
+            self.assertIsNone(cache.get("2"))
+            cache.close()
+            cache = ResponseCache(path, memory_size=1, disk_max_bytes=100)
+            self.assertEqual([cache.get(key) for key in "0345"], ["x" * 20] * 4)
+            cache.close()
+
+    def test_concurrent_requests_deduplicated(self):
+        cache = ResponseCache()
+        calls = []
+        release = threading.Event()
+
+        def request():
+            calls.append(1)
+            release.wait(1)
+            return "answer"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_request("key", request)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((len(calls), results), (1, ["answer"] * 4))
+
+    def test_concurrent_async_requests_deduplicated(self):
+        cache = ResponseCache()
+        calls = []
+
+        async def request():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "answer"
+
+        async def run():
+            return await asyncio.gather(*(cache.aget_or_request("key", request) for _ in range(4)))
+
+        self.assertEqual(asyncio.run(run()), ["answer"] * 4)
+        self.assertEqual(len(calls), 1)
+
+    def test_cancelled_async_request_retried_by_waiter(self):
+        cache = ResponseCache()
+        calls = []
+
+        async def request():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "answer"
+
+        async def run():
+            owner = asyncio.ensure_future(cache.aget_or_request("key", request))
+            await asyncio.sleep(0)
+            waiters = [asyncio.ensure_future(cache.aget_or_request("key", request)) for _ in range(3)]
+            await asyncio.sleep(0)
+            owner.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await owner
+            return await asyncio.gather(*waiters)
+
+        self.assertEqual(asyncio.run(run()), ["answer"] * 3)
+        # One request that was cancelled, and one that a waiter made for all three
+        self.assertEqual(len(calls), 2)
+
+
+class TestModelRouting(unittest.TestCase):
+    def test_select_model(self):
+        model = OpenAIModel("gpt-3.5-turbo-0613", fallback_models=["gpt-3.5-turbo-16k-0613"])
+        self.assertEqual(model.select_model(1000), "gpt-3.5-turbo-0613")
+        self.assertEqual(model.select_model(estimate_tokens("x" * 20000)), "gpt-3.5-turbo-16k-0613")
+        self.assertEqual(model.next_model("gpt-3.5-turbo-0613"), "gpt-3.5-turbo-16k-0613")
+        self.assertIsNone(model.next_model("gpt-3.5-turbo-16k-0613"))
+
+
+class TestStreaming(unittest.TestCase):
+    def test_cut_off(self):
+        chunks = [{"choices": [{"delta": {"role": "assistant"}}]}] + [
+                {"choices": [{"delta": {"content": token}}]} for token in ["One", " two", " three", " four"]]
+        stream = mock.MagicMock(__iter__=lambda self: iter(chunks))
+        model = OpenAIModel(stream=True, stop_when=lambda text: text.endswith("two"))
+        with mock.patch("openai.ChatCompletion.create", return_value=stream) as create:
+            completion = model.generate("instruction", "input", api_key="sk-test-abcd")
+        self.assertTrue(create.call_args.kwargs["stream"])
+        stream.close.assert_called_once()
+        self.assertEqual(completion["choices"][0]["message"]["content"], "One two")
+        self.assertEqual(completion["choices"][0]["finish_reason"], "client_stop")
+        self.assertEqual(TIME_TO_FIRST_TOKEN.collect()["...abcd"]["count"], 1)
+
+    def test_unfinished_stream_retried(self):
+        finished = [{"choices": [{"delta": {"content": "ok"}}]},
+                    {"choices": [{"delta": {}, "finish_reason": "stop"}]}]
+        # An empty stream, then one that ends before its finish chunk
+        streams = [mock.MagicMock(__iter__=lambda self, chunks=chunks: iter(chunks))
+                   for chunks in ([], finished[:1], finished)]
+        with tempfile.TemporaryDirectory() as directory:
+            key_manager = KeyManager(config_path=write_config(directory, ["a"]))
+            with mock.patch("openai.ChatCompletion.create", side_effect=streams) as create:
+                tokens = list(request_openai_api_stream(OpenAIModel(), Prompt("a", "b"), key_manager, max_retries=5,
+                                                        retry_policy=RetryPolicy(base_delay=0.01)))
+        # The first stream is retried; the second broke after its first token, which was already yielded
+        self.assertEqual(tokens, ["ok"])
+        self.assertEqual(create.call_count, 2)
+        self.assertEqual(key_manager.using_keys, set())
+
+    def test_stream_holds_slot_and_key(self):
+        chunks = [{"choices": [{"delta": {"content": "ok"}, "finish_reason": "stop"}]}]
+        streams = [error.RateLimitError("Rate limit reached: 3 / min"),
+                   mock.MagicMock(__iter__=lambda self: iter(chunks))]
+        concurrency = AdaptiveConcurrency(initial=1, max_limit=1)
+        with tempfile.TemporaryDirectory() as directory:
+            key_manager = KeyManager(config_path=write_config(directory, ["a", "b"]))
+            with mock.patch("openai.ChatCompletion.create", side_effect=streams):
+                stream = request_openai_api_stream(OpenAIModel(), Prompt("a", "b"), key_manager, max_retries=5,
+                                                   retry_policy=RetryPolicy(concurrency=concurrency))
+                self.assertEqual(next(stream), "ok")
+                # The rate limited key is held back, the other one streams inside a concurrency slot
+                self.assertEqual(len(key_manager.using_keys), 1)
+                self.assertEqual(concurrency.in_flight, 1)
+                stream.close()
+            self.assertEqual((key_manager.using_keys, concurrency.in_flight), (set(), 0))
+            self.assertEqual(key_manager.get_limited_length(), 1)
+
+
+class TestPromptPacker(unittest.TestCase):
+    def test_pack_and_split(self):
+        packer = PromptPacker(max_items=2)
+        items = [("1", Prompt("a", "x")), ("2", Prompt("b", "y")), ("3", Prompt("a", "z"))]
+        groups = list(packer.pack(items, OpenAIModel()))
+        self.assertEqual(groups, [[items[0], items[2]], [items[1]]])
+        self.assertEqual(json.loads(packer.build(groups[0]).input), ["x", "z"])
+        self.assertEqual(packer.split('```json\n["X", "Z"]\n```', 2), ["X", "Z"])
+        self.assertIsNone(packer.split('["X"]', 2))
+        self.assertIsNone(packer.split("X and Z", 2))
+
+
+class TestScheduler(unittest.TestCase):
+    def test_order(self):
+        scheduler = Scheduler(priorities={"3": 1})
+        items = [("1", Prompt("a", "short")), ("2", Prompt("a", "long " * 100)), ("3", Prompt("a", "short"))]
+        scheduler.start(items, OpenAIModel())
+        # Priority first, then the longest prompt
+        self.assertEqual([scheduler.get().index, scheduler.get().index], ["3", "2"])
+        scheduler.task_done()
+        job = scheduler.get()
+        scheduler.retry(job, 0, (1, 0, "gpt-3.5-turbo-0613"))
+        self.assertIs(scheduler.get(), job)
+        scheduler.task_done()
+        scheduler.task_done()
+        self.assertIsNone(scheduler.get())
+
+    def test_tokens_counted_lazily(self):
+        scheduler = Scheduler(window=2)
+        model = OpenAIModel()
+        items = [(str(i), Prompt("a", "word " * i)) for i in range(5)]
+        with mock.patch.object(model, "count_tokens", wraps=model.count_tokens) as count_tokens:
+            scheduler.start(items, model)
+            self.assertEqual(count_tokens.call_count, 0)
+            # The longest of the first window goes first
+            self.assertEqual(scheduler.get().index, "1")
+            self.assertEqual(count_tokens.call_count, 2)
+
+    def test_unsupported_engines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            tool = ParallelToolkit(config_path=write_config(directory, ["a"]), scheduler=Scheduler())
+            with self.assertRaises(ValueError):
+                asyncio.run(tool.aparallel_api({}))
+            with self.assertRaises(ValueError):
+                next(tool.iter_api({}))
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+    def test_aimd(self):
+        concurrency = AdaptiveConcurrency(initial=4, max_limit=5)
+        for _ in range(20):
+            for _ in range(4):
+                concurrency.acquire()
+            for _ in range(4):
+                concurrency.release(latency=0.1)
+        self.assertEqual(concurrency.limit, 5)
+        concurrency.acquire()
+        concurrency.release(congested=True)
+        self.assertEqual(int(concurrency.limit), 3)
+
+    def test_async_waiters_woken_on_release(self):
+        concurrency = AdaptiveConcurrency(initial=1, max_limit=1)
+
+        async def run():
+            await concurrency.aacquire()
+            waiter = asyncio.ensure_future(concurrency.aacquire())
+            await asyncio.sleep(0)
+            self.assertFalse(waiter.done())
+            self.assertEqual(len(concurrency.async_waiters), 1)
+            # Released from another thread, as a thread engine request would
+            threading.Thread(target=concurrency.release).start()
+            await asyncio.wait_for(waiter, timeout=1)
+            self.assertEqual(concurrency.in_flight, 1)
+
+        asyncio.run(run())
+
+
+class TestTracer(unittest.TestCase):
+    def test_ring_buffer(self):
+        tracer = Tracer(capacity=4)
+        with tracer.span("http"):
+            pass
+        self.assertIsNone(tracer.spans[0])
+        tracer.enable()
+        for index in range(6):
+            with tracer.span("item", index):
+                pass
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.json")
+            self.assertEqual(tracer.export_chrome(path), 4)
+            with open(path) as f:
+                events = json.load(f)["traceEvents"]
+        self.assertEqual([event["args"]["index"] for event in events], [2, 3, 4, 5])
+
+
+class TestPromptDataset(unittest.TestCase):
+    def test_lazy_and_interned(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "input.jsonl")
+            with open(path, "w", encoding="utf-8") as f:
+                for index in (3, 1, 2):
+                    f.write(json.dumps({"index": str(index), "instruction": "translate", "input": f"text {index}"}))
+                    f.write("\n")
+            with PromptDataset(path) as dataset:
+                self.assertEqual(dataset.instructions, ["translate"])
+                self.assertEqual(dataset.find(1), 1)
+                self.assertIsNone(dataset.find("01"))
+                subset = dataset.select(skip={"3"})
+                self.assertEqual([(index, prompt.input) for index, prompt in subset.items()],
+                                 [("1", "text 1"), ("2", "text 2")])